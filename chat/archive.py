@@ -0,0 +1,224 @@
+"""
+Архив старых сообщений.
+
+`archive_messages(cutoff)` переносит сообщения старше `cutoff` из
+chat_chatmessage в сегменты – gzip-файлы JSONL в CHAT_ARCHIVE['DIR'],
+разложенные по месяцам (`YYYY/MM/<first_id>-<last_id>-<rows>.jsonl.gz`).
+Каждый прогон пишет новые файлы, записанные не меняются. Файл сначала
+записывается целиком, затем одной транзакцией создаётся запись
+ArchiveSegment (манифест) и удаляются перенесённые строки. Файл, для
+которого записи в манифесте нет (сбой между шагами), не читается, а
+следующий прогон записывает его заново.
+
+Последнее сообщение диалога (Conversation.last_message) не архивируется,
+чтобы сводка диалога оставалась полной.
+
+`ArchivedHistory` читает сегменты пользователя как ещё одну ветвь
+keyset-пагинации истории (см. KeysetPagination.paginate_queryset).
+"""
+import collections
+import datetime
+import functools
+import gzip
+import os
+from pathlib import Path
+
+from django.db import transaction
+from django.utils.functional import cached_property
+
+from . import codec, history_cache
+from .conf import chat_setting
+from .models import (
+    ArchiveSegment, ArchiveSegmentMember, ChatMessage, Conversation
+)
+
+FIELDS = ('id', 'uid', 'sender_id', 'receiver_id', 'content', 'timestamp',
+          'conversation_id', 'seq')
+
+
+def archive_dir():
+    return Path(chat_setting('CHAT_ARCHIVE')['DIR'])
+
+
+def candidates(cutoff):
+    """
+    Сообщения старше `cutoff`, которые можно архивировать, от старых к новым.
+    """
+    last_messages = Conversation.objects.filter(
+        last_message__isnull=False
+    ).values('last_message_id')
+    return ChatMessage.objects.filter(timestamp__lt=cutoff).exclude(
+        pk__in=last_messages
+    ).order_by('timestamp', 'id')
+
+
+def write_segment(relative_path, rows):
+    """
+    Записывает сегмент через временный файл с fsync, чтобы в манифест не
+    попал недописанный файл.
+    """
+    path = archive_dir() / relative_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + '.tmp')
+    with open(temporary, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as compressed:
+            for row in rows:
+                line = dict(row, uid=str(row['uid']),
+                            timestamp=row['timestamp'].isoformat())
+                compressed.write(codec.dumps(line).encode() + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temporary, path)
+
+
+def archive_batch(rows):
+    """
+    Переносит строки `rows` в сегменты по месяцам. Возвращает созданные
+    сегменты.
+    """
+    months = collections.defaultdict(list)
+    for row in rows:
+        months[row['timestamp'].date().replace(day=1)].append(row)
+
+    segments = []
+    for month, items in months.items():
+        relative_path = (f"{month:%Y/%m}/{items[0]['id']}-{items[-1]['id']}"
+                         f"-{len(items)}.jsonl.gz")
+        write_segment(relative_path, items)
+        members = collections.Counter()
+        for row in items:
+            members.update({row['sender_id'], row['receiver_id']})
+        segments.append((ArchiveSegment(
+            path=relative_path,
+            month=month,
+            rows=len(items),
+            first_id=items[0]['id'],
+            last_id=items[-1]['id'],
+            first_timestamp=items[0]['timestamp'],
+            last_timestamp=items[-1]['timestamp'],
+        ), members))
+
+    with transaction.atomic():
+        for segment, members in segments:
+            segment.save()
+            ArchiveSegmentMember.objects.bulk_create([
+                ArchiveSegmentMember(segment=segment, user_id=user_id,
+                                     rows=count)
+                for user_id, count in members.items()
+            ])
+        ChatMessage.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+    history_cache.invalidate({(row['sender_id'], row['receiver_id'])
+                              for row in rows})
+    return [segment for segment, _ in segments]
+
+
+def archive_messages(cutoff, batch_size=None):
+    """
+    Архивирует все сообщения старше `cutoff` пачками по `batch_size`.
+    Возвращает (число сообщений, число сегментов).
+    """
+    batch_size = batch_size or chat_setting('CHAT_ARCHIVE')['BATCH_SIZE']
+    archived = created = 0
+    while True:
+        rows = list(candidates(cutoff).values(*FIELDS)[:batch_size])
+        if not rows:
+            return archived, created
+        created += len(archive_batch(rows))
+        archived += len(rows)
+
+
+def iter_segment(path):
+    """
+    Строки сегмента по одной, без чтения файла целиком.
+    """
+    with gzip.open(path, 'rb') as compressed:
+        for line in compressed:
+            row = codec.loads(line)
+            row['timestamp'] = datetime.datetime.fromisoformat(
+                row['timestamp']
+            )
+            yield row
+
+
+@functools.lru_cache(maxsize=64)
+def read_segment(path):
+    """
+    Строки сегмента. Файлы неизменны, поэтому разобранные сегменты
+    кэшируются по пути.
+    """
+    return list(iter_segment(path))
+
+
+class ArchivedHistory:
+    """
+    Архивные сообщения пользователя `user_id` (при `counterpart_id` – только
+    переписка с ним) в порядке keyset-пагинации по (timestamp, id).
+    """
+    def __init__(self, user_id, counterpart_id=None, fields=FIELDS):
+        self.user_id = user_id
+        self.counterpart_id = counterpart_id
+        self.fields = fields
+
+    def segments(self):
+        segments = ArchiveSegment.objects.filter(members__user_id=self.user_id)
+        if self.counterpart_id is not None:
+            segments = segments.filter(pk__in=ArchiveSegmentMember.objects
+                                       .filter(user_id=self.counterpart_id)
+                                       .values('segment_id'))
+        return segments
+
+    @cached_property
+    def horizon(self):
+        """
+        Время самого нового архивного сообщения пользователя или None.
+        """
+        latest = self.segments().order_by('-last_timestamp').first()
+        return latest.last_timestamp if latest is not None else None
+
+    def matches(self, row):
+        participants = (row['sender_id'], row['receiver_id'])
+        if self.user_id not in participants:
+            return False
+        if self.counterpart_id is None:
+            return True
+        return sorted(participants) == sorted((self.user_id,
+                                               self.counterpart_id))
+
+    def fetch(self, cursor, descending, limit):
+        """
+        До `limit` строк за курсором (timestamp, id): старше него при
+        `descending`, иначе новее. Сегменты читаются от ближайшего к
+        курсору, пока следующий не может содержать строк лучше уже
+        найденных.
+        """
+        segments = self.segments()
+        if cursor is not None:
+            if descending:
+                segments = segments.filter(first_timestamp__lte=cursor[0])
+            else:
+                segments = segments.filter(last_timestamp__gte=cursor[0])
+        segments = segments.order_by(
+            '-last_timestamp' if descending else 'first_timestamp'
+        )
+
+        def key(row):
+            return row['timestamp'], row['id']
+
+        rows = []
+        for segment in segments:
+            if len(rows) >= limit:
+                bound = rows[limit - 1]['timestamp']
+                if descending and segment.last_timestamp < bound or \
+                        not descending and segment.first_timestamp > bound:
+                    break
+            for row in read_segment(str(archive_dir() / segment.path)):
+                if not self.matches(row):
+                    continue
+                if cursor is not None and (
+                        key(row) >= cursor if descending else
+                        key(row) <= cursor):
+                    continue
+                rows.append({field: row[field] for field in self.fields})
+            rows.sort(key=key, reverse=descending)
+            del rows[limit:]
+        return rows
@@ -0,0 +1,227 @@
+"""
+Нагрузочные сценарии для `python manage.py chat_bench`.
+
+Каждый сценарий регистрируется декоратором `scenario` и возвращает словарь
+с результатами, который команда печатает в виде JSON. Сценарии работают
+во временной базе данных, рабочая база не затрагивается.
+"""
+import contextlib
+import importlib
+import inspect
+import statistics
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+from chat import db
+
+SCENARIOS = {}
+
+SCENARIO_MODULES = [
+    'chat.bench.history',
+    'chat.bench.api',
+    'chat.bench.write_behind',
+    'chat.bench.reconnect',
+    'chat.bench.multiplex',
+    'chat.bench.fanout',
+    'chat.bench.encode',
+    'chat.bench.flood',
+    'chat.bench.load',
+    'chat.bench.search',
+    'chat.bench.archive',
+    'chat.bench.export',
+    'chat.bench.sharding',
+    'chat.bench.history_cache',
+    'chat.bench.local_layer',
+    'chat.bench.broadcast',
+    'chat.bench.db_executor',
+    'chat.bench.framing',
+    'chat.bench.relations',
+]
+
+
+def scenario(name):
+    """
+    Регистрирует функцию сценария под именем `name`.
+    """
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+    return decorator
+
+
+def load_scenarios():
+    for module in SCENARIO_MODULES:
+        # Импорт подмодуля записывает его в атрибут пакета: модуль с именем
+        # помощника (так было с connect.py, отсюда reconnect.py) подменил бы
+        # функцию для сценариев, импортированных после него.
+        helper = globals().get(module.rsplit('.', 1)[1])
+        if helper is not None and not inspect.ismodule(helper):
+            raise ImportError(f'{module} перекрывает помощник '
+                              f'chat.bench.{helper.__name__}.')
+        importlib.import_module(module)
+    return SCENARIOS
+
+
+@contextlib.contextmanager
+def temporary_database(name='bench_db.sqlite3'):
+    """
+    Создаёт отдельную базу с применёнными миграциями и удаляет её по выходу.
+    """
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    previous = test_settings.get('NAME')
+    test_settings['NAME'] = name
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False
+    )
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = previous
+
+
+def percentiles(samples):
+    """
+    Сводка по замерам в миллисекундах.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def pick(fraction):
+        index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': pick(0.50),
+        'p90_ms': pick(0.90),
+        'p99_ms': pick(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def measure(func, repeat):
+    """
+    Выполняет `func` `repeat` раз и возвращает длительности в секундах.
+    """
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+IN_MEMORY_LAYER = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+}
+
+
+async def connect(user, path, timeout=1):
+    """
+    Открывает WebSocket-соединение от имени `user` через ASGI-приложение.
+    """
+    from channels.testing import WebsocketCommunicator
+    from chat_channels.asgi import application
+
+    communicator = WebsocketCommunicator(application, path)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect(timeout)
+    if not connected:
+        raise RuntimeError(f'{user} не смог подключиться к {path}')
+    return communicator
+
+
+@contextlib.contextmanager
+def query_counter():
+    """
+    Считает SQL-запросы внутри блока: в текущем соединении, в вызовах
+    database_sync_to_async (они выполняются в потоке, вызвавшем
+    async_to_sync) и в потоках пула chat.db. Пул пересоздаётся на входе и
+    выходе, чтобы его потоки открыли соединения со счётчиком.
+    """
+    counted = {'queries': 0}
+    lock = threading.Lock()
+
+    def wrapper(execute, sql, params, many, context):
+        with lock:
+            counted['queries'] += 1
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        if wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(wrapper)
+
+    db.reset_executor()
+    connection_created.connect(install)
+    try:
+        with connection.execute_wrapper(wrapper):
+            yield counted
+    finally:
+        connection_created.disconnect(install)
+        db.reset_executor()
+
+
+def count_queries(func):
+    """
+    Считает SQL-запросы, выполненные `func` в текущем соединении.
+    """
+    with query_counter() as counted:
+        func()
+    return counted['queries']
+
+
+def create_users(prefix, count, is_staff=False):
+    """
+    Массово создаёт пользователей без хеширования паролей.
+    """
+    User.objects.bulk_create(
+        [User(username=f'{prefix}{i}', is_staff=is_staff)
+         for i in range(count)],
+        batch_size=1000,
+    )
+    return list(User.objects.filter(username__startswith=prefix)
+                .order_by('id'))
+
+
+def seed_messages(pairs, rows, batch_size=5000, content=None,
+                  spacing=timedelta(seconds=1)):
+    """
+    Заполняет таблицу сообщений `rows` записями по кругу пар
+    (sender_id, receiver_id) со строго возрастающим временем с шагом
+    `spacing`. `content(i)` задаёт текст i-го сообщения.
+    Вставка идёт через executemany, чтобы не тратить время на модели.
+    """
+    from chat.models import ChatMessage
+
+    table = ChatMessage._meta.db_table
+    sql = (f'INSERT INTO {table} '
+           f'(sender_id, receiver_id, uid, content, timestamp) '
+           f'VALUES (%s, %s, %s, %s, %s)')
+    adapt = connection.ops.adapt_datetimefield_value
+    uid_field = ChatMessage._meta.get_field('uid')
+    start = timezone.now() - spacing * rows
+    batch = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for i in range(rows):
+            sender_id, receiver_id = pairs[i % len(pairs)]
+            batch.append((
+                sender_id, receiver_id,
+                uid_field.get_db_prep_value(uuid.uuid4(), connection),
+                content(i) if content else f'message {i}',
+                adapt(start + spacing * i),
+            ))
+            if len(batch) >= batch_size:
+                cursor.executemany(sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
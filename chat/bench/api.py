@@ -0,0 +1,69 @@
+"""
+Пропускная способность списков `/messages/` и `/relations/`: быстрые
+сериализаторы против вложенных ModelSerializer без select_related.
+"""
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat.models import ChatMessage, ChatRelation
+from chat.serializers import ChatMessageSerializer, ChatRelationSerializer
+from chat.views import ChatMessageViewSet, ChatRelationViewSet
+from . import (
+    count_queries, create_users, measure, percentiles, scenario, seed_messages,
+)
+
+
+def throughput(samples):
+    summary = percentiles(samples)
+    summary['requests_per_sec'] = round(len(samples) / sum(samples), 2)
+    return summary
+
+
+@scenario('api')
+def run(options):
+    rows = options['rows']
+    repeat = options['repeat']
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', options.get('clients') or 500)
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=manager, client=client) for client in clients]
+    )
+    pairs = [(manager.id, c.id) for c in clients] + \
+        [(c.id, manager.id) for c in clients]
+    seed_messages(pairs, rows)
+
+    factory = APIRequestFactory()
+    message_list = ChatMessageViewSet.as_view({'get': 'list'})
+    relation_list = ChatRelationViewSet.as_view({'get': 'list'})
+
+    def call(view, path):
+        def request():
+            req = factory.get(path)
+            force_authenticate(req, user=manager)
+            view(req).render()
+        return request
+
+    def legacy_messages():
+        ChatMessageSerializer(
+            ChatMessage.objects.filter(sender=manager) |
+            ChatMessage.objects.filter(receiver=manager), many=True
+        ).data
+
+    def legacy_relations():
+        ChatRelationSerializer(
+            ChatRelation.objects.filter(manager=manager), many=True
+        ).data
+
+    messages = call(message_list, '/messages/')
+    relations = call(relation_list, '/relations/?limit=1000')
+    return {
+        'rows': rows,
+        'relation_rows': len(clients),
+        'messages': throughput(measure(messages, repeat)),
+        'messages_queries': count_queries(messages),
+        'messages_legacy': throughput(measure(legacy_messages, repeat)),
+        'messages_legacy_queries': count_queries(legacy_messages),
+        'relations': throughput(measure(relations, repeat)),
+        'relations_queries': count_queries(relations),
+        'relations_legacy': throughput(measure(legacy_relations, repeat)),
+        'relations_legacy_queries': count_queries(legacy_relations),
+    }
@@ -0,0 +1,97 @@
+"""
+Архивирование: размер горячей таблицы и задержка страниц истории до и
+после переноса старых сообщений в сегменты. История распределена по двум
+годам, в горячей таблице остаются последние 90 дней.
+"""
+import random
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from chat.archive import ArchivedHistory, archive_messages
+from chat.models import ArchiveSegment, ChatMessage
+from chat.pagination import KeysetPagination
+from . import create_users, measure, percentiles, scenario, seed_messages
+
+HISTORY_DAYS = 730
+HOT_DAYS = 90
+FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp')
+
+
+def page(user, params):
+    request = Request(APIRequestFactory().get('/messages/history/', params))
+    messages = ChatMessage.objects.values(*FIELDS)
+    paginator = KeysetPagination()
+    paginator.paginate_queryset(
+        [messages.filter(sender=user), messages.filter(receiver=user)],
+        request, archive=ArchivedHistory(user.id, fields=FIELDS)
+    )
+    return paginator
+
+
+def measure_pages(user, cursors, repeat):
+    return {
+        'first_page': percentiles(measure(lambda: page(user, {}), repeat)),
+        **{
+            f'{name}_page': percentiles(measure(
+                lambda: page(user, {'before': random.choice(group)}), repeat
+            ))
+            for name, group in cursors.items()
+        },
+    }
+
+
+@scenario('archive')
+def run(options):
+    rows = options['rows']
+    repeat = options['repeat']
+    client = create_users('bench_client', 1)[0]
+    managers = create_users('bench_manager', options.get('clients') or 50,
+                            is_staff=True)
+    pairs = []
+    for manager in managers:
+        pairs.append((client.id, manager.id))
+        pairs.append((manager.id, client.id))
+    seed_messages(pairs, rows,
+                  spacing=timedelta(days=HISTORY_DAYS) / rows)
+
+    cutoff = timezone.now() - timedelta(days=HOT_DAYS)
+    encode = KeysetPagination().encode_cursor
+    sample = random.sample(range(rows), min(rows, 200))
+    messages = list(ChatMessage.objects.order_by('id').values(
+        'id', 'timestamp'
+    ))
+    picked = [messages[i] for i in sample]
+    cursors = {
+        'recent': [encode(row) for row in picked
+                   if row['timestamp'] >= cutoff],
+        'old': [encode(row) for row in picked
+                if row['timestamp'] < cutoff],
+    }
+
+    result = {
+        'rows': rows,
+        'hot_rows_before': ChatMessage.objects.count(),
+        'before_archive': measure_pages(client, cursors, repeat),
+    }
+    with tempfile.TemporaryDirectory() as directory, \
+            override_settings(CHAT_ARCHIVE={'DIR': directory}):
+        started = time.perf_counter()
+        archived, segments = archive_messages(cutoff)
+        result['archive_seconds'] = round(time.perf_counter() - started, 1)
+        result['archived_rows'] = archived
+        result['segments'] = segments
+        result['archive_bytes'] = sum(
+            path.stat().st_size for path in Path(directory).rglob('*.gz')
+        )
+        result['months'] = ArchiveSegment.objects.values('month') \
+            .distinct().count()
+        result['hot_rows_after'] = ChatMessage.objects.count()
+        result['after_archive'] = measure_pages(client, cursors, repeat)
+    return result
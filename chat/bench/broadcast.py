@@ -0,0 +1,106 @@
+"""
+Рассылка менеджера `--clients` клиентам (по умолчанию 10 000): время до
+доставки последнему получателю и SQL-запросы для chat.broadcast против
+цикла отправок по одной, как при N отдельных сообщениях через
+ChatConsumer (INSERT и fan_out на каждое).
+
+Каждый клиент слушает свою группу уведомлений. Слой – LocalChannelLayer,
+с `--redis` – channels_redis.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+
+from chat import services
+from chat.broadcast import broadcast, broadcast_events
+from chat.fanout import fan_out
+from chat.local_layer import LocalChannelLayer
+from chat.models import ChatRelation
+from . import create_users, query_counter, scenario
+
+CAPACITY = 100
+
+
+def make_layer(hosts):
+    if hosts:
+        from channels_redis.core import RedisChannelLayer
+        return RedisChannelLayer(hosts=hosts, capacity=CAPACITY)
+    return LocalChannelLayer(capacity=CAPACITY)
+
+
+async def listen(layer, clients):
+    channels = []
+    for client in clients:
+        channel = await layer.new_channel()
+        await layer.group_add(f'user_{client.id}_notifications', channel)
+        channels.append(channel)
+    return channels
+
+
+async def drain(layer, channels, started):
+    """
+    Ждёт кадр на каждом канале; возвращает время от `started` до
+    последней доставки.
+    """
+    await asyncio.gather(*(layer.receive(channel) for channel in channels))
+    return time.perf_counter() - started
+
+
+async def one_by_one(layer, manager, clients, content):
+    send = database_sync_to_async(services.create_chat_message)
+    for client in clients:
+        message = await send(manager, client.id, content, manager.id,
+                             client.id)
+        await fan_out(layer, broadcast_events(manager.id, [message])[0])
+
+
+async def measure(layer, clients, send):
+    channels = await listen(layer, clients)
+    receivers = asyncio.ensure_future(drain(layer, channels,
+                                            time.perf_counter()))
+    started = time.perf_counter()
+    await send()
+    written = time.perf_counter() - started
+    delivered = await receivers
+    await layer.flush()
+    return {
+        'send_returned_seconds': round(written, 3),
+        'last_delivery_seconds': round(delivered, 3),
+        'deliveries_per_second': round(len(clients) / delivered),
+    }
+
+
+@scenario('broadcast')
+def run(options):
+    count = options.get('clients') or 10_000
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', count)
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=manager, client=client) for client in clients],
+        batch_size=1000,
+    )
+    result = {'recipients': count,
+              'layer': 'redis' if options['redis'] else 'local'}
+
+    layer = make_layer(options['redis'])
+    with query_counter() as counted:
+        result['broadcast'] = async_to_sync(measure)(
+            layer, clients,
+            lambda: broadcast(layer, manager, 'объявление')
+        )
+    result['broadcast']['queries'] = counted['queries']
+
+    layer = make_layer(options['redis'])
+    with query_counter() as counted:
+        result['one_by_one'] = async_to_sync(measure)(
+            layer, clients,
+            lambda: one_by_one(layer, manager, clients, 'по одному')
+        )
+    result['one_by_one']['queries'] = counted['queries']
+    result['speedup'] = round(
+        result['one_by_one']['last_delivery_seconds'] /
+        result['broadcast']['last_delivery_seconds'], 1
+    )
+    return result
@@ -0,0 +1,106 @@
+"""
+Одновременные подключения к ChatConsumer: проверка доступа в общем потоке
+database_sync_to_async (MAX_WORKERS = 0) против пула chat.db.
+
+`--clients` соединений (по умолчанию 1000) подключаются разом, кэш
+доступа выключен, так что каждое делает запрос к ChatRelation. Замер –
+при времени ответа БД 0 и 2 мс: к каждому запросу добавляется пауза, как
+round trip до сервера БД (SQLite в файле отвечает мгновенно). Кроме
+задержки подключения выводится ожидание потока из chat_db_queue_seconds.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from chat import db
+from chat.models import ChatRelation
+from . import IN_MEMORY_LAYER, connect, create_users, percentiles, scenario
+
+LATENCIES_MS = (0, 2)
+WORKERS = (0, 16)
+
+
+class DatabaseLatency:
+    """
+    Пауза перед каждым запросом во всех соединениях с БД, включая
+    соединения потоков пула.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        time.sleep(self.seconds)
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        self.install()
+        connection_created.connect(self.install)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        if self in connection.execute_wrappers:
+            connection.execute_wrappers.remove(self)
+
+
+async def storm(pairs):
+    samples = []
+
+    async def open_one(manager, client):
+        started = time.perf_counter()
+        communicator = await connect(
+            client, f'/ws/chat/{manager.id}/{client.id}/', timeout=60
+        )
+        samples.append(time.perf_counter() - started)
+        return communicator
+
+    communicators = await asyncio.gather(*(open_one(*pair)
+                                           for pair in pairs))
+    for communicator in communicators:
+        await communicator.disconnect()
+    return samples
+
+
+def run_mode(pairs, workers, latency):
+    db.reset_executor()
+    db.queue_seconds.reset()
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER,
+                           CHAT_RELATION_CACHE={'ENABLED': False},
+                           CHAT_DB_EXECUTOR={'MAX_WORKERS': workers}), \
+            DatabaseLatency(latency / 1000):
+        started = time.perf_counter()
+        samples = async_to_sync(storm)(pairs)
+        elapsed = time.perf_counter() - started
+    db.reset_executor()
+    return {
+        'workers': workers or 'shared thread',
+        'db_latency_ms': latency,
+        'connect': percentiles(samples),
+        'connects_per_second': round(len(samples) / elapsed),
+        'queue_p50_ms': round(db.queue_seconds.quantile(0.5) * 1000, 3),
+        'queue_p99_ms': round(db.queue_seconds.quantile(0.99) * 1000, 3),
+    }
+
+
+@scenario('db_executor')
+def run(options):
+    count = options.get('clients') or 1000
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', count)
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=manager, client=client) for client in clients]
+    )
+    pairs = [(manager, client) for client in clients]
+    return {
+        'connections': count,
+        'modes': [run_mode(pairs, workers, latency)
+                  for latency in LATENCIES_MS for workers in WORKERS],
+    }
@@ -0,0 +1,100 @@
+"""
+Процессорное время на одну доставку: кадр, кодируемый каждым получателем
+(json.dumps в обработчике), против кадра, закодированного один раз при
+отправке. Отдельно – разбор входящих кадров json и chat.codec.
+"""
+import json
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from django.utils import timezone
+
+from chat import codec
+from chat.consumers import ChatConsumer
+from . import scenario
+
+
+class PerRecipientConsumer(ChatConsumer):
+    """
+    Прежний обработчик: кадр собирается и кодируется для каждого получателя.
+    """
+    async def chat_message(self, event):
+        await self.send(text_data=json.dumps({
+            'conversation': event['conversation'],
+            'sender_id': event['sender_id'],
+            'message': event['message'],
+            'uid': event['uid'],
+            'timestamp': event['timestamp'],
+        }))
+
+
+def make_recipients(consumer_class, count):
+    async def base_send(message):
+        pass
+
+    recipients = []
+    for _ in range(count):
+        consumer = consumer_class()
+        consumer.base_send = base_send
+        recipients.append(consumer)
+    return recipients
+
+
+def make_frame(i):
+    return {
+        'conversation': '1_2',
+        'sender_id': 1,
+        'message': f'Сообщение номер {i} ' * 4,
+        'uid': str(uuid.uuid4()),
+        'timestamp': timezone.now().isoformat(),
+    }
+
+
+async def deliver(recipients, messages, pre_encoded):
+    started = time.process_time()
+    for i in range(messages):
+        frame = make_frame(i)
+        if pre_encoded:
+            event = {'type': 'chat_message', 'conversation': '1_2',
+                     'text': codec.dumps(frame)}
+        else:
+            event = {'type': 'chat_message', **frame}
+        for consumer in recipients:
+            await consumer.chat_message(event)
+    return time.process_time() - started
+
+
+def parse(loads, frames):
+    started = time.process_time()
+    for text in frames:
+        loads(text)
+    return time.process_time() - started
+
+
+@scenario('encode')
+def run(options):
+    messages = options['messages']
+    clients = options.get('clients') or 100
+    deliveries = messages * clients
+    result = {'messages': messages, 'recipients': clients,
+              'codec': codec.BACKEND}
+    for name, consumer_class, pre_encoded in (
+        ('per_recipient_dumps', PerRecipientConsumer, False),
+        ('pre_encoded', ChatConsumer, True),
+    ):
+        recipients = make_recipients(consumer_class, clients)
+        seconds = async_to_sync(deliver)(recipients, messages, pre_encoded)
+        result[name] = {
+            'cpu_us_per_delivery': round(seconds / deliveries * 1e6, 3),
+        }
+
+    frames = [json.dumps({'action': 'message', 'conversation': '1_2',
+                          'message': make_frame(i)['message']})
+              for i in range(messages)]
+    for name, loads in (('json', json.loads), ('codec', codec.loads)):
+        seconds = parse(loads, frames)
+        result[f'receive_{name}'] = {
+            'cpu_us_per_frame': round(seconds / messages * 1e6, 3),
+        }
+    return result
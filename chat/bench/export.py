@@ -0,0 +1,71 @@
+"""
+Потоковая выгрузка переписки: пик памяти Python (tracemalloc) и прирост
+RSS процесса при выгрузке `--rows` сообщений одной пары через
+`/relations/<id>/export/` против сборки того же ответа списком, как это
+делает `/messages/`, на десятой части истории.
+"""
+import itertools
+import resource
+import time
+import tracemalloc
+
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat import export
+from chat.models import ChatRelation
+from chat.views import ChatRelationViewSet
+from . import create_users, scenario, seed_messages
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def traced(func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = func()
+        elapsed = time.perf_counter() - started
+        return result, elapsed, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+@scenario('export')
+def run(options):
+    rows = options['rows']
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    client = create_users('bench_client', 1)[0]
+    relation = ChatRelation.objects.create(manager=manager, client=client)
+    seed_messages([(manager.id, client.id), (client.id, manager.id)], rows)
+
+    view = ChatRelationViewSet.as_view({'get': 'export'})
+
+    def stream():
+        request = APIRequestFactory().get(f'/relations/{relation.id}/export/')
+        force_authenticate(request, user=client)
+        response = view(request, pk=relation.id)
+        return sum(len(chunk) for chunk in response.streaming_content)
+
+    rss_before = rss_mb()
+    size, elapsed, peak = traced(stream)
+    rss_after = rss_mb()
+
+    def materialize():
+        messages = list(itertools.islice(
+            export.hot_messages(manager.id, client.id), rows // 10
+        ))
+        return len(''.join(export.ndjson_lines(messages)))
+
+    _, _, list_peak = traced(materialize)
+    return {
+        'rows': rows,
+        'export_mb': round(size / 2 ** 20, 1),
+        'export_seconds': round(elapsed, 1),
+        'rows_per_sec': round(rows / elapsed),
+        'stream_peak_python_mb': round(peak, 2),
+        'stream_max_rss_growth_mb': round(rss_after - rss_before, 1),
+        'list_rows': rows // 10,
+        'list_peak_python_mb': round(list_peak, 2),
+    }
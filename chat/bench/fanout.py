@@ -0,0 +1,99 @@
+"""
+Рассылка одного сообщения в комнату и в группу уведомлений получателя:
+два group_send против совмещённого fan_out. Для Redis (`--redis`)
+дополнительно считаются round trip'ы.
+"""
+import contextlib
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+
+from chat.fanout import fan_out
+from . import percentiles, scenario
+
+
+@contextlib.contextmanager
+def count_round_trips():
+    """
+    Считает отправки пакетов в Redis: одна команда или один pipeline –
+    один round trip.
+    """
+    from redis.asyncio.connection import AbstractConnection
+
+    original = AbstractConnection.send_packed_command
+    counter = {'round_trips': 0}
+
+    async def counted(self, *args, **kwargs):
+        counter['round_trips'] += 1
+        return await original(self, *args, **kwargs)
+
+    AbstractConnection.send_packed_command = counted
+    try:
+        yield counter
+    finally:
+        AbstractConnection.send_packed_command = original
+
+
+def make_layer(hosts):
+    if not hosts:
+        return InMemoryChannelLayer(capacity=10_000)
+    from channels_redis.core import RedisChannelLayer
+    return RedisChannelLayer(hosts=hosts, capacity=10_000)
+
+
+async def run_mode(layer, coalesced, messages, devices):
+    room, notifications = 'chat_1_2', 'user_2_notifications'
+    manager = await layer.new_channel()
+    client = await layer.new_channel()
+    await layer.group_add(room, manager)
+    await layer.group_add(room, client)
+    await layer.group_add(notifications, client)
+    # Прочие устройства получателя, не открывшие комнату.
+    others = [await layer.new_channel() for _ in range(devices)]
+    for channel in others:
+        await layer.group_add(notifications, channel)
+    # Клиент в комнате без совмещения получает сообщение дважды.
+    expected = [(manager, 1), (client, 1 if coalesced else 2)]
+    expected += [(channel, 1) for channel in others]
+
+    send_samples = []
+    delivery_samples = []
+    for i in range(messages):
+        message = {'type': 'chat_message', 'message': f'bench {i}'}
+        notify = {'type': 'new_message_notify', 'message': f'bench {i}'}
+        started = time.perf_counter()
+        if coalesced:
+            await fan_out(layer, [(room, message), (notifications, notify)])
+        else:
+            await layer.group_send(room, message)
+            await layer.group_send(notifications, notify)
+        send_samples.append(time.perf_counter() - started)
+        for channel, count in expected:
+            for _ in range(count):
+                await layer.receive(channel)
+        delivery_samples.append(time.perf_counter() - started)
+    await layer.flush()
+    return send_samples, delivery_samples, sum(c for _, c in expected)
+
+
+@scenario('fanout')
+def run(options):
+    messages = options['messages']
+    devices = options.get('clients') or 3
+    result = {'messages': messages, 'receiver_devices': devices + 1}
+    for name, coalesced in (('group_send', False), ('fan_out', True)):
+        layer = make_layer(options['redis'])
+        with count_round_trips() as counter:
+            sends, deliveries, frames = async_to_sync(run_mode)(
+                layer, coalesced, messages, devices
+            )
+        result[name] = {
+            'send': percentiles(sends),
+            'end_to_end': percentiles(deliveries),
+            'deliveries_per_message': frames,
+            'redis_round_trips_per_message':
+                round(counter['round_trips'] / messages, 2)
+                if options['redis'] else None,
+        }
+    return result
@@ -0,0 +1,102 @@
+"""
+Один клиент засыпает свою комнату сообщениями с нескольких соединений,
+остальные комнаты пишут в обычном темпе. Сравнивается задержка доставки
+в спокойных комнатах и число записей флудера с ограничением частоты и без
+него.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+
+from chat.models import ChatMessage, ChatRelation
+from chat.ratelimit import user_buckets
+from . import IN_MEMORY_LAYER, connect, create_users, percentiles, scenario
+
+QUIET_MESSAGES = 20
+QUIET_INTERVAL = 0.25
+FLOOD_SOCKETS = 10
+
+
+async def drive(pairs, flood_frames):
+    (flood_manager, flooder), quiet_pairs = pairs[0], pairs[1:]
+    flood_sockets = [
+        await connect(flooder, f'/ws/chat/{flood_manager.id}/{flooder.id}/')
+        for _ in range(FLOOD_SOCKETS)
+    ]
+    quiet = []
+    for manager, client in quiet_pairs:
+        path = f'/ws/chat/{manager.id}/{client.id}/'
+        quiet.append((await connect(client, path),
+                      await connect(manager, path)))
+
+    async def flood(socket, frames):
+        for i in range(frames):
+            await socket.send_json_to({'message': f'flood {i}'})
+        # Кроме ошибок сокет получает сообщения, принятые с любого из
+        # сокетов флудера, поэтому читаем до тишины.
+        rejected = 0
+        while not await socket.receive_nothing(timeout=1):
+            frame = await socket.receive_json_from()
+            rejected += frame.get('code') == 'rate_limited'
+        return rejected
+
+    async def quiet_room(sender, receiver):
+        samples = []
+        for i in range(QUIET_MESSAGES):
+            started = time.perf_counter()
+            await sender.send_json_to({'message': f'quiet {i}'})
+            await receiver.receive_json_from(timeout=120)
+            samples.append(time.perf_counter() - started)
+            await asyncio.sleep(QUIET_INTERVAL)
+        return samples
+
+    per_socket = flood_frames // FLOOD_SOCKETS
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(flood(socket, per_socket) for socket in flood_sockets),
+        *(quiet_room(*pair) for pair in quiet)
+    )
+    elapsed = time.perf_counter() - started
+    for sockets in quiet:
+        for communicator in sockets:
+            await communicator.disconnect()
+    for socket in flood_sockets:
+        await socket.disconnect()
+    rejected = sum(results[:FLOOD_SOCKETS])
+    samples = [s for room in results[FLOOD_SOCKETS:] for s in room]
+    return rejected, samples, elapsed
+
+
+def run_mode(pairs, flood_frames, enabled):
+    ChatMessage.objects.all().delete()
+    user_buckets.clear()
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER,
+                           CHAT_RATE_LIMIT={'ENABLED': enabled}):
+        rejected, samples, elapsed = async_to_sync(drive)(pairs,
+                                                          flood_frames)
+    flooder = pairs[0][1]
+    return {
+        'quiet_latency': percentiles(samples),
+        'flood_frames': flood_frames,
+        'flood_rejected': rejected,
+        'flood_stored': ChatMessage.objects.filter(sender=flooder).count(),
+        'seconds': round(elapsed, 2),
+    }
+
+
+@scenario('flood')
+def run(options):
+    rooms = options.get('clients') or 5
+    managers = create_users('bench_manager', rooms + 1, is_staff=True)
+    clients = create_users('bench_client', rooms + 1)
+    pairs = list(zip(managers, clients))
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=m, client=c) for m, c in pairs]
+    )
+    return {
+        'quiet_rooms': rooms,
+        'without_limit': run_mode(pairs, options['messages'], enabled=False),
+        'with_limit': run_mode(pairs, options['messages'], enabled=True),
+    }
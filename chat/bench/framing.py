@@ -0,0 +1,127 @@
+"""
+Всплеск уведомлений менеджеру с `--clients` клиентами: `--messages`
+событий new_message_notify в группу уведомлений одного соединения
+UserChatConsumer в четырёх режимах – кадр на событие и пачки
+(`?batch=1`), JSON и msgpack (`?encoding=msgpack`).
+
+Считаются кадры, события и кадры в секунду и байты в сокете: полезная
+нагрузка плюс заголовок кадра WebSocket сервера (2, 4 или 10 байт). Колонка
+`deflate_bytes` – те же кадры после permessage-deflate с общим словарём
+соединения (zlib, как у ASGI-сервера с включённым сжатием).
+"""
+import asyncio
+import time
+import zlib
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.test import override_settings
+from django.utils import timezone
+
+from chat import codec
+from chat.consumers import message_frame
+from . import connect, create_users, scenario
+
+LAYER = {
+    'default': {
+        'BACKEND': 'chat.local_layer.LocalChannelLayer',
+        'CONFIG': {'capacity': 1_000_000},
+    },
+}
+MODES = [(False, 'json'), (True, 'json'), (False, 'msgpack'),
+         (True, 'msgpack')]
+
+
+def header_size(length):
+    if length < 126:
+        return 2
+    return 4 if length < 65536 else 10
+
+
+class Wire:
+    """
+    Учёт кадров в сокете, с permessage-deflate и без.
+    """
+    def __init__(self):
+        self.frames = 0
+        self.events = 0
+        self.bytes = 0
+        self.deflate_bytes = 0
+        self.deflate = zlib.compressobj(wbits=-15)
+
+    def add(self, output):
+        payload = output.get('bytes')
+        if payload is None:
+            payload = output['text'].encode()
+            events = codec.loads(payload)
+        else:
+            events = msgpack.unpackb(payload)
+        self.frames += 1
+        self.events += len(events) if isinstance(events, list) else 1
+        self.bytes += header_size(len(payload)) + len(payload)
+        # RFC 7692: сброс SYNC_FLUSH без четырёх последних байт.
+        compressed = (self.deflate.compress(payload) +
+                      self.deflate.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        self.deflate_bytes += header_size(len(compressed)) + len(compressed)
+
+
+def notifications(manager, clients, count):
+    now = timezone.now()
+    texts = []
+    for i in range(count):
+        client = clients[i % len(clients)]
+        conversation = f'{manager.id}_{client.id}'
+        frame = message_frame(conversation, client.id, f'сообщение {i}',
+                              f'{i:032x}', now, i + 1)
+        texts.append((conversation,
+                      codec.dumps({'notification': True, **frame})))
+    return texts
+
+
+async def burst(manager, texts, batch, encoding):
+    query = f'?encoding={encoding}' + ('&batch=1' if batch else '')
+    communicator = await connect(manager, '/ws/chat/' + query)
+    layer = get_channel_layer()
+    group = f'user_{manager.id}_notifications'
+    wire = Wire()
+
+    async def send():
+        for conversation, text in texts:
+            await layer.group_send(group, {
+                'type': 'new_message_notify',
+                'conversation': conversation,
+                'text': text,
+            })
+            await asyncio.sleep(0)
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    sender = asyncio.ensure_future(send())
+    while wire.events < len(texts):
+        wire.add(await communicator.receive_output(timeout=10))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    await sender
+    await communicator.disconnect()
+    return {
+        'batch': batch,
+        'encoding': encoding,
+        'frames': wire.frames,
+        'events_per_frame': round(wire.events / wire.frames, 1),
+        'frames_per_second': round(wire.frames / elapsed),
+        'events_per_second': round(wire.events / elapsed),
+        'cpu_us_per_event': round(cpu / wire.events * 1_000_000, 1),
+        'bytes': wire.bytes,
+        'deflate_bytes': wire.deflate_bytes,
+    }
+
+
+@scenario('framing')
+def run(options):
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', options.get('clients') or 50)
+    texts = notifications(manager, clients, options['messages'])
+    with override_settings(CHANNEL_LAYERS=LAYER):
+        modes = [async_to_sync(burst)(manager, texts, batch, encoding)
+                 for batch, encoding in MODES]
+    return {'events': len(texts), 'modes': modes}
@@ -0,0 +1,74 @@
+"""
+Сравнение keyset-страниц истории с текущим OR-сканированием `/messages/`.
+"""
+import random
+
+from django.db.models import Q
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from chat.models import ChatMessage
+from chat.pagination import KeysetPagination
+from . import create_users, measure, percentiles, scenario, seed_messages
+
+
+def keyset_page(branches, params):
+    request = Request(APIRequestFactory().get('/messages/history/', params))
+    paginator = KeysetPagination()
+    paginator.paginate_queryset(branches, request)
+    return paginator
+
+
+@scenario('history')
+def run(options):
+    rows = options['rows']
+    repeat = options['repeat']
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', options.get('clients') or 200)
+    pairs = []
+    for client in clients:
+        pairs.append((manager.id, client.id))
+        pairs.append((client.id, manager.id))
+    seed_messages(pairs, rows)
+
+    def branches(counterpart=None):
+        messages = ChatMessage.objects.all()
+        if counterpart is None:
+            return [messages.filter(sender=manager),
+                    messages.filter(receiver=manager)]
+        return [messages.filter(sender=manager, receiver=counterpart),
+                messages.filter(sender=counterpart, receiver=manager)]
+
+    # Курсоры в глубине истории: берём случайные сообщения менеджера.
+    ids = list(ChatMessage.objects.filter(sender=manager)
+               .values_list('id', flat=True)[:10000])
+    cursors = []
+    for message in ChatMessage.objects.filter(
+            id__in=random.sample(ids, min(len(ids), 100))):
+        cursors.append(KeysetPagination().encode_cursor(message))
+
+    def first_page():
+        keyset_page(branches(), {})
+
+    def deep_page():
+        keyset_page(branches(), {'before': random.choice(cursors)})
+
+    def conversation_page():
+        client = random.choice(clients)
+        keyset_page(branches(client), {'before': random.choice(cursors)})
+
+    def or_scan():
+        list(ChatMessage.objects.filter(
+            Q(sender=manager) | Q(receiver=manager)
+        ).values_list('id', 'timestamp'))
+
+    baseline_repeat = max(3, repeat // 20)
+    return {
+        'rows': rows,
+        'keyset_first_page': percentiles(measure(first_page, repeat)),
+        'keyset_deep_page': percentiles(measure(deep_page, repeat)),
+        'keyset_conversation_page':
+            percentiles(measure(conversation_page, repeat)),
+        'or_scan_full_history':
+            percentiles(measure(or_scan, baseline_repeat)),
+    }
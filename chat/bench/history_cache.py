@@ -0,0 +1,105 @@
+"""
+Кэш последних сообщений (chat.history_cache) против чтения истории
+переписки из базы: первая страница и страница `before` внутри буфера,
+затем смешанная нагрузка – чтения вперемешку с новыми сообщениями – с
+долей попаданий.
+"""
+import random
+
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat import history_cache, services
+from chat.models import ChatMessage
+from chat.views import ChatMessageViewSet
+from . import count_queries, create_users, measure, percentiles, scenario
+
+BATCH = 5000
+WRITE_SHARE = 0.2
+
+
+def seed_conversations(manager, clients, per_pair):
+    """
+    Переписка менеджера с каждым клиентом с номерами сообщений, как у
+    отправки через WebSocket.
+    """
+    batch = []
+    for client in clients:
+        pair = (manager.id, client.id)
+        conversation_id, seq = services.allocate_seqs({pair: per_pair})[pair]
+        for i in range(per_pair):
+            sender, receiver = (manager, client) if i % 2 else \
+                (client, manager)
+            batch.append(ChatMessage(
+                sender=sender, receiver=receiver, content=f'message {i}',
+                conversation_id=conversation_id, seq=seq + i
+            ))
+            if len(batch) >= BATCH:
+                services.persist_messages(batch)
+                batch = []
+    if batch:
+        services.persist_messages(batch)
+
+
+@scenario('history_cache')
+def run(options):
+    repeat = options['repeat']
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', options.get('clients') or 100)
+    per_pair = max(1, options['rows'] // len(clients))
+    seed_conversations(manager, clients, per_pair)
+    size = history_cache.history_cache_config()['SIZE']
+
+    factory = APIRequestFactory()
+    history = ChatMessageViewSet.as_view({'get': 'history'})
+    cursors = {}
+
+    def page(client, before=False):
+        params = {'with_user': client.id, 'limit': 50}
+        if before:
+            params['before'] = cursors[client.id]
+        request = factory.get('/messages/history/', params)
+        force_authenticate(request, user=manager)
+        response = history(request)
+        response.render()
+        cursors.setdefault(client.id, response.data['before'])
+
+    def first_page():
+        page(random.choice(clients))
+
+    def inner_page():
+        page(random.choice(clients), before=True)
+
+    def mixed():
+        client = random.choice(clients)
+        if random.random() < WRITE_SHARE:
+            services.create_chat_message(manager, client.id, 'new',
+                                         manager.id, client.id)
+        page(client)
+
+    for client in clients:
+        page(client)
+
+    result = {'rows': per_pair * len(clients), 'pairs': len(clients),
+              'buffer_size': size}
+    with override_settings(CHAT_HISTORY_CACHE={'ENABLED': False}):
+        result['db_first_page'] = percentiles(measure(first_page, repeat))
+        result['db_first_page_queries'] = count_queries(first_page)
+        result['db_inner_page'] = percentiles(measure(inner_page, repeat))
+
+    history_cache.cache().clear()
+    for client in clients:
+        page(client)
+    result['cached_first_page'] = percentiles(measure(first_page, repeat))
+    result['cached_first_page_queries'] = count_queries(first_page)
+    result['cached_inner_page'] = percentiles(measure(inner_page, repeat))
+
+    counters = (history_cache.hits, history_cache.misses, history_cache.stale)
+    before = [counter.value for counter in counters]
+    result['mixed'] = percentiles(measure(mixed, repeat))
+    hits, misses, stale = [counter.value - start
+                           for counter, start in zip(counters, before)]
+    result['mixed_write_share'] = WRITE_SHARE
+    result['mixed_hit_ratio'] = round(hits / max(1, hits + misses), 3)
+    result['mixed_stale'] = stale
+    return result
@@ -0,0 +1,95 @@
+"""
+Нагрузка на путь сообщения WebSocket: N связей, M одновременных пар
+клиент–менеджер через chat_channels.asgi.application, in-memory channel
+layer и SQLite.
+
+Каждый клиент шлёт сообщения по замкнутому циклу: следующее – после того,
+как менеджер получил предыдущее. Замеряются подключение, задержка
+отправка→получение, сообщения в секунду и SQL-запросы на сообщение.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+
+from chat.models import ChatRelation
+from . import (
+    IN_MEMORY_LAYER, connect, create_users, percentiles, query_counter,
+    scenario,
+)
+
+
+async def pump(sender, receiver, count, samples):
+    for i in range(count):
+        started = time.perf_counter()
+        await sender.send_json_to({'message': f'load {i}'})
+        await receiver.receive_json_from(timeout=60)
+        samples.append(time.perf_counter() - started)
+        # Эхо в комнате отправителю.
+        await sender.receive_json_from(timeout=60)
+
+
+async def drive(pairs, per_client, counted):
+    """
+    Подключает пары и гоняет сообщения. Все communicator должны жить
+    в одном event loop, поэтому фазы разделяются снимками счётчика
+    запросов.
+    """
+    result = {'connect': [], 'latency': []}
+    sockets = []
+    for manager, client in pairs:
+        path = f'/ws/chat/{manager.id}/{client.id}/'
+        for user in (client, manager):
+            started = time.perf_counter()
+            sockets.append(await connect(user, path))
+            result['connect'].append(time.perf_counter() - started)
+    result['connect_queries'] = counted['queries']
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        pump(sockets[i], sockets[i + 1], per_client, result['latency'])
+        for i in range(0, len(sockets), 2)
+    ))
+    result['elapsed'] = time.perf_counter() - started
+    result['send_queries'] = counted['queries'] - result['connect_queries']
+
+    for communicator in sockets:
+        await communicator.disconnect()
+    return result
+
+
+@scenario('load')
+def run(options):
+    clients = options.get('clients') or 50
+    relations = max(options['relations'], clients)
+    managers = create_users('bench_manager', max(1, relations // 20),
+                            is_staff=True)
+    users = create_users('bench_client', relations)
+    pairs = [(managers[i % len(managers)], user)
+             for i, user in enumerate(users)]
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=m, client=c) for m, c in pairs]
+    )
+    active = pairs[:clients]
+    per_client = max(1, options['messages'] // clients)
+
+    # Замкнутый цикл шлёт быстрее любого разумного лимита частоты.
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER,
+                           CHAT_RATE_LIMIT={'ENABLED': False}):
+        with query_counter() as counted:
+            result = async_to_sync(drive)(active, per_client, counted)
+
+    total = per_client * clients
+    return {
+        'relations': relations,
+        'clients': clients,
+        'messages': total,
+        'connect': percentiles(result['connect']),
+        'latency': percentiles(result['latency']),
+        'messages_per_sec': round(total / result['elapsed'], 1),
+        'queries_per_connect': round(
+            result['connect_queries'] / len(result['connect']), 2
+        ),
+        'queries_per_message': round(result['send_queries'] / total, 2),
+    }
@@ -0,0 +1,108 @@
+"""
+Channel layer на одном узле: LocalChannelLayer против InMemoryChannelLayer
+и (с `--redis`) channels_redis на одной и той же рассылке.
+
+В `--relations` комнатах по менеджеру и клиенту, у клиента ещё одно
+устройство вне комнаты. Каждое сообщение, как в ChatConsumer, уходит
+через fan_out в комнату и в группу уведомлений клиента – три доставки.
+`--clients` отправителей шлют `--messages` сообщений, у каждого канала
+свой читатель. Считаются доставки в секунду, задержка отправка→получение
+и процессорное время на сообщение.
+"""
+import asyncio
+import random
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+
+from chat.fanout import fan_out
+from chat.local_layer import LocalChannelLayer
+from . import percentiles, scenario
+
+CAPACITY = 10_000
+
+
+def make_layers(hosts):
+    layers = {
+        'local': LocalChannelLayer(capacity=CAPACITY),
+        'in_memory': InMemoryChannelLayer(capacity=CAPACITY),
+    }
+    if hosts:
+        from channels_redis.core import RedisChannelLayer
+        layers['channels_redis'] = RedisChannelLayer(hosts=hosts,
+                                                     capacity=CAPACITY)
+    return layers
+
+
+async def drive(layer, rooms, senders, messages):
+    targets = []
+    readers = []
+    for i in range(rooms):
+        room, notifications = f'chat_{i}', f'user_{i}_notifications'
+        manager, client, device = [await layer.new_channel()
+                                   for _ in range(3)]
+        await layer.group_add(room, manager)
+        await layer.group_add(room, client)
+        await layer.group_add(notifications, client)
+        await layer.group_add(notifications, device)
+        targets.append((room, notifications))
+        readers += [manager, client, device]
+
+    expected = messages * 3
+    latencies = []
+    done = asyncio.Event()
+
+    async def reader(channel):
+        while True:
+            message = await layer.receive(channel)
+            latencies.append(time.perf_counter() - message['sent'])
+            if len(latencies) >= expected:
+                done.set()
+
+    remaining = [messages]
+
+    async def sender():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            room, notifications = random.choice(targets)
+            sent = time.perf_counter()
+            await fan_out(layer, [
+                (room, {'type': 'chat_message', 'text': 'bench',
+                        'sent': sent}),
+                (notifications, {'type': 'new_message_notify',
+                                 'text': 'bench', 'sent': sent}),
+            ])
+            # Как консьюмер между кадрами: даём поработать читателям.
+            await asyncio.sleep(0)
+
+    tasks = [asyncio.create_task(reader(channel)) for channel in readers]
+    started, cpu_started = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(sender() for _ in range(senders)))
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await layer.flush()
+    return {
+        'deliveries': len(latencies),
+        'deliveries_per_second': round(len(latencies) / elapsed),
+        'cpu_us_per_message': round(cpu / messages * 1_000_000, 1),
+        'latency': percentiles(latencies),
+    }
+
+
+@scenario('local_layer')
+def run(options):
+    random.seed(0)
+    rooms = options['relations']
+    senders = options.get('clients') or 50
+    messages = options['messages']
+    result = {'rooms': rooms, 'senders': senders, 'messages': messages}
+    for name, layer in make_layers(options['redis']).items():
+        result[name] = async_to_sync(drive)(layer, rooms, senders, messages)
+    if not options['redis']:
+        result['channels_redis'] = None
+    return result
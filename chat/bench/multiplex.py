@@ -0,0 +1,71 @@
+"""
+Менеджер с N клиентами: соединения, членства в группах и доставки одного
+сообщения при сокете на комнату и при одном мультиплексированном сокете.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.test import override_settings
+
+from chat.models import ChatRelation
+from . import IN_MEMORY_LAYER, connect, create_users, scenario
+
+
+def memberships():
+    layer = get_channel_layer()
+    return sum(len(channels) for channels in layer.groups.values())
+
+
+async def count_frames(communicators):
+    frames = 0
+    for communicator in communicators:
+        while not await communicator.receive_nothing(timeout=0.05):
+            await communicator.receive_output()
+            frames += 1
+    return frames
+
+
+async def per_room(manager, clients):
+    sockets = [await connect(manager, f'/ws/chat/{manager.id}/{c.id}/')
+               for c in clients]
+    sender = await connect(clients[0],
+                           f'/ws/chat/{manager.id}/{clients[0].id}/')
+    groups = memberships()
+    await sender.send_json_to({'message': 'ping'})
+    frames = await count_frames(sockets)
+    for communicator in sockets + [sender]:
+        await communicator.disconnect()
+    return {'manager_sockets': len(sockets), 'group_memberships': groups,
+            'frames_per_message': frames}
+
+
+async def multiplexed(manager, clients):
+    socket = await connect(manager, '/ws/chat/')
+    for client in clients:
+        await socket.send_json_to({'action': 'subscribe',
+                                   'conversation': f'{manager.id}_{client.id}'})
+        await socket.receive_json_from()
+    sender = await connect(clients[0],
+                           f'/ws/chat/{manager.id}/{clients[0].id}/')
+    groups = memberships()
+    await sender.send_json_to({'message': 'ping'})
+    frames = await count_frames([socket])
+    await socket.disconnect()
+    await sender.disconnect()
+    return {'manager_sockets': 1, 'group_memberships': groups,
+            'frames_per_message': frames}
+
+
+@scenario('multiplex')
+def run(options):
+    count = options.get('clients') or 200
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', count)
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=manager, client=c) for c in clients]
+    )
+    result = {'clients': count}
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER):
+        result['per_room'] = async_to_sync(per_room)(manager, clients)
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER):
+        result['multiplexed'] = async_to_sync(multiplexed)(manager, clients)
+    return result
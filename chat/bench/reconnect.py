@@ -0,0 +1,58 @@
+"""
+Шторм переподключений: задержка подключения и доля попаданий в кэш
+доступа с кэшем и без него.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+
+from chat.models import ChatRelation
+from chat.relation_cache import hits, misses, relation_cache
+from . import IN_MEMORY_LAYER, connect, create_users, percentiles, scenario
+
+
+async def storm(pairs, rounds):
+    samples = []
+
+    async def reconnect(manager, client):
+        path = f'/ws/chat/{manager.id}/{client.id}/'
+        for _ in range(rounds):
+            started = time.perf_counter()
+            communicator = await connect(client, path)
+            samples.append(time.perf_counter() - started)
+            await communicator.disconnect()
+
+    await asyncio.gather(*(reconnect(*pair) for pair in pairs))
+    return samples
+
+
+def run_mode(pairs, rounds, enabled):
+    relation_cache.clear()
+    hits.reset()
+    misses.reset()
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER,
+                           CHAT_RELATION_CACHE={'ENABLED': enabled}):
+        samples = async_to_sync(storm)(pairs, rounds)
+    return {
+        'connect': percentiles(samples),
+        'cache_hit_rate': round(relation_cache.hit_rate(), 4),
+    }
+
+
+@scenario('reconnect')
+def run(options):
+    count = options.get('clients') or 100
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', count)
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=manager, client=c) for c in clients]
+    )
+    pairs = [(manager, client) for client in clients]
+    rounds = max(1, options['repeat'] // 20)
+    return {
+        'connections': count * rounds,
+        'without_cache': run_mode(pairs, rounds, enabled=False),
+        'with_cache': run_mode(pairs, rounds, enabled=True),
+    }
@@ -0,0 +1,116 @@
+"""
+Клиентская книга менеджера на `--clients` клиентов (по умолчанию 20 000):
+проверка доступа, обход списка связей страницами, импорт и передача
+клиентов другому менеджеру.
+
+Импорт и передача через services.import_relations/reassign_relations
+сравниваются с тем же по одной связи (create и save, как в POST и PATCH
+/relations/). Для проверки доступа выводится план запроса.
+"""
+import time
+
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat import services
+from chat.models import ChatRelation
+from chat.views import ChatRelationViewSet
+from . import (
+    count_queries, create_users, measure, percentiles, query_counter,
+    scenario,
+)
+
+PAGE = 1000
+
+
+def timed(func):
+    with query_counter() as counted:
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+    return {'seconds': round(elapsed, 3), 'queries': counted['queries'],
+            'result': result}
+
+
+def walk(manager, ordering):
+    """
+    Обходит все страницы списка связей; возвращает длительности страниц,
+    число строк и запросов.
+    """
+    factory = APIRequestFactory()
+    view = ChatRelationViewSet.as_view({'get': 'list'})
+    samples, rows, cursor = [], 0, None
+    with query_counter() as counted:
+        while True:
+            params = {'ordering': ordering, 'limit': PAGE}
+            if cursor:
+                params['cursor'] = cursor
+            request = factory.get('/relations/', params)
+            force_authenticate(request, user=manager)
+            started = time.perf_counter()
+            response = view(request)
+            response.render()
+            samples.append(time.perf_counter() - started)
+            rows += len(response.data['results'])
+            cursor = response.data['cursor']
+            if cursor is None:
+                break
+    return {'rows': rows, 'pages': len(samples),
+            'queries_per_page': round(counted['queries'] / len(samples), 1),
+            'page': percentiles(samples)}
+
+
+def one_by_one_import(manager, clients):
+    with transaction.atomic():
+        for client in clients:
+            if not ChatRelation.objects.filter(manager=manager,
+                                               client=client).exists():
+                ChatRelation.objects.create(manager=manager, client=client)
+    return len(clients)
+
+
+def one_by_one_reassign(source, target):
+    with transaction.atomic():
+        for relation in list(ChatRelation.objects.filter(manager=source)):
+            relation.manager = target
+            relation.save()
+
+
+@scenario('relations')
+def run(options):
+    count = options.get('clients') or 20_000
+    managers = create_users('bench_manager', 4, is_staff=True)
+    clients = create_users('bench_client', count)
+    result = {'clients': count}
+
+    result['import'] = timed(lambda: services.import_relations(
+        [(managers[0].id, client.id) for client in clients]
+    ))
+    result['import_one_by_one'] = timed(
+        lambda: one_by_one_import(managers[1], clients)
+    )
+
+    client = clients[count // 2]
+    check = ChatRelation.objects.filter(manager_id=managers[0].id,
+                                        client_id=client.id)
+    result['access_check'] = {
+        'plan': check.explain(),
+        'queries': count_queries(check.exists),
+        **percentiles(measure(check.exists, options['repeat'])),
+    }
+
+    result['list'] = {ordering: walk(managers[0], ordering)
+                      for ordering in ('id', 'client_name', '-client')}
+
+    result['reassign'] = timed(lambda: services.reassign_relations(
+        managers[0].id, managers[2].id
+    ))
+    result['reassign_one_by_one'] = timed(
+        lambda: one_by_one_reassign(managers[1], managers[3])
+    )
+    for name in ('import', 'reassign'):
+        result[f'{name}_speedup'] = round(
+            result[f'{name}_one_by_one']['seconds'] /
+            result[name]['seconds'], 1
+        )
+    return result
@@ -0,0 +1,100 @@
+"""
+Поиск по истории: FTS5 и инвертированный индекс MessageTerm против
+`content__icontains` по сообщениям пользователя.
+
+Тексты собираются из словаря с распределением Ципфа, поэтому в запросах
+есть и частые слова (совпадает большая часть истории), и редкие.
+"""
+import random
+import time
+
+from django.db.models import Q
+from django.test import override_settings
+
+from chat import search
+from chat.models import ChatMessage
+from . import create_users, measure, percentiles, scenario, seed_messages
+
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = 8
+PAGE = 21
+# Инвертированный индекс строится на Python, на больших корпусах это
+# десятки минут; он нужен только для баз без FTS5.
+INDEX_MAX_ROWS = 500_000
+
+
+def word(rank):
+    return f'слово{rank}'
+
+
+def zipf_text(rng, i):
+    return ' '.join(
+        word(min(VOCABULARY, int(rng.paretovariate(1.0))))
+        for _ in range(WORDS_PER_MESSAGE)
+    )
+
+
+def measure_queries(queries, user, repeat):
+    result = {}
+    for name, query in queries.items():
+        finder = search.MessageSearch(query, user, fields=('content',))
+        result[name] = percentiles(
+            measure(lambda: finder.fetch(None, PAGE), repeat)
+        )
+    return result
+
+
+@scenario('search')
+def run(options):
+    rows = options['rows']
+    repeat = options['repeat']
+    manager = create_users('bench_manager', 1, is_staff=True)[0]
+    clients = create_users('bench_client', options.get('clients') or 200)
+    pairs = []
+    for client in clients:
+        pairs.append((manager.id, client.id))
+        pairs.append((client.id, manager.id))
+    rng = random.Random(42)
+    # Вставка сразу проходит через триггеры FTS5.
+    started = time.perf_counter()
+    seed_messages(pairs, rows, content=lambda i: zipf_text(rng, i))
+    seeded = time.perf_counter() - started
+
+    queries = {
+        'frequent_word': word(1),
+        'rare_word': word(5000),
+        'two_words': f'{word(2)} {word(50)}',
+    }
+    client = clients[0]
+
+    def icontains(user, query):
+        return lambda: list(ChatMessage.objects.filter(
+            Q(sender=user) | Q(receiver=user), content__icontains=query
+        ).order_by('-timestamp', '-id').values('id', 'content')[:PAGE])
+
+    baseline_repeat = max(3, repeat // 20)
+    result = {
+        'rows': rows,
+        'seed_with_fts_triggers_seconds': round(seeded, 1),
+        'icontains_manager': {
+            name: percentiles(measure(icontains(manager, query),
+                                      baseline_repeat))
+            for name, query in queries.items()
+        },
+        'icontains_client_rare_word': percentiles(
+            measure(icontains(client, queries['rare_word']), baseline_repeat)
+        ),
+        'fts5_manager': measure_queries(queries, manager, repeat),
+        'fts5_client': measure_queries(queries, client, repeat),
+    }
+    if rows > INDEX_MAX_ROWS:
+        result['index'] = f'пропущен: больше {INDEX_MAX_ROWS} сообщений'
+        return result
+    with override_settings(CHAT_SEARCH={'BACKEND': 'index'}):
+        started = time.perf_counter()
+        search.rebuild_index()
+        result['index_build_seconds'] = round(time.perf_counter() - started,
+                                              1)
+        result['index_manager'] = measure_queries(queries, manager, repeat)
+        result['index_client'] = measure_queries(queries, client, repeat)
+    return result
@@ -0,0 +1,197 @@
+"""
+Шардирование channel layer (chat.sharding).
+
+- `rebalance` – доля групп, меняющих узел при добавлении узла, и перекос
+  нагрузки (группы самого загруженного узла к среднему): HashRing против
+  деления crc32 на диапазоны в channels_redis.
+- `throughput` – group_send в `--relations` комнат из `--clients`
+  параллельных отправителей при 1, 2, 4… узлах. С `--redis` (несколько
+  раз) – настоящие redis-server, иначе stand-in: узел выполняет команды
+  по одной с фиксированным временем обслуживания, как однопоточный Redis,
+  а рассылка стоит команду на узле группы и по команде на каждом узле
+  каналов-получателей. Каналы принадлежат нескольким «процессам», как
+  в развёртывании с несколькими воркерами.
+"""
+import asyncio
+import collections
+import random
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels_redis.utils import _consistent_hash
+
+from chat.sharding import HashRing, ShardedRedisChannelLayer
+from . import scenario
+
+GROUPS = 100_000
+PROCESSES = 64
+SERVICE_TIME = 0.005
+
+
+def rebalance(max_shards):
+    groups = [f'chat_{i}_{i + 1}' for i in range(GROUPS)]
+    result = []
+    for shards in range(1, max_shards):
+        before = HashRing([f'node-{i}' for i in range(shards)])
+        after = HashRing([f'node-{i}' for i in range(shards + 1)])
+        load = collections.Counter(after.index(group) for group in groups)
+        result.append({
+            'shards': f'{shards}->{shards + 1}',
+            'ideal_moved': round(1 / (shards + 1), 3),
+            'hash_ring_moved': round(sum(
+                before.index(group) != after.index(group) for group in groups
+            ) / GROUPS, 3),
+            'crc32_ranges_moved': round(sum(
+                _consistent_hash(group, shards) !=
+                _consistent_hash(group, shards + 1) for group in groups
+            ) / GROUPS, 3),
+            'hash_ring_max_to_mean': round(
+                max(load.values()) / (GROUPS / (shards + 1)), 3
+            ),
+        })
+    return result
+
+
+class StandInNode:
+    """
+    Узел-заглушка: команды выполняются по одной, каждая SERVICE_TIME.
+    """
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.commands = 0
+
+    async def execute(self):
+        async with self.lock:
+            self.commands += 1
+            await asyncio.sleep(SERVICE_TIME)
+
+
+class StandInLayer:
+    """
+    Группы и каналы на узлах-заглушках с маршрутизацией
+    ShardedRedisChannelLayer.
+    """
+    def __init__(self, shards):
+        self.ring = HashRing([f'stand-in-{i}' for i in range(shards)])
+        self.nodes = [StandInNode() for _ in range(shards)]
+        self.groups = collections.defaultdict(set)
+        self.delivered = 0
+
+    def shard(self, name):
+        if '!' in name:
+            name = name[:name.find('!') + 1]
+        return self.ring.index(name)
+
+    async def new_channel(self, process):
+        return f'specific.process{process}!{uuid.uuid4().hex}'
+
+    async def group_add(self, group, channel):
+        await self.nodes[self.shard(group)].execute()
+        self.groups[group].add(channel)
+
+    async def group_send(self, group, message):
+        await self.nodes[self.shard(group)].execute()
+        members = self.groups[group]
+        for index in {self.shard(channel) for channel in members}:
+            await self.nodes[index].execute()
+        self.delivered += len(members)
+
+    def commands(self):
+        return [node.commands for node in self.nodes]
+
+
+class RedisLayers:
+    """
+    Несколько экземпляров ShardedRedisChannelLayer на первых `shards`
+    адресах – по одному на «процесс».
+    """
+    def __init__(self, hosts, shards):
+        self.layers = [
+            ShardedRedisChannelLayer(hosts=hosts[:shards], capacity=100_000)
+            for _ in range(PROCESSES)
+        ]
+        self.delivered = 0
+
+    async def new_channel(self, process):
+        return await self.layers[process].new_channel()
+
+    async def group_add(self, group, channel):
+        await self.layers[0].group_add(group, channel)
+
+    async def group_send(self, group, message):
+        await random.choice(self.layers).group_send(group, message)
+        self.delivered += 2
+
+    def commands(self):
+        return None
+
+    async def close(self):
+        await self.layers[0].flush()
+        for layer in self.layers:
+            await layer.close_pools()
+
+
+async def drive(layer, rooms, senders, messages):
+    groups = [f'chat_{i}_{i + 1}' for i in range(rooms)]
+    for group in groups:
+        for _ in range(2):
+            channel = await layer.new_channel(random.randrange(PROCESSES))
+            await layer.group_add(group, channel)
+
+    remaining = [messages]
+
+    async def sender():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await layer.group_send(random.choice(groups),
+                                   {'type': 'chat_message', 'text': 'bench'})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(senders)))
+    return time.perf_counter() - started
+
+
+@scenario('sharding')
+def run(options):
+    random.seed(0)
+    hosts = options['redis']
+    rooms = options['relations']
+    senders = options.get('clients') or 64
+    messages = options['messages']
+    shard_counts = range(1, len(hosts) + 1) if hosts else (1, 2, 4, 8)
+
+    throughput = []
+    for shards in shard_counts:
+        if hosts:
+            layer = RedisLayers(hosts, shards)
+        else:
+            layer = StandInLayer(shards)
+        elapsed = async_to_sync(drive)(layer, rooms, senders, messages)
+        if hosts:
+            async_to_sync(layer.close)()
+        commands = layer.commands()
+        throughput.append({
+            'shards': shards,
+            'group_sends_per_second': round(messages / elapsed),
+            'deliveries': layer.delivered,
+            'commands_per_node': commands,
+            # С одним узлом оба получателя комнаты на узле группы; с
+            # несколькими рассылка стоит до трёх команд вместо двух.
+            'commands_per_second':
+                round(sum(commands) / elapsed) if commands else None,
+        })
+    base = throughput[0]['group_sends_per_second']
+    for row in throughput:
+        row['speedup'] = round(row['group_sends_per_second'] / base, 2)
+        row['efficiency'] = round(row['speedup'] / row['shards'], 2)
+
+    return {
+        'backend': 'redis' if hosts else 'stand-in',
+        'service_time_ms': None if hosts else SERVICE_TIME * 1000,
+        'rooms': rooms,
+        'senders': senders,
+        'messages': messages,
+        'rebalance': rebalance(8),
+        'throughput': throughput,
+    }
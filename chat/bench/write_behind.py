@@ -0,0 +1,69 @@
+"""
+Сообщений в секунду на один процесс: синхронная запись против write-behind.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+
+from chat.models import ChatMessage, ChatRelation
+from chat.persistence import get_writer
+from . import IN_MEMORY_LAYER, connect, create_users, scenario
+
+
+async def drive(pairs, per_pair):
+    connections = []
+    for manager, client in pairs:
+        path = f'/ws/chat/{manager.id}/{client.id}/'
+        connections.append((await connect(manager, path),
+                            await connect(client, path)))
+
+    async def pump(receiver, sender):
+        for i in range(per_pair):
+            await sender.send_json_to({'message': f'bench {i}'})
+        # Получатель в комнате видит сообщение один раз, без уведомления.
+        for _ in range(per_pair):
+            await receiver.receive_json_from(timeout=30)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(pump(*pair) for pair in connections))
+    delivered = time.perf_counter() - started
+    await get_writer().drain()
+    persisted = time.perf_counter() - started
+    for manager_comm, client_comm in connections:
+        await manager_comm.disconnect()
+        await client_comm.disconnect()
+    return delivered, persisted
+
+
+def run_mode(pairs, per_pair, enabled):
+    ChatMessage.objects.all().delete()
+    # Сценарий намеренно шлёт сообщения быстрее лимита частоты.
+    with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER,
+                           CHAT_WRITE_BEHIND={'ENABLED': enabled},
+                           CHAT_RATE_LIMIT={'ENABLED': False}):
+        delivered, persisted = async_to_sync(drive)(pairs, per_pair)
+    total = per_pair * len(pairs)
+    return {
+        'messages': total,
+        'stored': ChatMessage.objects.count(),
+        'delivered_per_sec': round(total / delivered, 1),
+        'persisted_per_sec': round(total / persisted, 1),
+    }
+
+
+@scenario('write_behind')
+def run(options):
+    count = options.get('clients') or 10
+    managers = create_users('bench_manager', count, is_staff=True)
+    clients = create_users('bench_client', count)
+    pairs = list(zip(managers, clients))
+    ChatRelation.objects.bulk_create(
+        [ChatRelation(manager=m, client=c) for m, c in pairs]
+    )
+    per_pair = max(1, options['messages'] // count)
+    return {
+        'sync': run_mode(pairs, per_pair, enabled=False),
+        'write_behind': run_mode(pairs, per_pair, enabled=True),
+    }
@@ -0,0 +1,111 @@
+"""
+Рассылка менеджера многим клиентам: POST /messages/broadcast/ и действие
+`broadcast` в UserChatConsumer.
+
+Вместо N отправок с отдельным INSERT и двумя group_send на каждую
+рассылка проверяет связи одним запросом и пишет все сообщения одним
+bulk_create (services.broadcast_messages). Затем кадры уходят пачками по
+FANOUT_BATCH диалогов через fan_out_many: на пачку одно чтение состава
+групп и одна отправка. Каждый получатель видит обычное сообщение своего
+диалога – в комнате и в группе уведомлений, как от ChatConsumer.
+"""
+from . import codec
+from .conf import chat_setting
+from .db import db_sync_to_async
+from .fanout import fan_out_many
+from .metrics import counter, histogram
+from .services import broadcast_messages
+
+recipients = counter('chat_broadcast_recipients_total',
+                     'Получатели рассылок менеджеров.')
+broadcast_seconds = histogram('chat_broadcast_seconds',
+                              'Запись и рассылка сообщения всем получателям.')
+
+
+def broadcast_config():
+    return chat_setting('CHAT_BROADCAST')
+
+
+def parse_message(value):
+    """
+    Текст рассылки из запроса. Бросает ValueError с текстом ошибки для
+    клиента, если это не непустая строка.
+    """
+    if not value or not isinstance(value, str):
+        raise ValueError('Сообщение не может быть пустым.')
+    return value
+
+
+def parse_clients(value):
+    """
+    Получатели из запроса: список id или "all" (None – все связи
+    менеджера). Бросает ValueError с текстом ошибки для клиента.
+    """
+    if value == 'all':
+        return None
+    if not isinstance(value, list) or not value:
+        raise ValueError('clients должен быть непустым списком id или "all".')
+    try:
+        client_ids = sorted({int(client_id) for client_id in value})
+    except (TypeError, ValueError):
+        raise ValueError('clients должен содержать только числа.')
+    if len(client_ids) > broadcast_config()['MAX_RECIPIENTS']:
+        raise ValueError('Слишком много получателей.')
+    return client_ids
+
+
+def broadcast_events(manager_id, messages):
+    """
+    Для каждого сообщения – рассылка fan_out в комнату диалога и в группу
+    уведомлений клиента. Кадры кодируются один раз на сообщение.
+    """
+    # Имена групп и формат кадра задаёт модуль консьюмеров, который сам
+    # импортирует этот.
+    from .consumers import (
+        conversation_id, message_frame, notifications_group_name,
+        room_group_name
+    )
+
+    events = []
+    for message in messages:
+        client_id = message.receiver_id
+        conversation = conversation_id(manager_id, client_id)
+        frame = message_frame(conversation, manager_id, message.content,
+                              message.uid, message.timestamp, message.seq)
+        events.append([
+            (room_group_name(manager_id, client_id), {
+                'type': 'chat_message',
+                'conversation': conversation,
+                'text': codec.dumps(frame),
+            }),
+            (notifications_group_name(client_id), {
+                'type': 'new_message_notify',
+                'conversation': conversation,
+                'text': codec.dumps({'notification': True, **frame}),
+            }),
+        ])
+    return events
+
+
+async def announce(layer, manager_id, messages):
+    """
+    Рассылает сохранённые сообщения рассылки пачками по FANOUT_BATCH.
+    """
+    events = broadcast_events(manager_id, messages)
+    size = broadcast_config()['FANOUT_BATCH']
+    for start in range(0, len(events), size):
+        await fan_out_many(layer, events[start:start + size])
+
+
+async def broadcast(layer, manager, content, client_ids=None):
+    """
+    Сохраняет и рассылает сообщение менеджера. Возвращает
+    {"sent": число получателей, "rejected": [id без связи]}.
+    """
+    with broadcast_seconds.time():
+        messages, rejected = await db_sync_to_async(
+            broadcast_messages, write=True
+        )(manager, content, client_ids)
+        await announce(layer, manager.id, messages)
+    recipients.inc(len(messages))
+    return {'sent': len(messages), 'rejected': rejected}
@@ -0,0 +1,29 @@
+"""
+Кодирование кадров WebSocket в JSON.
+
+Если установлен orjson, используется он, иначе стандартный json с теми же
+параметрами: компактные разделители и UTF-8 без экранирования. Оба варианта
+возвращают str, пригодную для `send(text_data=...)`.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(value):
+        return orjson.dumps(value).decode()
+
+    # orjson.JSONDecodeError наследует json.JSONDecodeError.
+    loads = orjson.loads
+else:  # pragma: no cover
+    BACKEND = 'json'
+
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    loads = json.loads
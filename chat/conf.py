@@ -0,0 +1,102 @@
+from django.conf import settings
+
+DEFAULTS = {
+    # Отложенная (write-behind) запись сообщений, пришедших по WebSocket.
+    'CHAT_WRITE_BEHIND': {
+        'ENABLED': False,
+        'BATCH_SIZE': 200,
+        'FLUSH_INTERVAL_MS': 50,
+        'MAX_QUEUE': 10_000,
+        'PUT_TIMEOUT': 1.0,
+    },
+    # Кэш проверки доступа к чату в ChatConsumer.user_can_join.
+    'CHAT_RELATION_CACHE': {
+        'ENABLED': True,
+        'MAX_SIZE': 10_000,
+        'TTL': 60,
+        # Кэш Django с версиями связей для инвалидации в других процессах,
+        # None – только в своём процессе.
+        'CACHE': 'default',
+    },
+    # Догрузка пропущенных сообщений после переподключения (resume_from).
+    'CHAT_RESUME': {
+        'BATCH_SIZE': 100,
+        'MAX_MESSAGES': 5000,
+    },
+    # Ограничение частоты входящих кадров WebSocket (chat.ratelimit).
+    'CHAT_RATE_LIMIT': {
+        'ENABLED': True,
+        'CONNECTION_RATE': 5,
+        'CONNECTION_BURST': 20,
+        'USER_RATE': 10,
+        'USER_BURST': 40,
+        'SHARED': False,
+    },
+    # Полнотекстовый поиск: 'auto' (FTS5, если есть), 'fts5' или 'index'.
+    'CHAT_SEARCH': {
+        'BACKEND': 'auto',
+        'MAX_CANDIDATES': 10_000,
+    },
+    # Архив сообщений старше AFTER_DAYS дней (chat.archive).
+    'CHAT_ARCHIVE': {
+        'DIR': 'archive',
+        'AFTER_DAYS': 365,
+        'BATCH_SIZE': 5000,
+    },
+    # Эндпоинт /metrics в формате Prometheus. Без ALLOWED_IPS – только
+    # для сотрудников: за прокси на том же хосте REMOTE_ADDR у всех
+    # запросов локальный.
+    'CHAT_METRICS': {
+        'ENABLED': True,
+        'ALLOWED_IPS': (),
+    },
+    # Буфер отметок доставки и прочтения (chat.receipts).
+    'CHAT_RECEIPTS': {
+        'BATCH_SIZE': 500,
+        'FLUSH_INTERVAL_MS': 200,
+    },
+    # Присутствие в диалогах и индикатор набора текста (chat.presence).
+    'CHAT_PRESENCE': {
+        'ENABLED': True,
+        'STORE': 'auto',
+        'TTL': 30,
+        'HEARTBEAT_INTERVAL': 10,
+        'TYPING_INTERVAL': 2.0,
+    },
+    # Пул потоков для обращений консьюмеров к БД (chat.db).
+    'CHAT_DB_EXECUTOR': {
+        'MAX_WORKERS': 16,
+        'PARALLEL_WRITES': 'auto',
+    },
+    # Массовый импорт и передача связей (/relations/import/, reassign/).
+    'CHAT_RELATIONS': {
+        'MAX_BULK': 50_000,
+    },
+    # Рассылки менеджеров многим клиентам (chat.broadcast).
+    'CHAT_BROADCAST': {
+        'MAX_RECIPIENTS': 50_000,
+        'FANOUT_BATCH': 500,
+    },
+    # Пачки исходящих событий и кодировка кадров соединения (chat.framing).
+    'CHAT_FRAMING': {
+        'ALLOW_BATCH': True,
+        'BATCH_MAX_EVENTS': 50,
+        'BATCH_MAX_DELAY_MS': 5,
+    },
+    # Кэш последних сообщений переписки (chat.history_cache).
+    'CHAT_HISTORY_CACHE': {
+        'ENABLED': True,
+        'SIZE': 200,
+        'TTL': 600,
+        'CACHE': 'default',
+    },
+}
+
+
+def chat_setting(name):
+    """
+    Возвращает настройку приложения: значения из settings поверх DEFAULTS.
+    """
+    value = dict(DEFAULTS[name])
+    value.update(getattr(settings, name, None) or {})
+    return value
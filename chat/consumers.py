@@ -1,132 +1,792 @@
-import json
+import logging
+import time
+from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
+from . import codec, services
+from .broadcast import broadcast, parse_clients, parse_message
+from .conf import chat_setting
+from .db import db_sync_to_async
+from .fanout import fan_out
+from .framing import Framing, negotiate
+from .lifecycle import tracker
 from .models import ChatRelation, ChatMessage
+from .metrics import counter, histogram
+from .persistence import (
+    WriteBehindOverflow, get_allocator, get_writer, write_behind_enabled
+)
+from .presence import (
+    TypingThrottle, get_presence_store, presence_config, typing_events,
+    typing_frames
+)
+from .ratelimit import TokenBucket, check_frame, limited, rate_limit_config
+from .receipts import KINDS as RECEIPT_KINDS, get_receipt_buffer
+from .relation_cache import relation_cache, relation_cache_enabled
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+connect_seconds = histogram('chat_ws_connect_seconds',
+                            'Длительность подключения к ChatConsumer.')
+receive_seconds = histogram('chat_ws_receive_seconds',
+                            'Обработка входящего кадра WebSocket целиком.')
+auth_seconds = histogram('chat_ws_auth_seconds',
+                         'Проверка доступа к диалогу (user_can_join).')
+db_write_seconds = histogram(
+    'chat_db_write_seconds',
+    'Сохранение сообщения: запись в БД или постановка в очередь write-behind.'
+)
+group_send_seconds = histogram('chat_group_send_seconds',
+                               'Рассылка сообщения в группы channel layer.')
+serialize_seconds = histogram('chat_ws_serialize_seconds',
+                              'Кодирование исходящих кадров сообщений.')
+frames_in = counter('chat_ws_frames_in_total', 'Входящие кадры WebSocket.')
+frames_out = counter('chat_ws_frames_out_total', 'Исходящие кадры WebSocket.')
+
+
+def conversation_id(manager_id, client_id):
     """
-    WebSocket-консьюмер для чата между клиентом и менеджером.
+    Идентификатор диалога в кадрах WebSocket: "<manager_id>_<client_id>".
     """
-    async def connect(self):
+    return f"{int(manager_id)}_{int(client_id)}"
+
+
+def parse_conversation_id(value):
+    """
+    Разбирает "<manager_id>_<client_id>" в пару чисел или возвращает None.
+    """
+    try:
+        manager_id, client_id = str(value).split('_')
+        return int(manager_id), int(client_id)
+    except ValueError:
+        return None
+
+
+def parse_seq(value):
+    """
+    Разбирает порядковый номер сообщения (resume_from) или возвращает None.
+    """
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+
+def message_frame(conversation, sender_id, message, uid, timestamp, seq):
+    """
+    Кадр сообщения чата, одинаковый для рассылки и догрузки.
+    """
+    return {
+        'conversation': conversation,
+        'seq': seq,
+        'sender_id': sender_id,
+        'message': message,
+        'uid': str(uid),
+        'timestamp': timestamp.isoformat(),
+    }
+
+
+def room_group_name(manager_id, client_id):
+    return f"chat_{conversation_id(manager_id, client_id)}"
+
+
+def notifications_group_name(user_id):
+    return f"user_{user_id}_notifications"
+
+
+class ChatMessagingMixin:
+    """
+    Общая логика консьюмеров чата: проверка доступа, членство в группах,
+    сохранение сообщения и рассылка в комнату и в группу уведомлений
+    получателя.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Диалоги, где соединение отмечено присутствующим, и диалоги, чьи
+        # события присутствия оно запросило.
+        self.present = set()
+        self.presence_watched = set()
+        self.presence_touched = 0.0
+        # Упаковка исходящих кадров (chat.framing); None – кадр на событие
+        # в JSON, как без согласования.
+        self.framing = None
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.framing is not None:
+                self.framing.close()
+            # Экземпляр могли отменить, не вызвав disconnect: группы всё
+            # равно нужно покинуть.
+            if getattr(self, 'channel_name', None) in tracker.connections:
+                await self.leave_all_groups()
+
+    async def dispatch(self, message):
         """
-        Метод, вызываемый при подключении пользователя к WebSocket.
+        Как AsyncConsumer.dispatch, но без aclose_old_connections перед
+        каждым событием: это переход в общий поток sync_to_async на каждый
+        входящий кадр и каждое сообщение группы. Обращения консьюмера к БД
+        сами закрывают старые соединения своего потока (chat.db).
         """
-        self.manager_id = self.scope['url_route']['kwargs']['manager_id']
-        self.client_id = self.scope['url_route']['kwargs']['client_id']
-        self.room_group_name = f"chat_{self.manager_id}_{self.client_id}"
-        self.user_notifications_group_name = f"user_{self.scope['user'].id}_notifications"
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError(
+                f"No handler for message type {message['type']}"
+            )
+        await handler(message)
 
-        user = self.scope["user"]
+    async def websocket_receive(self, message):
+        frames_in.inc()
+        with receive_seconds.time():
+            await super().websocket_receive(message)
 
-        allowed = await self.user_can_join(
-            user, self.manager_id, self.client_id
-        )
-        if allowed:
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
-            await self.channel_layer.group_add(
-                self.user_notifications_group_name,
-                self.channel_name
-            )
-            await self.accept()
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None and self.framing is not None:
+            await self.framing.send(text_data)
+            if close:
+                await self.close(close)
+            return
+        await self.send_frame(text_data=text_data, bytes_data=bytes_data,
+                              close=close)
+
+    async def send_frame(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None or bytes_data is not None:
+            frames_out.inc()
+        await super().send(text_data=text_data, bytes_data=bytes_data,
+                           close=close)
+
+    async def send_event(self, text):
+        """
+        Отправляет событие группы – готовый JSON-текст кадра – с учётом
+        согласованной упаковки.
+        """
+        if self.framing is None:
+            await self.send(text_data=text)
         else:
-            await self.close()
+            await self.framing.event(text)
+
+    async def setup_framing(self, query):
+        """
+        Включает пачки событий и кодировку кадров по параметрам `batch` и
+        `encoding` строки подключения (chat.framing). Вызывается после
+        accept.
+        """
+        try:
+            batch, encoding = negotiate(query)
+        except ValueError as error:
+            await self.send_error(str(error))
+            return
+        if batch or encoding != 'json':
+            self.framing = Framing(self.send_frame, batch, encoding)
+
+    async def join_group(self, group):
+        tracker.ensure_started(self.channel_layer)
+        tracker.opened(self.channel_name)
+        tracker.joined(self.channel_name, group)
+        await self.channel_layer.group_add(group, self.channel_name)
+
+    async def leave_group(self, group):
+        tracker.left(self.channel_name, group)
+        await self.channel_layer.group_discard(group, self.channel_name)
 
-    @database_sync_to_async
-    def user_can_join(self, user, manager_id, client_id):
+    async def leave_all_groups(self):
+        """
+        Выходит из всех групп соединения. Вызывается при отключении.
+        """
+        for group in tracker.closed(self.channel_name):
+            try:
+                await self.channel_layer.group_discard(
+                    group, self.channel_name
+                )
+            except Exception:
+                logger.exception('Не удалось покинуть группу %s', group)
+                tracker.failed_discard(self.channel_name, group)
+
+    async def user_can_join(self, user, manager_id, client_id):
         """
         Проверяет, может ли пользователь присоединиться к чату.
+        Существование связи берётся из кэша, если он включён.
         """
-        relation_exists = ChatRelation.objects.filter(
+        if user.id not in (int(manager_id), int(client_id)):
+            return False
+        with auth_seconds.time():
+            if not relation_cache_enabled():
+                return await self.relation_exists(manager_id, client_id)
+
+            versions = await relation_cache.aversions(manager_id, client_id)
+            exists = relation_cache.get(manager_id, client_id, versions)
+            if exists is None:
+                generation = relation_cache.generation
+                exists = await self.relation_exists(manager_id, client_id)
+                relation_cache.set(manager_id, client_id, exists, generation,
+                                   versions)
+            return exists
+
+    @db_sync_to_async
+    def relation_exists(self, manager_id, client_id):
+        return ChatRelation.objects.filter(
             manager_id=manager_id,
             client_id=client_id
         ).exists()
 
-        if not relation_exists:
-            return False
-
-        return (user.id == int(manager_id)) or (user.id == int(client_id))
+    @db_sync_to_async(write=True)
+    def create_chat_message(self, user, receiver_id, content,
+                            manager_id, client_id):
+        """
+        Синхронно создаём сообщение в БД.
+        """
+        return services.create_chat_message(
+            user, receiver_id, content, manager_id, client_id
+        )
 
+    @db_sync_to_async
+    def messages_after(self, manager_id, client_id, seq, limit):
+        return services.messages_after(manager_id, client_id, seq, limit)
 
-    @database_sync_to_async
-    def create_chat_message(self, user, receiver_id, content):
+    async def store_chat_message(self, user, receiver_id, content,
+                                 manager_id, client_id):
         """
-        Синхронно создаём сообщение в БД.
+        Сохраняет сообщение: сразу или через очередь write-behind.
+        В режиме write-behind номер в диалоге выделяется сразу (общей для
+        одновременных отправителей транзакцией), uid и timestamp уже
+        известны, а запись сообщения в БД происходит позже, пачкой.
         """
-        return ChatMessage.objects.create(
+        if not write_behind_enabled():
+            return await self.create_chat_message(
+                user, receiver_id, content, manager_id, client_id
+            )
+        conversation_id, seq = await get_allocator().allocate(
+            manager_id, client_id
+        )
+        chat_message = ChatMessage(
             sender=user,
             receiver_id=receiver_id,
-            content=content
+            content=content,
+            conversation_id=conversation_id,
+            seq=seq
         )
+        await get_writer().put(chat_message)
+        return chat_message
 
-    async def disconnect(self, close_code):
+    async def send_error(self, error, code=None, **extra):
+        frame = {'error': error}
+        if code is not None:
+            frame['code'] = code
+        frame.update(extra)
+        await self.send(text_data=codec.dumps(frame))
+
+    async def allow_frame(self):
         """
-        Метод, вызываемый при отключении пользователя от WebSocket.
+        Проверяет лимиты частоты входящих кадров соединения и пользователя
+        перед записью сообщения. Кадр сверх лимита не обрабатывается,
+        клиент получает ошибку с кодом rate_limited и временем до повтора.
+        """
+        config = rate_limit_config()
+        if not config['ENABLED']:
+            return True
+        if getattr(self, 'rate_bucket', None) is None:
+            self.rate_bucket = TokenBucket(config['CONNECTION_RATE'],
+                                           config['CONNECTION_BURST'])
+        wait = await check_frame(self.rate_bucket, self.channel_layer,
+                                 self.scope['user'].id)
+        if not wait:
+            return True
+        limited.inc()
+        await self.send_error('Слишком много сообщений, повторите позже.',
+                              code='rate_limited',
+                              retry_after=round(wait, 3))
+        return False
+
+    async def enter_conversation(self, manager_id, client_id):
+        """
+        Отмечает соединение присутствующим в диалоге и сообщает комнате,
+        что пользователь онлайн.
         """
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
+        config = presence_config()
+        if not config['ENABLED']:
+            return
+        conversation = conversation_id(manager_id, client_id)
+        user_id = self.scope['user'].id
+        try:
+            await get_presence_store(self.channel_layer).touch(
+                conversation, user_id, self.channel_name, config['TTL']
+            )
+        except Exception:
+            logger.exception('Не удалось отметить присутствие в %s',
+                             conversation)
+            return
+        self.present.add((int(manager_id), int(client_id)))
+        self.presence_touched = time.monotonic()
+        await self.channel_layer.group_send(
+            room_group_name(manager_id, client_id), {
+                'type': 'chat_presence',
+                'conversation': conversation,
+                'user_id': user_id,
+                'text': codec.dumps({'presence': conversation,
+                                     'user_id': user_id, 'online': True}),
+            }
         )
 
-    async def receive(self, text_data):
+    async def leave_conversation(self, manager_id, client_id):
         """
-        Метод, вызываемый при получении сообщения от клиента.
+        Снимает присутствие соединения. Комната узнаёт об уходе, только
+        если у пользователя не осталось других соединений в диалоге.
         """
-        data = json.loads(text_data)
-        message = data.get('message')
-        user = self.scope['user']
-        if not message:
-            await self.send(text_data=json.dumps({
-                'error': 'Сообщение не может быть пустым.'
-            }))
+        pair = (int(manager_id), int(client_id))
+        if pair not in self.present:
+            return
+        self.present.discard(pair)
+        conversation = conversation_id(*pair)
+        user_id = self.scope['user'].id
+        store = get_presence_store(self.channel_layer)
+        try:
+            await store.remove(conversation, user_id, self.channel_name)
+            online = await store.online(conversation)
+        except Exception:
+            logger.exception('Не удалось снять присутствие в %s',
+                             conversation)
+            return
+        if user_id in online:
             return
+        await self.channel_layer.group_send(room_group_name(*pair), {
+            'type': 'chat_presence',
+            'conversation': conversation,
+            'user_id': user_id,
+            'text': codec.dumps({'presence': conversation,
+                                 'user_id': user_id, 'online': False}),
+        })
 
-        if user.id == int(self.manager_id):
-            receiver_id = self.client_id
-        else:
-            receiver_id = self.manager_id
+    async def leave_all_conversations(self):
+        for pair in list(self.present):
+            await self.leave_conversation(*pair)
+
+    async def heartbeat(self):
+        """
+        Продлевает присутствие соединения во всех его диалогах не чаще
+        раза в HEARTBEAT_INTERVAL секунд, сколько бы кадров ни пришло.
+        """
+        config = presence_config()
+        now = time.monotonic()
+        if not self.present or \
+                now - self.presence_touched < config['HEARTBEAT_INTERVAL']:
+            return
+        self.presence_touched = now
+        store = get_presence_store(self.channel_layer)
+        user_id = self.scope['user'].id
+        try:
+            for pair in self.present:
+                await store.touch(conversation_id(*pair), user_id,
+                                  self.channel_name, config['TTL'])
+        except Exception:
+            logger.exception('Не удалось продлить присутствие')
 
-        chat_message = await self.create_chat_message(
-            user, receiver_id, message
+    async def send_presence(self, manager_id, client_id):
+        """
+        Подписывает соединение на события присутствия диалога и присылает,
+        кто онлайн сейчас: `{"presence": ..., "online_users": [...]}`.
+        """
+        conversation = conversation_id(manager_id, client_id)
+        self.presence_watched.add(conversation)
+        online = await get_presence_store(self.channel_layer).online(
+            conversation
         )
+        await self.send(text_data=codec.dumps({
+            'presence': conversation, 'online_users': online
+        }))
 
+    async def typing(self, manager_id, client_id, active):
+        """
+        Индикатор набора текста. Кадры сводятся TypingThrottle, поэтому
+        поток нажатий не превращается в поток group_send.
+        """
+        typing_frames.inc()
+        if getattr(self, 'typing_throttle', None) is None:
+            self.typing_throttle = TypingThrottle(
+                presence_config()['TYPING_INTERVAL']
+            )
+        conversation = conversation_id(manager_id, client_id)
+        active = bool(active)
+        if not self.typing_throttle.allow(conversation, active):
+            return
+        typing_events.inc()
+        user_id = self.scope['user'].id
         await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'sender_id': user.id,
-                'message': message,
+            room_group_name(manager_id, client_id), {
+                'type': 'chat_typing',
+                'user_id': user_id,
+                'text': codec.dumps({'typing': conversation,
+                                     'user_id': user_id, 'active': active}),
             }
         )
-        await self.channel_layer.group_send(
-            f"user_{receiver_id}_notifications",
-            {
-                'type': 'new_message_notify',
-                'sender_id': user.id,
-                'message': message,
+
+    async def acknowledge(self, manager_id, client_id, data):
+        """
+        Подтверждение `{"ack": "delivered" | "read", "seq": N}` (или
+        `message_id` вместо `seq`). Связь проверяется так же, как при
+        подписке. В базу и собеседнику отметка уходит пачкой при сбросе
+        буфера (chat.receipts).
+        """
+        kind = data.get('ack')
+        seq = parse_seq(data.get('seq'))
+        message_id = parse_seq(data.get('message_id'))
+        if kind not in RECEIPT_KINDS or (seq is None) == (message_id is None):
+            await self.send_error('Некорректное подтверждение.')
+            return
+        user = self.scope['user']
+        if not await self.user_can_join(user, manager_id, client_id):
+            await self.send_error('Нет доступа к диалогу.')
+            return
+        get_receipt_buffer().add(self.channel_layer, manager_id, client_id,
+                                 user.id, kind, seq, message_id)
+
+    async def chat_receipts(self, event):
+        await self.send_event(event['text'])
+
+    async def chat_presence(self, event):
+        if event['user_id'] == self.scope['user'].id:
+            return
+        if event['conversation'] in self.presence_watched:
+            await self.send_event(event['text'])
+
+    async def chat_typing(self, event):
+        if event['user_id'] != self.scope['user'].id:
+            await self.send_event(event['text'])
+
+    async def deliver_message(self, user, manager_id, client_id, message):
+        """
+        Сохраняет сообщение и рассылает его участникам диалога.
+        Возвращает False, если сообщение не принято.
+        """
+        if not message:
+            await self.send_error('Сообщение не может быть пустым.')
+            return False
+
+        if user.id == int(manager_id):
+            receiver_id = client_id
+        else:
+            receiver_id = manager_id
+
+        try:
+            with db_write_seconds.time():
+                chat_message = await self.store_chat_message(
+                    user, receiver_id, message, manager_id, client_id
+                )
+        except WriteBehindOverflow:
+            await self.send_error(
+                'Сервер перегружен, повторите отправку позже.'
+            )
+            return False
+
+        conversation = conversation_id(manager_id, client_id)
+        frame = message_frame(conversation, user.id, message,
+                              chat_message.uid, chat_message.timestamp,
+                              chat_message.seq)
+        # Кадры кодируются один раз здесь, обработчики получателей отправляют
+        # готовый текст без повторного json.dumps.
+        with serialize_seconds.time():
+            room_text = codec.dumps(frame)
+            notify_text = codec.dumps({'notification': True, **frame})
+        # Участник, открывший комнату, получает сообщение из неё, а не
+        # повторное уведомление.
+        with group_send_seconds.time():
+            await fan_out(self.channel_layer, [
+                (room_group_name(manager_id, client_id), {
+                    'type': 'chat_message',
+                    'conversation': conversation,
+                    'text': room_text,
+                }),
+                (notifications_group_name(receiver_id), {
+                    'type': 'new_message_notify',
+                    'conversation': conversation,
+                    'text': notify_text,
+                }),
+            ])
+        if getattr(self, 'typing_throttle', None) is not None:
+            self.typing_throttle.reset(conversation)
+        return True
+
+    async def resume(self, manager_id, client_id, seq):
+        """
+        Досылает сообщения диалога с номером больше `seq` пачками кадров
+        `{"resume": <conversation>, "messages": [...], "last": bool}`.
+        Если достигнут предел MAX_MESSAGES, последний кадр помечается
+        `"truncated": true`, и клиент повторяет догрузку с последнего
+        полученного номера.
+
+        В режиме write-behind сначала дописывается очередь процесса, иначе
+        отправленные, но ещё не записанные сообщения выпали бы из
+        догрузки. Очереди других процессов попадают в базу не позже
+        FLUSH_INTERVAL_MS.
+        """
+        if write_behind_enabled():
+            await get_writer().flush()
+        config = chat_setting('CHAT_RESUME')
+        conversation = conversation_id(manager_id, client_id)
+        sent = 0
+        while True:
+            limit = min(config['BATCH_SIZE'], config['MAX_MESSAGES'] - sent)
+            rows = await self.messages_after(manager_id, client_id, seq,
+                                             limit + 1)
+            more = len(rows) > limit
+            rows = rows[:limit]
+            sent += len(rows)
+            truncated = more and sent >= config['MAX_MESSAGES']
+            frame = {
+                'resume': conversation,
+                'messages': [
+                    message_frame(conversation, row['sender_id'],
+                                  row['content'], row['uid'],
+                                  row['timestamp'], row['seq'])
+                    for row in rows
+                ],
+                'last': not more or truncated,
             }
+            if truncated:
+                frame['truncated'] = True
+            await self.send(text_data=codec.dumps(frame))
+            if frame['last']:
+                return
+            seq = rows[-1]['seq']
+
+
+class ChatConsumer(ChatMessagingMixin, AsyncWebsocketConsumer):
+    """
+    WebSocket-консьюмер для чата между клиентом и менеджером.
+    """
+    async def connect(self):
+        """
+        Метод, вызываемый при подключении пользователя к WebSocket.
+        """
+        started = time.perf_counter()
+        self.manager_id = self.scope['url_route']['kwargs']['manager_id']
+        self.client_id = self.scope['url_route']['kwargs']['client_id']
+        self.room_group_name = room_group_name(self.manager_id, self.client_id)
+        self.user_notifications_group_name = notifications_group_name(
+            self.scope['user'].id
+        )
+
+        user = self.scope["user"]
+
+        allowed = await self.user_can_join(
+            user, self.manager_id, self.client_id
+        )
+        if allowed:
+            await self.join_group(self.room_group_name)
+            await self.join_group(self.user_notifications_group_name)
+            await self.accept()
+            await self.enter_conversation(self.manager_id, self.client_id)
+        else:
+            await self.close()
+        connect_seconds.observe(time.perf_counter() - started)
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        if allowed:
+            await self.setup_framing(query)
+        if allowed and query.get('presence') == ['1']:
+            await self.send_presence(self.manager_id, self.client_id)
+        # Догрузка после группы: сообщение, пришедшее во время чтения,
+        # может прийти дважды (его отличает seq), но не потеряется.
+        if allowed and 'resume_from' in query:
+            await self.resume_from(query['resume_from'][0])
+
+    async def resume_from(self, value):
+        seq = parse_seq(value)
+        if seq is None:
+            await self.send_error('Некорректный resume_from.')
+            return
+        await self.resume(self.manager_id, self.client_id, seq)
+
+    async def disconnect(self, close_code):
+        """
+        Метод, вызываемый при отключении пользователя от WebSocket.
+        Соединение выходит и из комнаты, и из группы уведомлений.
+        """
+        await self.leave_all_conversations()
+        await self.leave_all_groups()
+
+    async def receive(self, text_data):
+        """
+        Метод, вызываемый при получении сообщения от клиента.
+        Кадры `{"heartbeat": true}`, `{"typing": true | false}` и
+        подтверждения `{"ack": ...}` не расходуют лимит сообщений.
+        """
+        data = codec.loads(text_data)
+        await self.heartbeat()
+        if 'heartbeat' in data:
+            return
+        if 'typing' in data:
+            await self.typing(self.manager_id, self.client_id,
+                              data['typing'])
+            return
+        if 'ack' in data:
+            await self.acknowledge(self.manager_id, self.client_id, data)
+            return
+        if not await self.allow_frame():
+            return
+        if 'resume_from' in data:
+            await self.resume_from(data['resume_from'])
+            return
+        await self.deliver_message(
+            self.scope['user'], self.manager_id, self.client_id,
+            data.get('message')
         )
 
     async def chat_message(self, event):
         """
         Метод, вызываемый при отправке сообщения клиенту.
         """
-        await self.send(text_data=json.dumps({
-            'sender_id': event['sender_id'],
-            'message': event['message'],
-        }))
+        await self.send_event(event['text'])
 
     async def new_message_notify(self, event):
         """
         Метод для уведомления пользователя,
         о новом сообщении.
         """
-        await self.send(text_data=json.dumps({
-            'notification': True,
-            'sender_id': event['sender_id'],
-            'message': event['message'],
+        await self.send_event(event['text'])
+
+
+class UserChatConsumer(ChatMessagingMixin, AsyncWebsocketConsumer):
+    """
+    Одно WebSocket-соединение на пользователя для всех его диалогов.
+
+    Подписки управляются кадрами `{"action": "subscribe" | "unsubscribe",
+    "conversation": "<manager_id>_<client_id>"}`, сообщения отправляются
+    кадром `{"action": "message", "conversation": ..., "message": ...}`.
+    Поле `resume_from` в кадре подписки досылает сообщения диалога с
+    большим номером (см. `resume`), поле `"presence": true` – присылает,
+    кто в диалоге онлайн, и подписывает на изменения.
+    Кадр `{"action": "typing", "conversation": ..., "typing": true | false}`
+    – индикатор набора текста, `{"action": "ack", "conversation": ...,
+    "ack": "delivered" | "read", "seq": N}` – подтверждение,
+    `{"action": "heartbeat"}` продлевает присутствие без других действий.
+    Менеджер рассылает сообщение клиентам кадром `{"action": "broadcast",
+    "clients": [id, ...] | "all", "message": ...}` и получает в ответ
+    `{"broadcast": {"sent": N, "rejected": [...]}}`.
+    Входящие события помечаются полем `conversation`. Уведомление по
+    диалогу, на который соединение уже подписано, не дублируется.
+    Параметры `?batch=1` и `?encoding=msgpack` строки подключения
+    включают пачки событий и бинарные кадры (chat.framing).
+    """
+    async def connect(self):
+        started = time.perf_counter()
+        user = self.scope['user']
+        self.subscriptions = set()
+        if user.id is None:
+            await self.close()
+            return
+        self.user_notifications_group_name = notifications_group_name(user.id)
+        await self.join_group(self.user_notifications_group_name)
+        await self.accept()
+        connect_seconds.observe(time.perf_counter() - started)
+        await self.setup_framing(
+            parse_qs(self.scope.get('query_string', b'').decode())
+        )
+
+    async def disconnect(self, close_code):
+        self.subscriptions = set()
+        await self.leave_all_conversations()
+        await self.leave_all_groups()
+
+    async def receive(self, text_data):
+        data = codec.loads(text_data)
+        action = data.get('action')
+        await self.heartbeat()
+        if action == 'heartbeat':
+            return
+        if action == 'broadcast':
+            await self.send_broadcast(data)
+            return
+        handler = {
+            'subscribe': self.subscribe,
+            'unsubscribe': self.unsubscribe,
+            'message': self.send_message,
+            'typing': self.send_typing,
+            'ack': self.send_ack,
+        }.get(action)
+        if handler is None:
+            await self.send_error(f'Неизвестное действие: {action}.')
+            return
+        conversation = parse_conversation_id(data.get('conversation'))
+        if conversation is None:
+            await self.send_error('Некорректный идентификатор диалога.')
+            return
+        await handler(conversation, data)
+
+    async def subscribe(self, conversation, data):
+        if conversation not in self.subscriptions:
+            if not await self.user_can_join(self.scope['user'], *conversation):
+                await self.send_error('Нет доступа к диалогу.')
+                return
+            await self.join_group(room_group_name(*conversation))
+            self.subscriptions.add(conversation)
+            await self.enter_conversation(*conversation)
+        await self.send(text_data=codec.dumps({
+            'subscribed': conversation_id(*conversation)
         }))
+        if data.get('presence'):
+            await self.send_presence(*conversation)
+        if data.get('resume_from') is not None:
+            seq = parse_seq(data['resume_from'])
+            if seq is None:
+                await self.send_error('Некорректный resume_from.')
+                return
+            await self.resume(*conversation, seq)
+
+    async def unsubscribe(self, conversation, data):
+        if conversation in self.subscriptions:
+            self.subscriptions.discard(conversation)
+            self.presence_watched.discard(conversation_id(*conversation))
+            await self.leave_conversation(*conversation)
+            await self.leave_group(room_group_name(*conversation))
+        await self.send(text_data=codec.dumps({
+            'unsubscribed': conversation_id(*conversation)
+        }))
+
+    async def send_message(self, conversation, data):
+        # Лимит частоты касается только отправки: подписка на сотни
+        # диалогов при подключении не должна в него упираться.
+        if not await self.allow_frame():
+            return
+        if conversation not in self.subscriptions and \
+                not await self.user_can_join(self.scope['user'], *conversation):
+            await self.send_error('Нет доступа к диалогу.')
+            return
+        await self.deliver_message(
+            self.scope['user'], *conversation, data.get('message')
+        )
+
+    async def send_typing(self, conversation, data):
+        if conversation not in self.subscriptions:
+            await self.send_error('Нет подписки на диалог.')
+            return
+        await self.typing(*conversation, data.get('typing'))
+
+    async def send_ack(self, conversation, data):
+        await self.acknowledge(*conversation, data)
+
+    async def send_broadcast(self, data):
+        user = self.scope['user']
+        if not user.is_staff:
+            await self.send_error('Только менеджер может делать рассылки.')
+            return
+        if not await self.allow_frame():
+            return
+        try:
+            message = parse_message(data.get('message'))
+            client_ids = parse_clients(data.get('clients'))
+        except ValueError as error:
+            await self.send_error(str(error))
+            return
+        result = await broadcast(self.channel_layer, user, message,
+                                 client_ids)
+        await self.send(text_data=codec.dumps({'broadcast': result}))
+
+    async def chat_message(self, event):
+        await self.send_event(event['text'])
+
+    async def new_message_notify(self, event):
+        if parse_conversation_id(event['conversation']) in self.subscriptions:
+            return
+        await self.send_event(event['text'])
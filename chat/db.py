@@ -0,0 +1,142 @@
+"""
+Обращения консьюмеров к БД в отдельном пуле потоков.
+
+database_sync_to_async выполняет вызов с thread_sensitive=True. Channels
+не открывает для консьюмера своего синхронного контекста, поэтому все
+такие вызовы всех соединений процесса идут по очереди через один общий
+поток. При шторме подключений проверки доступа ждут друг друга.
+Асинхронный ORM Django 5.1 (aexists, acreate, async for) – тоже
+sync_to_async с thread_sensitive=True, он попадает в тот же поток.
+
+`db_sync_to_async` выполняет вызов в пуле из
+CHAT_DB_EXECUTOR['MAX_WORKERS'] потоков, у каждого своё соединение с БД.
+Поток держит соединение между вызовами и закрывает его только после
+ошибки, если оно стало непригодным: при CONN_MAX_AGE = 0 close_old_connections
+открывал бы новое соединение на каждый вызов, и пул проигрывал общему
+потоку. Соединений не больше MAX_WORKERS. MAX_WORKERS = 0 возвращает
+прежнее поведение.
+
+SQLite не пишет параллельно – база блокируется целиком. Поэтому при
+PARALLEL_WRITES 'auto' пишущие вызовы (`write=True`) для SQLite остаются
+в общем потоке, для остальных баз идут в пул.
+"""
+import concurrent.futures
+import functools
+import threading
+import time
+
+from asgiref.sync import SyncToAsync
+from channels.db import database_sync_to_async
+from django.db import connection, connections
+
+from .conf import chat_setting
+from .metrics import histogram
+
+queue_seconds = histogram('chat_db_queue_seconds',
+                          'Ожидание потока для обращения консьюмера к БД.')
+
+
+def executor_config():
+    return chat_setting('CHAT_DB_EXECUTOR')
+
+
+def release_connections():
+    """
+    Закрывает соединения потока, непригодные после ошибки; рабочие
+    остаются для следующего вызова.
+    """
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is None:
+            continue
+        if not conn.get_autocommit():
+            conn.close()
+        elif conn.errors_occurred:
+            if conn.is_usable():
+                conn.errors_occurred = False
+            else:
+                conn.close()
+
+
+class ExecutorSyncToAsync(SyncToAsync):
+    def thread_handler(self, loop, *args, **kwargs):
+        try:
+            return super().thread_handler(loop, *args, **kwargs)
+        finally:
+            release_connections()
+
+
+_executor = None
+_workers = 0
+
+
+def db_executor():
+    """
+    Пул потоков процесса по CHAT_DB_EXECUTOR или None, если он выключен.
+    """
+    global _executor, _workers
+    if _executor is None:
+        _workers = executor_config()['MAX_WORKERS']
+        if _workers:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_workers, thread_name_prefix='chat-db'
+            )
+    return _executor
+
+
+def close_worker_connections(barrier):
+    # Барьер держит задачу, пока остальные не заняли свои потоки: так
+    # каждая из _workers задач выполняется в отдельном потоке пула.
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    finally:
+        connections.close_all()
+
+
+def reset_executor():
+    """
+    Закрывает соединения потоков пула и останавливает его; следующий
+    вызов создаст пул по текущим настройкам. Соединение потока не
+    переживает пул (например, тест, который его создал).
+    """
+    global _executor
+    if _executor is not None:
+        barrier = threading.Barrier(_workers, timeout=5)
+        for _ in range(_workers):
+            _executor.submit(close_worker_connections, barrier)
+        _executor.shutdown(wait=True)
+    _executor = None
+
+
+def parallel_writes():
+    value = executor_config()['PARALLEL_WRITES']
+    if value == 'auto':
+        return connection.vendor != 'sqlite'
+    return bool(value)
+
+
+def db_sync_to_async(func=None, write=False):
+    """
+    Как database_sync_to_async, но в пуле db_executor(). `write=True`
+    помечает вызов, который пишет в БД (см. PARALLEL_WRITES). Время до
+    начала вызова попадает в chat_db_queue_seconds.
+    """
+    if func is None:
+        return functools.partial(db_sync_to_async, write=write)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        submitted = time.perf_counter()
+
+        def call():
+            queue_seconds.observe(time.perf_counter() - submitted)
+            return func(*args, **kwargs)
+
+        executor = db_executor()
+        if executor is None or write and not parallel_writes():
+            return await database_sync_to_async(call)()
+        return await ExecutorSyncToAsync(
+            call, thread_sensitive=False, executor=executor
+        )()
+    return wrapper
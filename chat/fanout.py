@@ -0,0 +1,228 @@
+"""
+Совмещённая рассылка события по нескольким группам.
+
+`fan_out(layer, sends)` принимает список пар (group, message) в порядке
+приоритета. Состав всех групп выясняется за один проход, каждый канал
+получает ровно одно сообщение – от первой группы, в которой он состоит, –
+и отправка выполняется одной пачкой. Для channels_redis это два round trip
+(чтение групп и отправка) вместо четырёх на каждый group_send.
+
+Слой может сам предоставить методы `group_channels(groups)` и
+`send_batch(batches)` (как chat.local_layer.LocalChannelLayer); для
+InMemoryChannelLayer и RedisChannelLayer используются адаптеры ниже, для
+остальных слоёв – обычные group_send без устранения дублей.
+
+RedisAdapter опирается на закрытые методы channels_redis, поэтому версия
+закреплена в requirements.txt. Если у слоя нет этих методов с ожидаемыми
+сигнатурами (другая версия), рассылка идёт обычными group_send.
+"""
+import collections
+import functools
+import inspect
+import logging
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # pragma: no cover
+    RedisChannelLayer = None
+
+logger = logging.getLogger(__name__)
+
+
+def plan(sends, members):
+    """
+    Раскладывает каналы по сообщениям: канал получает сообщение первой
+    группы, в которой состоит. Возвращает список (message, [channels]).
+    """
+    seen = set()
+    batches = []
+    for group, message in sends:
+        channels = [channel for channel in members.get(group, ())
+                    if channel not in seen]
+        seen.update(channels)
+        if channels:
+            batches.append((message, channels))
+    return batches
+
+
+class LayerAdapter:
+    """
+    Адаптер по умолчанию: слой умеет `group_channels`/`send_batch` сам.
+    """
+    def __init__(self, layer):
+        self.layer = layer
+
+    async def group_channels(self, groups):
+        return await self.layer.group_channels(groups)
+
+    async def send_batch(self, batches):
+        await self.layer.send_batch(batches)
+
+
+class InMemoryAdapter(LayerAdapter):
+    async def group_channels(self, groups):
+        self.layer._clean_expired()
+        return {group: list(self.layer.groups.get(group, {}))
+                for group in groups}
+
+    async def send_batch(self, batches):
+        for message, channels in batches:
+            for channel in channels:
+                try:
+                    await self.layer.send(channel, message)
+                except ChannelFull:
+                    pass
+
+
+class RedisAdapter(LayerAdapter):
+    # Закрытые методы RedisChannelLayer и их параметры (без self).
+    internals = {
+        '_group_key': ['group'],
+        '_map_channel_keys_to_connection': ['channel_names', 'message'],
+        'consistent_hash': ['value'],
+        'connection': ['index'],
+    }
+    # Копия скрипта group_send из channels_redis.
+    send_lua = """
+        local over_capacity = 0
+        local current_time = ARGV[#ARGV - 1]
+        local expiry = ARGV[#ARGV]
+        for i=1,#KEYS do
+            if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+                redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+                redis.call('EXPIRE', KEYS[i], expiry)
+            else
+                over_capacity = over_capacity + 1
+            end
+        end
+        return over_capacity
+    """
+
+    async def group_channels(self, groups):
+        """
+        Читает состав всех групп одним pipeline на каждый Redis-узел.
+        """
+        layer = self.layer
+        by_connection = collections.defaultdict(list)
+        for group in groups:
+            by_connection[layer.consistent_hash(group)].append(group)
+        expired = int(time.time()) - layer.group_expiry
+        members = {}
+        for index, node_groups in by_connection.items():
+            pipe = layer.connection(index).pipeline(transaction=False)
+            for group in node_groups:
+                key = layer._group_key(group)
+                pipe.zremrangebyscore(key, min=0, max=expired)
+                pipe.zrange(key, 0, -1)
+            results = await pipe.execute()
+            for position, group in enumerate(node_groups):
+                members[group] = [
+                    name.decode('utf8') for name in results[position * 2 + 1]
+                ]
+        return members
+
+    async def send_batch(self, batches):
+        """
+        Отправляет все сообщения одним pipeline (чистка просроченных
+        сообщений и Lua-скрипт) на каждый Redis-узел.
+        """
+        layer = self.layer
+        keys = collections.defaultdict(list)
+        payloads = collections.defaultdict(list)
+        capacities = collections.defaultdict(list)
+        for message, channels in batches:
+            (
+                connection_to_keys,
+                key_to_message,
+                key_to_capacity,
+            ) = layer._map_channel_keys_to_connection(channels, message)
+            for index, channel_keys in connection_to_keys.items():
+                for key in channel_keys:
+                    keys[index].append(key)
+                    payloads[index].append(key_to_message[key])
+                    capacities[index].append(key_to_capacity[key])
+
+        now = time.time()
+        for index, channel_keys in keys.items():
+            pipe = layer.connection(index).pipeline(transaction=False)
+            for key in set(channel_keys):
+                pipe.zremrangebyscore(key, min=0,
+                                      max=int(now) - int(layer.expiry))
+            pipe.eval(self.send_lua, len(channel_keys), *channel_keys,
+                      *payloads[index], *capacities[index], now, layer.expiry)
+            results = await pipe.execute()
+            if results[-1]:
+                logger.info('%s каналов переполнены при рассылке', results[-1])
+
+
+@functools.lru_cache(maxsize=None)
+def redis_internals_supported(layer_class):
+    """
+    Есть ли у класса слоя закрытые методы, нужные RedisAdapter.
+    """
+    for name, expected in RedisAdapter.internals.items():
+        method = getattr(layer_class, name, None)
+        if not callable(method):
+            break
+        try:
+            parameters = list(inspect.signature(method).parameters)
+        except (TypeError, ValueError):
+            break
+        if parameters[1:] != expected:
+            break
+    else:
+        return True
+    logger.warning('%s не совместим с RedisAdapter, рассылка идёт через '
+                   'group_send', layer_class.__name__)
+    return False
+
+
+def get_adapter(layer):
+    if hasattr(layer, 'group_channels') and hasattr(layer, 'send_batch'):
+        return LayerAdapter(layer)
+    if isinstance(layer, InMemoryChannelLayer):
+        return InMemoryAdapter(layer)
+    if RedisChannelLayer is not None and isinstance(layer, RedisChannelLayer) \
+            and redis_internals_supported(type(layer)):
+        return RedisAdapter(layer)
+    return None
+
+
+async def fan_out(layer, sends):
+    """
+    Рассылает сообщения группам из `sends` так, чтобы каждый канал получил
+    не больше одного сообщения.
+    """
+    adapter = get_adapter(layer)
+    if adapter is None:
+        for group, message in sends:
+            await layer.group_send(group, message)
+        return
+    members = await adapter.group_channels([group for group, _ in sends])
+    batches = plan(sends, members)
+    if batches:
+        await adapter.send_batch(batches)
+
+
+async def fan_out_many(layer, events):
+    """
+    Несколько независимых рассылок fan_out (`events` – список списков
+    пар (group, message)) одной пачкой: состав всех групп читается одним
+    вызовом, дубли устраняются внутри каждой рассылки, но не между ними.
+    """
+    adapter = get_adapter(layer)
+    if adapter is None:
+        for sends in events:
+            for group, message in sends:
+                await layer.group_send(group, message)
+        return
+    members = await adapter.group_channels(
+        list({group for sends in events for group, _ in sends})
+    )
+    batches = [batch for sends in events for batch in plan(sends, members)]
+    if batches:
+        await adapter.send_batch(batches)
@@ -0,0 +1,128 @@
+"""
+Согласуемая упаковка исходящих кадров соединения: пачки событий и msgpack.
+
+Клиент выбирает режим параметрами строки подключения:
+
+- `?batch=1` – события групп (сообщения, уведомления, отметки,
+  присутствие, набор текста) копятся до CHAT_FRAMING['BATCH_MAX_EVENTS']
+  штук или BATCH_MAX_DELAY_MS миллисекунд и уходят одним кадром-массивом
+  `[{...}, {...}]`. Событие уже закодировано отправителем, поэтому массив
+  склеивается из готовых строк без повторного кодирования.
+- `?encoding=msgpack` – кадры уходят бинарными в msgpack (те же объекты и
+  массивы, что в JSON). Входящие кадры остаются JSON.
+
+Ответы на запросы соединения (ошибки, подписки, догрузка) не копятся, но
+перед ними уходит накопленная пачка, так что порядок кадров сохраняется.
+Сжатие permessage-deflate – дело ASGI-сервера, а не консьюмера (см.
+README).
+"""
+import asyncio
+
+from . import codec
+from .conf import chat_setting
+from .metrics import counter
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+batched_events = counter('chat_ws_batched_events_total',
+                         'События, отправленные в кадрах-массивах.')
+
+
+def framing_config():
+    return chat_setting('CHAT_FRAMING')
+
+
+def encodings():
+    """
+    Доступные кодировки исходящих кадров.
+    """
+    return ('json', 'msgpack') if msgpack is not None else ('json',)
+
+
+def negotiate(query):
+    """
+    Параметры упаковки из разобранной строки подключения (parse_qs):
+    (batch, encoding). Бросает ValueError для неизвестной кодировки.
+    """
+    config = framing_config()
+    batch = config['ALLOW_BATCH'] and query.get('batch') == ['1']
+    encoding = query.get('encoding', ['json'])[0]
+    if encoding not in encodings():
+        raise ValueError(f'Неподдерживаемая кодировка: {encoding}.')
+    return batch, encoding
+
+
+class Framing:
+    """
+    Упаковка кадров одного соединения. `send_frame(text_data=...,
+    bytes_data=...)` – отправка готового кадра в сокет.
+    """
+    def __init__(self, send_frame, batch=False, encoding='json'):
+        config = framing_config()
+        self.send_frame = send_frame
+        self.batch = batch
+        self.encoding = encoding
+        self.max_events = config['BATCH_MAX_EVENTS']
+        self.delay = config['BATCH_MAX_DELAY_MS'] / 1000
+        self.pending = []
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def encode(self, text):
+        if self.encoding == 'msgpack':
+            return {'bytes_data': msgpack.packb(codec.loads(text))}
+        return {'text_data': text}
+
+    async def send(self, text):
+        """
+        Ответ соединения: сначала накопленная пачка, затем сам кадр.
+        """
+        async with self.lock:
+            await self.drain()
+            await self.send_frame(**self.encode(text))
+
+    async def event(self, text):
+        """
+        Событие группы: в пачку или сразу, если пачки выключены.
+        """
+        if not self.batch:
+            await self.send(text)
+            return
+        self.pending.append(text)
+        if len(self.pending) >= self.max_events:
+            await self.flush()
+        elif self.task is None:
+            self.task = asyncio.get_running_loop().create_task(
+                self.flush_later()
+            )
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        self.task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            await self.drain()
+
+    async def drain(self):
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+            self.task = None
+        if not self.pending:
+            return
+        texts, self.pending = self.pending, []
+        batched_events.inc(len(texts))
+        await self.send_frame(**self.encode('[' + ','.join(texts) + ']'))
+
+    def close(self):
+        """
+        Отменяет отложенную отправку; накопленные события отбрасываются.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.pending = []
@@ -0,0 +1,150 @@
+"""
+Кэш последних сообщений переписки для /messages/history/?with_user=...
+
+На каждую пару собеседников в кэше Django (CHAT_HISTORY_CACHE['CACHE'],
+locmem или Redis) лежит кольцевой буфер: до SIZE последних сообщений в
+виде строк FastChatMessageSerializer, пользователи пары и номер
+последнего сообщения `last_seq`. Запись хранится TTL секунд.
+
+Сохранённые сообщения дописываются в буфер после коммита (write-through),
+если их номера продолжают буфер без пропуска. Иначе буфер удаляется.
+Перед ответом из буфера его `last_seq` сверяется с Conversation.last_seq
+тем же запросом, что выбирает отметки доставки и прочтения. Поэтому
+буфер, пропустивший сообщение (другой процесс с locmem, гонка записи в
+Redis), не отдаётся, а перечитывается из базы.
+
+Из буфера отдаются первая страница и страницы `before`, если окно
+целиком лежит в буфере; `after` и переписка без номеров сообщений идут в
+базу.
+"""
+import heapq
+
+from django.core.cache import caches
+from django.db import transaction
+
+from .conf import chat_setting
+from .metrics import counter
+from .serializers import FastChatMessageSerializer
+
+FIELDS = FastChatMessageSerializer.values_fields
+
+hits = counter('chat_history_cache_hits_total',
+               'Страницы истории, отданные из кэша последних сообщений.')
+misses = counter('chat_history_cache_misses_total',
+                 'Страницы истории мимо кэша последних сообщений.')
+stale = counter('chat_history_cache_stale_total',
+                'Буферы, отброшенные из-за пропущенных сообщений.')
+
+
+def history_cache_config():
+    return chat_setting('CHAT_HISTORY_CACHE')
+
+
+def history_cache_enabled():
+    return history_cache_config()['ENABLED']
+
+
+def cache():
+    return caches[history_cache_config()['CACHE']]
+
+
+def cache_key(user_id, counterpart_id):
+    first, second = sorted((int(user_id), int(counterpart_id)))
+    return f'chat:history:{first}_{second}'
+
+
+def row_key(row):
+    return row['timestamp'], row['id']
+
+
+def get(user_id, counterpart_id):
+    return cache().get(cache_key(user_id, counterpart_id))
+
+
+def window(entry, cursor, limit):
+    """
+    До limit + 1 строк буфера старше `cursor` (без курсора – с начала)
+    или None, если окно выходит за буфер.
+    """
+    rows = entry['rows']
+    start = 0
+    if cursor is not None:
+        while start < len(rows) and row_key(rows[start]) >= cursor:
+            start += 1
+    page = rows[start:start + limit + 1]
+    if len(page) <= limit and not entry['complete']:
+        return None
+    return page
+
+
+def load(branches, archive):
+    """
+    Заполняет буфер пары из базы: по SIZE последних строк каждой ветви
+    истории. `archive` – ArchivedHistory пары: буфер полон, только если
+    у пары нет архива. Переписка без номеров или из нескольких диалогов
+    не кэшируется.
+    """
+    size = history_cache_config()['SIZE']
+    rows = list(heapq.merge(
+        *[list(branch.order_by('-timestamp', '-id')[:size])
+          for branch in branches],
+        key=row_key, reverse=True
+    ))[:size]
+    if not rows or len({row['conversation_id'] for row in rows}) != 1 or \
+            any(row['seq'] is None for row in rows):
+        return None
+    entry = {
+        'conversation_id': rows[0]['conversation_id'],
+        'last_seq': max(row['seq'] for row in rows),
+        'rows': rows,
+        'complete': len(rows) < size and archive.horizon is None,
+        'users': FastChatMessageSerializer(rows).get_users(),
+    }
+    cache().set(cache_key(archive.user_id, archive.counterpart_id), entry,
+                history_cache_config()['TTL'])
+    return entry
+
+
+def append(messages):
+    """
+    Дописывает сохранённые сообщения в буферы их пар. Сообщение, номер
+    которого не продолжает буфер, удаляет его.
+    """
+    config = history_cache_config()
+    by_pair = {}
+    for message in sorted(messages, key=lambda m: (m.seq or 0)):
+        by_pair.setdefault(cache_key(message.sender_id, message.receiver_id),
+                           []).append(message)
+    store = cache()
+    for key, items in by_pair.items():
+        entry = store.get(key)
+        if entry is None:
+            continue
+        for message in items:
+            if message.conversation_id != entry['conversation_id'] or \
+                    message.seq != entry['last_seq'] + 1:
+                store.delete(key)
+                break
+            entry['rows'].append({field: getattr(message, field)
+                                  for field in FIELDS})
+            entry['last_seq'] = message.seq
+        else:
+            entry['rows'].sort(key=row_key, reverse=True)
+            if len(entry['rows']) > config['SIZE']:
+                del entry['rows'][config['SIZE']:]
+                entry['complete'] = False
+            store.set(key, entry, config['TTL'])
+
+
+def append_on_commit(messages):
+    if history_cache_enabled():
+        transaction.on_commit(lambda: append(messages))
+
+
+def invalidate(pairs):
+    """
+    Удаляет буферы пар (sender_id, receiver_id), например после изменения
+    или архивации их сообщений.
+    """
+    if history_cache_enabled():
+        cache().delete_many({cache_key(*pair) for pair in pairs})
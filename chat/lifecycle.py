@@ -0,0 +1,171 @@
+"""
+Учёт WebSocket-соединений процесса и их членства в группах channel layer.
+
+Консьюмеры регистрируют каждое соединение и каждую группу, в которую его
+добавили, и при отключении выходят ровно из тех групп, в которые вошли.
+Периодическая чистка (`sweep`) раз в `sweep_interval` секунд в фоновой
+задаче процесса повторяет неудавшиеся group_discard и, если слой позволяет
+посмотреть состав групп (in-memory, LocalChannelLayer), проверяет группы
+соединений, закрытых с прошлой чистки. Чужие каналы и каналы живых
+соединений не трогаются, а работа чистки пропорциональна числу отключений,
+а не всех членств слоя.
+"""
+import asyncio
+import logging
+import time
+
+from .metrics import counter, gauge
+from .persistence import close_writer
+
+logger = logging.getLogger(__name__)
+
+opened_total = counter('chat_ws_connections_opened_total',
+                       'Открытые WebSocket-соединения.')
+closed_total = counter('chat_ws_connections_closed_total',
+                       'Закрытые WebSocket-соединения.')
+swept_total = counter('chat_group_memberships_swept_total',
+                      'Осиротевшие членства в группах, удалённые чисткой.')
+
+
+class ConnectionTracker:
+    sweep_interval = 60.0
+
+    def __init__(self):
+        # channel_name -> множество групп соединения
+        self.connections = {}
+        # (group, channel_name), которые не удалось покинуть при отключении
+        self.pending = set()
+        # channel_name -> группы соединений, закрытых с прошлой чистки
+        self.recently_closed = {}
+        self.last_sweep = time.monotonic()
+        self.loop = None
+        self.task = None
+
+    @property
+    def live_connections(self):
+        return len(self.connections)
+
+    @property
+    def live_memberships(self):
+        return sum(len(groups) for groups in self.connections.values())
+
+    @property
+    def live_groups(self):
+        return len(set().union(*self.connections.values())) \
+            if self.connections else 0
+
+    def opened(self, channel_name):
+        if channel_name not in self.connections:
+            self.connections[channel_name] = set()
+            opened_total.inc()
+
+    def joined(self, channel_name, group):
+        self.connections.setdefault(channel_name, set()).add(group)
+
+    def left(self, channel_name, group):
+        groups = self.connections.get(channel_name)
+        if groups is not None:
+            groups.discard(group)
+
+    def closed(self, channel_name):
+        """
+        Снимает соединение с учёта и возвращает группы, которые оно
+        должно покинуть.
+        """
+        groups = self.connections.pop(channel_name, None)
+        if groups is None:
+            return set()
+        closed_total.inc()
+        self.recently_closed[channel_name] = set(groups)
+        return groups
+
+    def failed_discard(self, channel_name, group):
+        self.pending.add((group, channel_name))
+
+    async def sweep(self, channel_layer):
+        """
+        Удаляет членства без живого соединения и возвращает их количество.
+        """
+        self.last_sweep = time.monotonic()
+        removed = 0
+        for group, channel_name in list(self.pending):
+            try:
+                await channel_layer.group_discard(group, channel_name)
+            except Exception:
+                logger.exception('Не удалось покинуть группу %s', group)
+                continue
+            self.pending.discard((group, channel_name))
+            removed += 1
+
+        closed, self.recently_closed = self.recently_closed, {}
+        groups = getattr(channel_layer, 'groups', None)
+        if isinstance(groups, dict):
+            for channel_name, channel_groups in closed.items():
+                # Канал мог снова подключиться под тем же именем.
+                if channel_name in self.connections:
+                    continue
+                for group in channel_groups:
+                    if channel_name in groups.get(group, ()):
+                        await channel_layer.group_discard(group, channel_name)
+                        removed += 1
+        swept_total.inc(removed)
+        return removed
+
+    def ensure_started(self, channel_layer):
+        """
+        Запускает периодическую чистку в текущем event loop (см.
+        ReceiptBuffer.ensure_started).
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and self.task is not None \
+                and not self.task.done():
+            return
+        self.loop = loop
+        self.task = loop.create_task(self.run(channel_layer))
+
+    async def run(self, channel_layer):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep(channel_layer)
+            except Exception:
+                logger.exception('Чистка членств в группах не удалась')
+
+    def stats(self):
+        return {
+            'live_connections': self.live_connections,
+            'live_memberships': self.live_memberships,
+            'live_groups': self.live_groups,
+            'opened_total': opened_total.value,
+            'closed_total': closed_total.value,
+            'swept_total': swept_total.value,
+        }
+
+
+tracker = ConnectionTracker()
+
+gauge('chat_ws_live_connections', 'Открытые WebSocket-соединения процесса.',
+      lambda: tracker.live_connections)
+gauge('chat_group_live_memberships',
+      'Членства живых соединений процесса в группах.',
+      lambda: tracker.live_memberships)
+
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan: при остановке сервера дописывает очередь write-behind,
+    пока event loop ещё работает. Ошибка записи попадает в лог, остановка
+    продолжается.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await close_writer()
+            except Exception:
+                logger.exception('Не удалось дописать очередь write-behind '
+                                 'при остановке')
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
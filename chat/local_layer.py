@@ -0,0 +1,237 @@
+"""
+Channel layer в памяти процесса для развёртывания на одном узле.
+
+С channels_redis каждая рассылка кодируется msgpack и идёт в Redis и
+обратно, даже если Redis и все соединения живут на одной машине.
+LocalChannelLayer хранит каналы и группы в памяти процесса:
+
+- состав группы – множество каналов, плюс обратный индекс «канал →
+  группы» со временем вступления для истечения членства;
+- у канала – ограниченная очередь (deque) и ожидающие receive; если
+  получатель уже ждёт, сообщение отдаётся ему напрямую, минуя очередь;
+- сообщения не копируются и не сериализуются: получатели не должны
+  менять полученный словарь.
+
+Ёмкость и сроки – как у channels_redis: send в полный канал бросает
+ChannelFull, group_send такие каналы пропускает; непрочитанное сообщение
+истекает через `expiry` секунд, членство в группе – через `group_expiry`.
+Канал с истёкшими сообщениями из групп не удаляется.
+
+Слой подходит только для одного процесса: другие процессы его каналов и
+групп не видят.
+"""
+import asyncio
+import collections
+import logging
+import time
+import uuid
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .metrics import counter
+
+logger = logging.getLogger(__name__)
+
+dropped = counter('chat_local_layer_dropped_total',
+                  'Сообщения group_send, не доставленные в полные каналы.')
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, cleanup_interval=1, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.cleanup_interval = cleanup_interval
+        self.capacities = {}
+        self.queues = {}
+        self.waiters = {}
+        self.groups = {}
+        self.memberships = {}
+        self.cleaned_at = time.monotonic()
+
+    def channel_limit(self, channel):
+        """
+        Ёмкость канала: шаблоны channel_capacity проверяются один раз на
+        канал.
+        """
+        capacity = self.capacities.get(channel)
+        if capacity is None:
+            capacity = self.capacities[channel] = self.get_capacity(channel)
+        return capacity
+
+    # Каналы
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}.local!{uuid.uuid4().hex}'
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.deliver(channel, message, time.monotonic())
+
+    def deliver(self, channel, message, now):
+        """
+        Отдаёт сообщение ожидающему receive или кладёт в очередь канала.
+        """
+        waiters = self.waiters.get(channel)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                if not waiters:
+                    del self.waiters[channel]
+                self.wake(waiter, channel, message)
+                return
+        if waiters is not None:
+            del self.waiters[channel]
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = collections.deque()
+        else:
+            self.drop_expired(queue, now)
+        if len(queue) >= self.channel_limit(channel):
+            raise ChannelFull(channel)
+        queue.append((now + self.expiry, message))
+
+    def wake(self, waiter, channel, message):
+        loop = waiter.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            waiter.set_result(message)
+        else:
+            # receive ждёт в другом event loop (async_to_sync из потока).
+            loop.call_soon_threadsafe(self.resolve, waiter, channel, message)
+
+    def resolve(self, waiter, channel, message):
+        if waiter.done():
+            self.requeue(channel, message)
+        else:
+            waiter.set_result(message)
+
+    def requeue(self, channel, message):
+        """
+        Возвращает в начало очереди сообщение, которое получатель не забрал.
+        """
+        queue = self.queues.setdefault(channel, collections.deque())
+        queue.appendleft((time.monotonic() + self.expiry, message))
+
+    @staticmethod
+    def drop_expired(queue, now):
+        while queue and queue[0][0] <= now:
+            queue.popleft()
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        now = time.monotonic()
+        self.maybe_clean(now)
+        queue = self.queues.get(channel)
+        if queue:
+            self.drop_expired(queue, now)
+            if queue:
+                _, message = queue.popleft()
+                if not queue:
+                    del self.queues[channel]
+                return message
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(channel, collections.deque()).append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # Сообщение успели отдать, но получатель отменён – не теряем его.
+            if waiter.done() and not waiter.cancelled():
+                self.requeue(channel, waiter.result())
+            raise
+
+    # Группы
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.groups.setdefault(group, set()).add(channel)
+        self.memberships.setdefault(channel, {})[group] = time.monotonic()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self.remove_member(group, channel)
+
+    def remove_member(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+        groups = self.memberships.get(channel)
+        if groups is not None:
+            groups.pop(group, None)
+            if not groups:
+                del self.memberships[channel]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        now = time.monotonic()
+        self.maybe_clean(now)
+        self.send_many(self.groups.get(group, ()), message, now)
+
+    def send_many(self, channels, message, now):
+        full = 0
+        for channel in list(channels):
+            try:
+                self.deliver(channel, message, now)
+            except ChannelFull:
+                full += 1
+        if full:
+            dropped.inc(full)
+            logger.info('%s каналов переполнены при рассылке', full)
+
+    # Совмещённая рассылка (chat.fanout)
+
+    async def group_channels(self, groups):
+        self.maybe_clean(time.monotonic())
+        return {group: list(self.groups.get(group, ())) for group in groups}
+
+    async def send_batch(self, batches):
+        now = time.monotonic()
+        for message, channels in batches:
+            self.send_many(channels, message, now)
+
+    # Истечение сроков
+
+    def maybe_clean(self, now):
+        if now - self.cleaned_at >= self.cleanup_interval:
+            self.clean_expired(now)
+
+    def clean_expired(self, now):
+        """
+        Удаляет истёкшие сообщения и членства в группах. Вызывается не
+        чаще раза в cleanup_interval секунд.
+        """
+        self.cleaned_at = now
+        for channel, queue in list(self.queues.items()):
+            self.drop_expired(queue, now)
+            if not queue:
+                del self.queues[channel]
+        joined_before = now - self.group_expiry
+        for channel, groups in list(self.memberships.items()):
+            for group, joined in list(groups.items()):
+                if joined < joined_before:
+                    self.remove_member(group, channel)
+        for channel in [channel for channel in self.capacities
+                        if channel not in self.queues]:
+            del self.capacities[channel]
+
+    async def flush(self):
+        self.queues = {}
+        self.groups = {}
+        self.memberships = {}
+        self.capacities = {}
+
+    async def close(self):
+        pass
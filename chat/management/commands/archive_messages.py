@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat import archive
+from chat.conf import chat_setting
+
+
+class Command(BaseCommand):
+    help = ('Переносит сообщения старше заданного срока в сжатые сегменты '
+            'архива (см. CHAT_ARCHIVE).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help='Срок в днях, по умолчанию '
+                                 'CHAT_ARCHIVE["AFTER_DAYS"].')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Сколько сообщений переносить за '
+                                 'транзакцию.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать сообщения к переносу.')
+        parser.add_argument('--every', type=int, default=None,
+                            help='Повторять каждые N секунд (режим по '
+                                 'расписанию).')
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_once(options)
+            if not options['every']:
+                return
+            time.sleep(options['every'])
+
+    def run_once(self, options):
+        days = options['older_than_days']
+        if days is None:
+            days = chat_setting('CHAT_ARCHIVE')['AFTER_DAYS']
+        cutoff = timezone.now() - timedelta(days=days)
+        if options['dry_run']:
+            count = archive.candidates(cutoff).count()
+            self.stdout.write(f"К переносу в архив сообщений: {count}.")
+            return
+        archived, segments = archive.archive_messages(cutoff,
+                                                      options['batch_size'])
+        self.stdout.write(
+            f"Перенесено в архив сообщений: {archived}, "
+            f"сегментов: {segments}."
+        )
@@ -0,0 +1,73 @@
+import json
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat.bench import load_scenarios, temporary_database
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def meta():
+    """
+    Сведения о запуске, чтобы результаты разных коммитов можно было
+    сравнивать.
+    """
+    return {
+        'revision': git_revision(),
+        'started_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Запускает нагрузочный сценарий во временной базе и печатает '
+            'результаты в JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', help='Имя сценария.')
+        parser.add_argument('--rows', type=int, default=200_000,
+                            help='Сколько сообщений сгенерировать.')
+        parser.add_argument('--repeat', type=int, default=200,
+                            help='Сколько раз повторить замер.')
+        parser.add_argument('--messages', type=int, default=2000,
+                            help='Сколько сообщений отправить по WebSocket.')
+        parser.add_argument('--redis', action='append', default=[],
+                            help='Адрес Redis (redis://host:port) для '
+                                 'сценариев channel layer; можно несколько.')
+        parser.add_argument('--clients', type=int, default=None,
+                            help='Количество клиентов в сценарии.')
+        parser.add_argument('--relations', type=int, default=1000,
+                            help='Сколько связей создать в сценарии load.')
+        parser.add_argument('--output', default=None,
+                            help='Дополнительно записать JSON в файл.')
+
+    def handle(self, *args, **options):
+        scenarios = load_scenarios()
+        name = options['scenario']
+        if name not in scenarios:
+            raise CommandError(
+                f"Неизвестный сценарий {name!r}. "
+                f"Доступны: {', '.join(sorted(scenarios))}"
+            )
+        with temporary_database():
+            result = scenarios[name](options)
+        result = {'scenario': name, **meta(), **result}
+        output = json.dumps(result, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output + '\n')
+        self.stdout.write(output)
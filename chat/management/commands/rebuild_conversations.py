@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery
+
+from chat.models import ChatMessage, Conversation
+
+SUMMARY_FIELDS = ('last_seq', 'last_message_id', 'last_timestamp',
+                  'manager_unread', 'client_unread')
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает сводку Conversation (последнее сообщение и '
+            'непрочитанные) по сообщениям и исправляет расхождения.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать расхождения.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько диалогов проверять за транзакцию.')
+
+    def handle(self, *args, **options):
+        checked = fixed = 0
+        ids = list(Conversation.objects.order_by('pk')
+                   .values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            with transaction.atomic():
+                changed = self.rebuild(batch, options['dry_run'])
+            checked += len(batch)
+            fixed += len(changed)
+            for conversation, before in changed:
+                self.stdout.write(
+                    f"Диалог {conversation}: {before} -> "
+                    f"{self.summary(conversation)}"
+                )
+        verb = 'Найдено расхождений' if options['dry_run'] else 'Исправлено'
+        self.stdout.write(f"Проверено диалогов: {checked}. {verb}: {fixed}.")
+
+    def summary(self, conversation):
+        return {field: getattr(conversation, field)
+                for field in SUMMARY_FIELDS}
+
+    def rebuild(self, ids, dry_run):
+        """
+        Сверяет диалоги `ids` с сообщениями. Возвращает список
+        (диалог, прежняя сводка) для расходящихся.
+        """
+        latest = ChatMessage.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by('-timestamp', '-id')
+        conversations = Conversation.objects.select_for_update().filter(
+            pk__in=ids
+        ).annotate(
+            actual_last_message_id=Subquery(latest.values('pk')[:1]),
+            actual_last_timestamp=Subquery(latest.values('timestamp')[:1]),
+        )
+        counts = ChatMessage.objects.filter(conversation_id__in=ids).values(
+            'conversation_id'
+        ).annotate(
+            max_seq=Max('seq'),
+            manager_unread=Count('id', filter=Q(
+                receiver_id=F('conversation__manager_id'),
+                seq__gt=F('conversation__manager_read_seq'),
+            )),
+            client_unread=Count('id', filter=Q(
+                receiver_id=F('conversation__client_id'),
+                seq__gt=F('conversation__client_read_seq'),
+            )),
+        )
+        counts = {row['conversation_id']: row for row in counts}
+
+        changed = []
+        for conversation in conversations:
+            row = counts.get(conversation.pk, {})
+            before = self.summary(conversation)
+            # Номера могут идти с пропусками, счётчик только растёт.
+            conversation.last_seq = max(conversation.last_seq,
+                                        row.get('max_seq') or 0)
+            conversation.last_message_id = conversation.actual_last_message_id
+            conversation.last_timestamp = conversation.actual_last_timestamp
+            conversation.manager_unread = row.get('manager_unread', 0)
+            conversation.client_unread = row.get('client_unread', 0)
+            if self.summary(conversation) != before:
+                changed.append((conversation, before))
+        if changed and not dry_run:
+            Conversation.objects.bulk_update(
+                [conversation for conversation, _ in changed], SUMMARY_FIELDS
+            )
+        return changed
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from chat import search
+
+
+class Command(BaseCommand):
+    help = ('Заново строит поисковый индекс сообщений (FTS5 или '
+            'MessageTerm, см. CHAT_SEARCH).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Сколько сообщений индексировать за '
+                                 'транзакцию (только для MessageTerm).')
+
+    def handle(self, *args, **options):
+        indexed = search.rebuild_index(options['batch_size'])
+        self.stdout.write(
+            f"Индекс: {search.search_backend()}. "
+            f"Проиндексировано сообщений: {indexed}."
+        )
@@ -0,0 +1,171 @@
+"""
+Простые метрики процесса: счётчики и гистограммы.
+
+Метрики живут в памяти процесса. Обновления приходят не только из event
+loop, но и из потоков (пул chat.db, синхронные view), а `+=` не атомарен,
+поэтому у каждой метрики своя блокировка. `render()` отдаёт их в текстовом
+формате Prometheus (см. `chat.views.metrics`).
+"""
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+REGISTRY = {}
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def reset(self):
+        with self.lock:
+            self.value = 0
+
+
+class Gauge:
+    """
+    Текущее значение, вычисляемое функцией в момент чтения.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description='', func=None):
+        self.name = name
+        self.description = description
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func() if self.func is not None else 0
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, fraction):
+        """
+        Оценка квантиля по верхней границе корзины.
+        """
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+
+    def snapshot(self):
+        """
+        Согласованные (counts, sum, count) для вывода.
+        """
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+def counter(name, description=''):
+    """
+    Возвращает счётчик `name`, создавая его при первом обращении.
+    """
+    if name not in REGISTRY:
+        REGISTRY[name] = Counter(name, description)
+    return REGISTRY[name]
+
+
+def gauge(name, description='', func=None):
+    """
+    Регистрирует (или перепривязывает) вычисляемую метрику `name`.
+    """
+    if name not in REGISTRY:
+        REGISTRY[name] = Gauge(name, description, func)
+    elif func is not None:
+        REGISTRY[name].func = func
+    return REGISTRY[name]
+
+
+def histogram(name, description='', buckets=DEFAULT_BUCKETS):
+    """
+    Возвращает гистограмму `name`, создавая её при первом обращении.
+    """
+    if name not in REGISTRY:
+        REGISTRY[name] = Histogram(name, description, buckets)
+    return REGISTRY[name]
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Все метрики REGISTRY в текстовом формате Prometheus 0.0.4.
+    """
+    lines = []
+    for name in sorted(REGISTRY):
+        metric = REGISTRY[name]
+        if metric.description:
+            description = metric.description.replace('\\', '\\\\')
+            lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        if metric.kind != 'histogram':
+            lines.append(f'{name} {_number(metric.value)}')
+            continue
+        counts, total, count = metric.snapshot()
+        seen = 0
+        for bound, bucket in zip(metric.buckets + (float('inf'),), counts):
+            seen += bucket
+            lines.append(f'{name}_bucket{{le="{_number(bound)}"}} {seen}')
+        lines.append(f'{name}_sum {_number(total)}')
+        lines.append(f'{name}_count {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,45 @@
+import time
+
+from django.db import connection
+
+from .metrics import histogram
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+request_seconds = histogram('chat_http_request_seconds',
+                            'Длительность HTTP-запроса.')
+request_queries = histogram('chat_http_request_queries',
+                            'SQL-запросы на HTTP-запрос.', QUERY_BUCKETS)
+request_query_seconds = histogram('chat_http_request_query_seconds',
+                                  'Время SQL-запросов на HTTP-запрос.')
+
+
+class QueryMetricsMiddleware:
+    """
+    Считает длительность, число и суммарное время SQL-запросов каждого
+    HTTP-запроса. Включена в MIDDLEWARE настроек проекта по умолчанию:
+    каждый запрос идёт через обёртку execute_wrapper (вызов функции и
+    perf_counter на SQL-запрос). Если запросы REST API в /metrics не нужны,
+    её убирают из MIDDLEWARE.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = {'queries': 0, 'seconds': 0.0}
+
+        def count(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                stats['queries'] += 1
+                stats['seconds'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        request_seconds.observe(time.perf_counter() - started)
+        request_queries.observe(stats['queries'])
+        request_query_seconds.observe(stats['seconds'])
+        return response
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='receiver',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='received_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='sender',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['sender', 'receiver', 'timestamp', 'id'], name='chat_msg_conversation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['sender', 'timestamp', 'id'], name='chat_msg_sender_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['receiver', 'timestamp', 'id'], name='chat_msg_receiver_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:56
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+def fill_uids(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    batch = []
+    for message in ChatMessage.objects.only('id').iterator(chunk_size=2000):
+        message.uid = uuid.uuid4()
+        batch.append(message)
+        if len(batch) >= 2000:
+            ChatMessage.objects.bulk_update(batch, ['uid'])
+            batch = []
+    if batch:
+        ChatMessage.objects.bulk_update(batch, ['uid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='uid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_uids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
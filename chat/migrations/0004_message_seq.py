@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-18 01:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_uid'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_seq', models.PositiveBigIntegerField(default=0)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='client_conversations', to=settings.AUTH_USER_MODEL)),
+                ('manager', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='manager_conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='chat.conversation'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='chat_msg_conversation_seq_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('manager', 'client'), name='chat_conversation_pair_uniq'),
+        ),
+    ]
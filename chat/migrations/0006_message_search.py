@@ -0,0 +1,80 @@
+# Generated by Django 5.1.7 on 2026-10-18 01:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import OperationalError, migrations, models
+
+PARTICIPANTS = "'u' || {row}.sender_id || ' u' || {row}.receiver_id"
+
+FTS_SQL = [
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+    "content, participants, content='', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO chat_message_fts(rowid, content, participants) "
+    f"SELECT id, content, {PARTICIPANTS.format(row='chat_chatmessage')} "
+    "FROM chat_chatmessage",
+    "CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_chatmessage "
+    "BEGIN INSERT INTO chat_message_fts(rowid, content, participants) "
+    f"VALUES (new.id, new.content, {PARTICIPANTS.format(row='new')}); END",
+    "CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_chatmessage "
+    "BEGIN INSERT INTO chat_message_fts(chat_message_fts, rowid, content, "
+    f"participants) VALUES ('delete', old.id, old.content, "
+    f"{PARTICIPANTS.format(row='old')}); END",
+    "CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content, "
+    "sender_id, receiver_id ON chat_chatmessage "
+    "BEGIN INSERT INTO chat_message_fts(chat_message_fts, rowid, content, "
+    f"participants) VALUES ('delete', old.id, old.content, "
+    f"{PARTICIPANTS.format(row='old')}); "
+    "INSERT INTO chat_message_fts(rowid, content, participants) "
+    f"VALUES (new.id, new.content, {PARTICIPANTS.format(row='new')}); END",
+]
+
+
+def create_fts(apps, schema_editor):
+    """
+    Индекс FTS5 и триггеры, поддерживающие его. Если SQLite собран без
+    FTS5 или база не SQLite, поиск работает по MessageTerm.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(FTS_SQL[0])
+        except OperationalError:
+            return
+        for sql in FTS_SQL[1:]:
+            cursor.execute(sql)
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for action in ('insert', 'delete', 'update'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS chat_message_fts_{action}')
+        cursor.execute('DROP TABLE IF EXISTS chat_message_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_conversation_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatmessage')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'term', 'message'), name='chat_term_user_term_msg_uniq')],
+            },
+        ),
+        migrations.RunPython(create_fts, drop_fts),
+    ]
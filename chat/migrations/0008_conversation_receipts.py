@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-18 02:50
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def delivered_from_read(apps, schema_editor):
+    # Прочитанное считается доставленным.
+    Conversation = apps.get_model('chat', 'Conversation')
+    Conversation.objects.update(
+        manager_delivered_seq=F('manager_read_seq'),
+        client_delivered_seq=F('client_read_seq'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='client_delivered_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='manager_delivered_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(delivered_from_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.7 on 2026-10-18 03:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_relations(apps, schema_editor):
+    # Из повторяющихся связей пары остаётся первая созданная.
+    ChatRelation = apps.get_model('chat', 'ChatRelation')
+    first = ChatRelation.objects.values('manager', 'client').annotate(
+        first_id=Min('id')
+    ).values('first_id')
+    ChatRelation.objects.exclude(id__in=first).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_conversation_receipts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_relations,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatrelation',
+            constraint=models.UniqueConstraint(fields=('manager', 'client'), name='chat_relation_pair_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='chatrelation',
+            index=models.Index(fields=['client', 'manager'], name='chat_relation_client_idx'),
+        ),
+        # Одиночные индексы внешних ключей покрыты составными.
+        migrations.AlterField(
+            model_name='chatrelation',
+            name='client',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='client_relations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='chatrelation',
+            name='manager',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='manager_relations', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,30 +1,190 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 class ChatRelation(models.Model):
     """
-    Модель для связи между менеджером и клиентом.
+    Модель для связи между менеджером и клиентом. Пара уникальна.
     """
     manager = models.ForeignKey(User, on_delete=models.CASCADE,
-                                related_name='manager_relations')
+                                related_name='manager_relations',
+                                db_index=False)
     client = models.ForeignKey(User, on_delete=models.CASCADE,
-                               related_name='client_relations')
+                               related_name='client_relations',
+                               db_index=False)
+
+    class Meta:
+        # Уникальный индекс (manager, client) обслуживает проверку доступа
+        # и клиентскую книгу менеджера, (client, manager) – связи клиента.
+        constraints = [
+            models.UniqueConstraint(fields=['manager', 'client'],
+                                    name='chat_relation_pair_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['client', 'manager'],
+                         name='chat_relation_client_idx'),
+        ]
 
     def __str__(self):
         return f"{self.client.username} -> {self.manager.username}"
 
 
+class Conversation(models.Model):
+    """
+    Диалог менеджера с клиентом: одна запись на пару, как у ChatRelation.
+
+    Хранит счётчик порядковых номеров сообщений и сводку для списка
+    диалогов – последнее сообщение и число непрочитанных у каждой стороны.
+    Сводка обновляется вместе с записью сообщений (см. chat.services)
+    и пересчитывается командой `rebuild_conversations`.
+    """
+    manager = models.ForeignKey(User, on_delete=models.CASCADE,
+                                related_name='manager_conversations',
+                                db_index=False)
+    client = models.ForeignKey(User, on_delete=models.CASCADE,
+                               related_name='client_conversations',
+                               db_index=False)
+    last_seq = models.PositiveBigIntegerField(default=0)
+    last_message = models.ForeignKey('ChatMessage', on_delete=models.SET_NULL,
+                                     related_name='+', null=True,
+                                     blank=True)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    # Непрочитанные сообщения каждой стороны и номер последнего
+    # прочитанного ею сообщения.
+    manager_unread = models.PositiveIntegerField(default=0)
+    client_unread = models.PositiveIntegerField(default=0)
+    manager_read_seq = models.PositiveBigIntegerField(default=0)
+    client_read_seq = models.PositiveBigIntegerField(default=0)
+    # Номер последнего доставленного стороне сообщения (chat.receipts),
+    # не меньше прочитанного.
+    manager_delivered_seq = models.PositiveBigIntegerField(default=0)
+    client_delivered_seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['manager', 'client'],
+                                    name='chat_conversation_pair_uniq'),
+        ]
+        # Список диалогов пользователя от свежих к старым.
+        indexes = [
+            models.Index(fields=['manager', 'last_timestamp', 'id'],
+                         name='chat_conv_manager_recent_idx'),
+            models.Index(fields=['client', 'last_timestamp', 'id'],
+                         name='chat_conv_client_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.manager_id}_{self.client_id}"
+
+
 class ChatMessage(models.Model):
     """
     Модель для хранения сообщений.
     """
     sender = models.ForeignKey(User, on_delete=models.CASCADE,
-                               related_name='sent_messages')
+                               related_name='sent_messages',
+                               db_index=False)
     receiver = models.ForeignKey(User, on_delete=models.CASCADE,
-                                 related_name='received_messages')
+                                 related_name='received_messages',
+                                 db_index=False)
+    # uid и timestamp генерируются на сервере до записи в БД, поэтому
+    # сообщение можно разослать раньше, чем оно будет сохранено
+    # (см. chat.persistence).
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Порядковый номер сообщения внутри диалога, монотонно растёт с 1.
+    # У сообщений, сохранённых до появления нумерации, он пустой.
+    conversation = models.ForeignKey(Conversation, on_delete=models.SET_NULL,
+                                     related_name='messages', null=True,
+                                     db_index=False, editable=False)
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
+
+    class Meta:
+        # Одиночные индексы по FK не нужны: их покрывают составные индексы
+        # ниже. Они же обслуживают keyset-пагинацию истории по
+        # (timestamp, id) как для диалога, так и для всех сообщений
+        # пользователя.
+        indexes = [
+            models.Index(fields=['sender', 'receiver', 'timestamp', 'id'],
+                         name='chat_msg_conversation_idx'),
+            models.Index(fields=['sender', 'timestamp', 'id'],
+                         name='chat_msg_sender_ts_idx'),
+            models.Index(fields=['receiver', 'timestamp', 'id'],
+                         name='chat_msg_receiver_ts_idx'),
+        ]
+        # Уникальный индекс (conversation, seq) обслуживает и догрузку
+        # пропущенных сообщений диапазоном seq > N.
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'],
+                                    name='chat_msg_conversation_seq_uniq'),
+        ]
 
     def __str__(self):
         return f"От {self.sender} к {self.receiver}: {self.content[:20]}"
+
+
+class MessageTerm(models.Model):
+    """
+    Инвертированный индекс поиска для баз без FTS5 (см. chat.search):
+    терм сообщения для каждого из его участников.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='+', db_index=False)
+    term = models.CharField(max_length=64)
+    message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE,
+                                related_name='+')
+    count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        # Поиск – диапазон (user, term) по этому индексу.
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'term', 'message'],
+                                    name='chat_term_user_term_msg_uniq'),
+        ]
+
+
+class ArchiveSegment(models.Model):
+    """
+    Сегмент архива сообщений (см. chat.archive): сжатый JSONL-файл с
+    сообщениями одного месяца, после записи не меняется. `path` – путь
+    относительно CHAT_ARCHIVE['DIR'].
+    """
+    path = models.CharField(max_length=255, unique=True)
+    month = models.DateField()
+    rows = models.PositiveIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_timestamp'],
+                         name='chat_archive_last_ts_idx'),
+        ]
+
+    def __str__(self):
+        return self.path
+
+
+class ArchiveSegmentMember(models.Model):
+    """
+    Участник сообщений сегмента: по нему история пользователя открывает
+    только свои сегменты.
+    """
+    segment = models.ForeignKey(ArchiveSegment, on_delete=models.CASCADE,
+                                related_name='members', db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='+', db_index=False)
+    rows = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'segment'],
+                                    name='chat_archive_member_uniq'),
+        ]
@@ -0,0 +1,306 @@
+import base64
+import binascii
+import datetime
+import heapq
+import json
+
+from django.db.models import F, Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) пагинация по паре полей, по умолчанию (timestamp, id).
+
+    Страница отдаётся от новых записей к старым. Параметры запроса:
+    - `before=<cursor>` – записи старше курсора;
+    - `after=<cursor>` – записи новее курсора;
+    - `limit=<int>` – размер страницы.
+
+    Вместо одного queryset можно передать список querysets («ветвей»):
+    каждая ветвь выбирается отдельным диапазонным сканированием индекса,
+    после чего результаты сливаются. Так запрос вида `A OR B` не превращается
+    в сортировку всей истории пользователя.
+
+    `archive` (chat.archive.ArchivedHistory) добавляет архивные записи:
+    к ним обращаются, только если горячие ветви не заполнили страницу
+    или курсор `after` лежит в архивном диапазоне.
+    """
+    cursor_fields = ('timestamp', 'id')
+    page_size = 50
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None, archive=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        before = self.decode_cursor(request.query_params.get('before'))
+        after = self.decode_cursor(request.query_params.get('after'))
+        if before is not None and after is not None:
+            raise ValidationError(
+                {"detail": "Нельзя передавать before и after одновременно."}
+            )
+        self.direction = 'after' if after is not None else 'before'
+        cursor = after if after is not None else before
+
+        branches = queryset if isinstance(queryset, (list, tuple)) \
+            else [queryset]
+        rows = self.fetch(branches, cursor)
+        if archive is not None and self.needs_archive(archive, rows, cursor):
+            rows = self.merge([rows, archive.fetch(
+                self.archive_cursor(cursor), self.direction == 'before',
+                self.limit + 1
+            )])
+
+        self.has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if self.direction == 'after':
+            rows.reverse()
+        self.page = rows
+        return rows
+
+    def paginate_window(self, request, window):
+        """
+        Страница из готовых строк: `window(cursor, limit)` возвращает до
+        limit + 1 строк старше курсора или None, если дать их не может
+        (например, кэш chat.history_cache). Поддерживается только
+        направление `before`. Возвращает None, если страницу нужно читать
+        из базы.
+        """
+        if 'after' in request.query_params:
+            return None
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.direction = 'before'
+        cursor = self.decode_cursor(request.query_params.get('before'))
+        rows = window(self.archive_cursor(cursor), self.limit)
+        if rows is None:
+            return None
+        self.has_more = len(rows) > self.limit
+        self.page = rows[:self.limit]
+        return self.page
+
+    def fetch(self, branches, cursor):
+        """
+        Выбирает до limit + 1 записей из каждой ветви и сливает их.
+        """
+        first, second = self.cursor_fields
+        descending = self.direction == 'before'
+        prefix = '-' if descending else ''
+        lookup = 'lt' if descending else 'gt'
+        results = []
+        for branch in branches:
+            if cursor is not None:
+                # Нестрогая граница по первому полю даёт индексу диапазон,
+                # а OR лишь отсекает записи с тем же значением.
+                branch = branch.filter(
+                    **{f'{first}__{lookup}e': cursor[0]}
+                ).filter(
+                    Q(**{f'{first}__{lookup}': cursor[0]}) |
+                    Q(**{f'{second}__{lookup}': cursor[1]})
+                )
+            branch = branch.order_by(f'{prefix}{first}', f'{prefix}{second}')
+            results.append(list(branch[:self.limit + 1]))
+        return self.merge(results)
+
+    def merge(self, results):
+        """
+        Сливает отсортированные результаты ветвей в одну страницу + 1.
+        """
+        if len(results) == 1:
+            return results[0]
+        descending = self.direction == 'before'
+        merged = heapq.merge(*results, key=self.row_key, reverse=descending)
+        rows = []
+        seen = set()
+        for row in merged:
+            key = self.row_key(row)
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append(row)
+            if len(rows) > self.limit:
+                break
+        return rows
+
+    def needs_archive(self, archive, rows, cursor):
+        if self.direction == 'before':
+            return len(rows) <= self.limit
+        horizon = archive.horizon
+        return horizon is not None and \
+            self.archive_cursor(cursor)[0] <= horizon
+
+    def archive_cursor(self, cursor):
+        """
+        Курсор с временем в виде datetime для сравнения с архивными строками.
+        """
+        if cursor is None:
+            return None
+        try:
+            timestamp = datetime.datetime.fromisoformat(cursor[0])
+        except (TypeError, ValueError):
+            timestamp = None
+        if timestamp is None or timestamp.tzinfo is None:
+            raise ValidationError({"detail": "Некорректный курсор."})
+        return timestamp, cursor[1]
+
+    def get_limit(self, request):
+        raw = request.query_params.get('limit')
+        if raw is None:
+            return self.page_size
+        try:
+            limit = int(raw)
+        except ValueError:
+            raise ValidationError({"detail": "limit должен быть числом."})
+        return max(1, min(limit, self.max_page_size))
+
+    def row_key(self, row):
+        if isinstance(row, dict):
+            return tuple(row[field] for field in self.cursor_fields)
+        return tuple(getattr(row, field) for field in self.cursor_fields)
+
+    def encode_cursor(self, row):
+        first, second = self.row_key(row)
+        if hasattr(first, 'isoformat'):
+            first = first.isoformat()
+        raw = json.dumps([first, second]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, value):
+        if not value:
+            return None
+        try:
+            padded = value + '=' * (-len(value) % 4)
+            first, second = json.loads(base64.urlsafe_b64decode(padded))
+        except (binascii.Error, ValueError, TypeError):
+            raise ValidationError({"detail": "Некорректный курсор."})
+        # Значения курсора уходят в фильтр ORM: неверный тип дал бы 500.
+        if not self.valid_cursor_value(first) or not is_int(second):
+            raise ValidationError({"detail": "Некорректный курсор."})
+        return first, second
+
+    def valid_cursor_value(self, value):
+        """
+        Проверяет первое поле курсора: по умолчанию время в ISO 8601 с
+        часовым поясом.
+        """
+        if not isinstance(value, str):
+            return False
+        try:
+            timestamp = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return False
+        return timestamp.tzinfo is not None
+
+    def get_paginated_response(self, data):
+        older = newer = None
+        if self.page:
+            if self.direction == 'after' or self.has_more:
+                older = self.encode_cursor(self.page[-1])
+            newer = self.encode_cursor(self.page[0])
+        return Response({
+            'before': older,
+            'after': newer,
+            'results': data,
+        })
+
+
+class RecentConversationPagination(KeysetPagination):
+    """
+    Список диалогов от недавно обновлённых к давним.
+    """
+    cursor_fields = ('last_timestamp', 'id')
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Страницы результатов поиска от лучших к худшим по (score, id).
+    Листается только вперёд: `cursor` из ответа даёт следующую страницу.
+    """
+    cursor_fields = ('score', 'id')
+    page_size = 20
+    max_page_size = 100
+
+    def valid_cursor_value(self, value):
+        return is_int(value) or isinstance(value, float)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        cursor = self.decode_cursor(request.query_params.get('cursor'))
+        rows = queryset.fetch(cursor, self.limit + 1)
+        self.has_more = len(rows) > self.limit
+        self.page = rows[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        following = None
+        if self.has_more:
+            following = self.encode_cursor(self.page[-1])
+        return Response({
+            'cursor': following,
+            'results': data,
+        })
+
+
+class RelationPagination(KeysetPagination):
+    """
+    Связи пользователя страницами в порядке `ordering`: `id` (по
+    умолчанию), `client`, `manager` (по id), `client_name`, `manager_name`
+    (по username); с `-` – по убыванию. Листается вперёд: `cursor` из
+    ответа даёт следующую страницу. Список менеджера по клиенту читается
+    уникальным индексом (manager, client), список клиента по менеджеру –
+    индексом (client, manager).
+    """
+    orderings = {
+        'id': 'id',
+        'client': 'client_id',
+        'manager': 'manager_id',
+        'client_name': 'client__username',
+        'manager_name': 'manager__username',
+    }
+    cursor_fields = ('sort_key', 'id')
+    page_size = 100
+    max_page_size = 1000
+
+    def get_ordering(self, request):
+        """
+        Поле сортировки и направление из параметра `ordering`.
+        """
+        value = request.query_params.get('ordering', 'id')
+        field = self.orderings.get(value.lstrip('-'))
+        if field is None:
+            raise ValidationError({"detail": "ordering должен быть одним из: "
+                                             + ", ".join(self.orderings)})
+        return field, value.startswith('-')
+
+    def valid_cursor_value(self, value):
+        if self.sort_field.endswith('__username'):
+            return isinstance(value, str)
+        return is_int(value)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        field, descending = self.get_ordering(request)
+        self.sort_field = field
+        self.direction = 'before' if descending else 'after'
+        # Поле сортировки попадает в строки values() для курсора.
+        queryset = queryset.annotate(sort_key=F(field))
+        cursor = self.decode_cursor(request.query_params.get('cursor'))
+        rows = self.fetch([queryset], cursor)
+        self.has_more = len(rows) > self.limit
+        self.page = rows[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        following = None
+        if self.has_more:
+            following = self.encode_cursor(self.page[-1])
+        return Response({
+            'cursor': following,
+            'results': data,
+        })
@@ -0,0 +1,276 @@
+"""
+Отложенная (write-behind) запись сообщений.
+
+Консьюмер рассылает сообщение сразу, а сохранение передаёт в очередь
+процесса. Фоновая задача сбрасывает очередь в БД через bulk_create, как
+только накопилось BATCH_SIZE сообщений или прошло FLUSH_INTERVAL_MS.
+Очередь ограничена MAX_QUEUE: при переполнении отправитель ждёт не дольше
+PUT_TIMEOUT, после чего получает WriteBehindOverflow. При остановке
+сервера очередь дописывается из ASGI lifespan (chat.lifecycle.lifespan),
+пока event loop ещё работает; без lifespan (daphne) остаток дописывается
+синхронно при завершении процесса. Ошибки записи попадают в лог.
+
+Порядковый номер сообщения нужен в кадре до записи, поэтому он выделяется
+сразу, но через SeqAllocator: номера для всех отправителей, пришедших, пока
+идёт предыдущая транзакция, выделяются одной следующей транзакцией.
+"""
+import asyncio
+import atexit
+import collections
+import logging
+
+from django.db import DatabaseError, close_old_connections
+
+from .conf import chat_setting
+from .db import db_sync_to_async
+from .services import allocate_seqs, persist_messages
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindOverflow(Exception):
+    """
+    Очередь записи переполнена и не освободилась за PUT_TIMEOUT.
+    """
+
+
+class MessageWriter:
+    def __init__(self, batch_size=200, flush_interval_ms=50,
+                 max_queue=10_000, put_timeout=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_queue = max_queue
+        self.put_timeout = put_timeout
+        self.buffer = collections.deque()
+        self.loop = None
+        self.task = None
+        self.written = 0
+        self.failed = 0
+        # Поставлено в очередь и обработано (записано или потеряно) – по
+        # ним flush ждёт свои сообщения.
+        self.queued = 0
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def ensure_started(self):
+        """
+        Запускает фоновую задачу в текущем event loop. Примитивы asyncio
+        привязаны к циклу, поэтому при смене цикла они пересоздаются.
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and self.task is not None \
+                and not self.task.done():
+            return
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.space = asyncio.Condition()
+        self.task = loop.create_task(self.run())
+
+    async def put(self, message):
+        """
+        Ставит сообщение в очередь. При переполнении ждёт освобождения места.
+        """
+        self.ensure_started()
+        if len(self.buffer) >= self.max_queue:
+            self.wakeup.set()
+            try:
+                async with self.space:
+                    await asyncio.wait_for(
+                        self.space.wait_for(
+                            lambda: len(self.buffer) < self.max_queue
+                        ),
+                        self.put_timeout,
+                    )
+            except asyncio.TimeoutError:
+                raise WriteBehindOverflow()
+        self.buffer.append(message)
+        self.queued += 1
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            while self.buffer:
+                await self.flush_batch()
+                if len(self.buffer) < self.batch_size:
+                    break
+
+    def take_batch(self):
+        batch = []
+        while self.buffer and len(batch) < self.batch_size:
+            batch.append(self.buffer.popleft())
+        return batch
+
+    async def flush_batch(self):
+        batch = self.take_batch()
+        if not batch:
+            return
+        try:
+            await db_sync_to_async(self.write, write=True)(batch)
+        finally:
+            self.flushed += len(batch)
+            async with self.space:
+                self.space.notify_all()
+
+    def write(self, batch):
+        """
+        Записывает пачку. Если пачка целиком не прошла (например, получатель
+        удалён), сообщения пишутся по одному, а битые отбрасываются в лог.
+        """
+        try:
+            persist_messages(batch)
+            self.written += len(batch)
+            return
+        except DatabaseError:
+            logger.exception('Не удалось записать пачку из %s сообщений',
+                             len(batch))
+        for message in batch:
+            try:
+                persist_messages([message])
+                self.written += 1
+            except DatabaseError:
+                self.failed += 1
+                logger.exception('Сообщение %s потеряно', message.uid)
+
+    async def drain(self):
+        """
+        Дописывает всё, что осталось в очереди.
+        """
+        while self.buffer:
+            await self.flush_batch()
+
+    async def flush(self):
+        """
+        Ждёт записи всех сообщений, поставленных в очередь до вызова,
+        включая пачку, которую уже пишет фоновая задача.
+        """
+        target = self.queued
+        if self.flushed >= target:
+            return
+        self.ensure_started()
+        await self.drain()
+        async with self.space:
+            await self.space.wait_for(lambda: self.flushed >= target)
+
+    async def close(self):
+        """
+        Дописывает очередь, включая пачку в записи, и останавливает
+        фоновую задачу.
+        """
+        await self.flush()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def drain_sync(self):
+        """
+        Синхронный сброс очереди при завершении процесса.
+        """
+        if not self.buffer:
+            return
+        close_old_connections()
+        while self.buffer:
+            batch = self.take_batch()
+            try:
+                self.write(batch)
+            except Exception:
+                lost = len(batch) + len(self.buffer)
+                self.failed += lost
+                logger.exception('При завершении процесса потеряно %s '
+                                 'сообщений', lost)
+                self.buffer.clear()
+                return
+            finally:
+                self.flushed += len(batch)
+
+
+class SeqAllocator:
+    """
+    Групповое выделение порядковых номеров сообщений.
+    """
+    def __init__(self):
+        self.pending = []
+        self.loop = None
+        self.task = None
+
+    async def allocate(self, manager_id, client_id):
+        """
+        Возвращает (conversation_id, seq) для следующего сообщения диалога.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((int(manager_id), int(client_id)), future))
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.task = loop.create_task(self.run())
+        return await future
+
+    async def run(self):
+        while self.pending:
+            batch, self.pending = self.pending, []
+            counts = collections.Counter(pair for pair, _ in batch)
+            try:
+                allocated = await db_sync_to_async(allocate_seqs,
+                                                   write=True)(counts)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            offsets = collections.Counter()
+            for pair, future in batch:
+                conversation_id, first_seq = allocated[pair]
+                # Номер отменённого отправителя пропадает: в диалоге будет
+                # пропуск, но не повтор.
+                if not future.done():
+                    future.set_result((conversation_id,
+                                       first_seq + offsets[pair]))
+                offsets[pair] += 1
+
+
+_writer = None
+_allocator = None
+
+
+def get_writer():
+    """
+    Возвращает писатель процесса, создавая его по настройкам
+    CHAT_WRITE_BEHIND.
+    """
+    global _writer
+    if _writer is None:
+        config = chat_setting('CHAT_WRITE_BEHIND')
+        _writer = MessageWriter(
+            batch_size=config['BATCH_SIZE'],
+            flush_interval_ms=config['FLUSH_INTERVAL_MS'],
+            max_queue=config['MAX_QUEUE'],
+            put_timeout=config['PUT_TIMEOUT'],
+        )
+        atexit.register(_writer.drain_sync)
+    return _writer
+
+
+async def close_writer():
+    """
+    Дописывает очередь писателя процесса, если он создан.
+    """
+    if _writer is not None:
+        await _writer.close()
+
+
+def get_allocator():
+    global _allocator
+    if _allocator is None:
+        _allocator = SeqAllocator()
+    return _allocator
+
+
+def write_behind_enabled():
+    return chat_setting('CHAT_WRITE_BEHIND')['ENABLED']
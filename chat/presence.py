@@ -0,0 +1,163 @@
+"""
+Присутствие участников в диалогах и индикатор набора текста.
+
+Присутствие хранится только в channel layer или памяти процесса, в SQL оно
+не пишется. Запись – соединение (user_id, channel_name) со сроком истечения
+TTL: соединение продлевает её входящими кадрами и кадрами heartbeat, но
+не чаще раза в HEARTBEAT_INTERVAL секунд. Запись упавшего процесса просто
+истекает. Кто онлайн в диалоге – одно чтение одного ключа диалога.
+
+С RedisChannelLayer записи лежат в хеше `<prefix>:presence:<conversation>`
+в Redis слоя и общие для всех процессов, иначе – в памяти процесса
+(`local_presence`), см. CHAT_PRESENCE['STORE'].
+
+События набора текста не хранятся: `TypingThrottle` соединения пропускает
+в группу комнаты не больше одного события «печатает» за TYPING_INTERVAL
+секунд на диалог и «перестал» – только если «печатает» было отправлено.
+"""
+import logging
+import time
+
+from .conf import chat_setting
+from .metrics import counter
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # pragma: no cover
+    RedisChannelLayer = None
+
+logger = logging.getLogger(__name__)
+
+updates = counter('chat_presence_updates_total',
+                  'Записи присутствия в хранилище.')
+typing_frames = counter('chat_typing_frames_total',
+                        'Входящие кадры набора текста.')
+typing_events = counter('chat_typing_events_total',
+                        'События набора текста, разосланные в комнаты.')
+
+
+def presence_config():
+    return chat_setting('CHAT_PRESENCE')
+
+
+class LocalPresenceStore:
+    """
+    Присутствие в памяти процесса: для одного процесса и
+    InMemoryChannelLayer.
+    """
+    def __init__(self):
+        self.conversations = {}
+
+    async def touch(self, conversation, user_id, channel, ttl):
+        members = self.conversations.setdefault(conversation, {})
+        members[(user_id, channel)] = time.monotonic() + ttl
+        updates.inc()
+
+    async def remove(self, conversation, user_id, channel):
+        members = self.conversations.get(conversation)
+        if members is None:
+            return
+        members.pop((user_id, channel), None)
+        if not members:
+            del self.conversations[conversation]
+
+    async def online(self, conversation):
+        members = self.conversations.get(conversation)
+        if not members:
+            return []
+        now = time.monotonic()
+        for key in [key for key, expires in members.items()
+                    if expires <= now]:
+            del members[key]
+        return sorted({user_id for user_id, _ in members})
+
+    def clear(self):
+        self.conversations.clear()
+
+
+class RedisPresenceStore:
+    """
+    Присутствие в Redis channel layer: хеш на диалог, поле
+    `<user_id>:<channel_name>` со временем истечения. Сам ключ истекает
+    вместе с последней записью.
+    """
+    def __init__(self, layer):
+        self.layer = layer
+
+    def key(self, conversation):
+        return f'{self.layer.prefix}:presence:{conversation}'
+
+    def connection(self, key):
+        return self.layer.connection(self.layer.consistent_hash(key))
+
+    async def touch(self, conversation, user_id, channel, ttl):
+        key = self.key(conversation)
+        async with self.connection(key).pipeline(transaction=False) as pipe:
+            pipe.hset(key, f'{user_id}:{channel}', time.time() + ttl)
+            pipe.expire(key, int(ttl) + 1)
+            await pipe.execute()
+        updates.inc()
+
+    async def remove(self, conversation, user_id, channel):
+        key = self.key(conversation)
+        await self.connection(key).hdel(key, f'{user_id}:{channel}')
+
+    async def online(self, conversation):
+        key = self.key(conversation)
+        connection = self.connection(key)
+        members = await connection.hgetall(key)
+        now = time.time()
+        expired = [field for field, expires in members.items()
+                   if float(expires) <= now]
+        if expired:
+            await connection.hdel(key, *expired)
+        return sorted({int(field.split(b':', 1)[0])
+                       for field, expires in members.items()
+                       if float(expires) > now})
+
+
+local_presence = LocalPresenceStore()
+
+
+def get_presence_store(layer):
+    """
+    Хранилище по CHAT_PRESENCE['STORE']: 'redis', 'local' или 'auto' –
+    Redis, если слой – RedisChannelLayer.
+    """
+    store = presence_config()['STORE']
+    if store == 'redis' or store == 'auto' and RedisChannelLayer is not None \
+            and isinstance(layer, RedisChannelLayer):
+        return RedisPresenceStore(layer)
+    return local_presence
+
+
+class TypingThrottle:
+    """
+    Сводит поток кадров набора текста одного соединения к редким событиям.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.announced = {}
+
+    def allow(self, conversation, active, now=None):
+        """
+        Нужно ли разослать событие: «печатает» – не чаще раза в interval,
+        «перестал» – только после отправленного «печатает».
+        """
+        now = time.monotonic() if now is None else now
+        last = self.announced.get(conversation)
+        if active:
+            if last is not None and now - last < self.interval:
+                return False
+            self.announced[conversation] = now
+            return True
+        if last is None:
+            return False
+        del self.announced[conversation]
+        return True
+
+    def reset(self, conversation):
+        """
+        Сообщение отправлено: клиенты сами гасят индикатор.
+        """
+        self.announced.pop(conversation, None)
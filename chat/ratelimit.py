@@ -0,0 +1,137 @@
+"""
+Ограничение частоты входящих кадров WebSocket (token bucket).
+
+Каждое соединение получает свою корзину в памяти консьюмера, каждый
+пользователь – общую для всех его соединений в процессе. При
+`CHAT_RATE_LIMIT['SHARED'] = True` и RedisChannelLayer корзина пользователя
+хранится в Redis слоя и общая для всех процессов; если Redis недоступен,
+используется локальная корзина.
+"""
+import collections
+import logging
+import threading
+import time
+
+from .conf import chat_setting
+from .metrics import counter
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # pragma: no cover
+    RedisChannelLayer = None
+
+logger = logging.getLogger(__name__)
+
+limited = counter('chat_rate_limited_frames_total',
+                  'Входящие кадры, отклонённые ограничением частоты.')
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now=None):
+        """
+        Забирает один токен. Возвращает 0, если токен был, иначе – через
+        сколько секунд он появится.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class UserBuckets:
+    """
+    Корзины пользователей процесса, ограниченные по количеству (LRU).
+    """
+    def __init__(self, max_size=100_000):
+        self.max_size = max_size
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, user_id, rate, burst):
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = self.buckets[user_id] = TokenBucket(rate, burst)
+                if len(self.buckets) > self.max_size:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(user_id)
+            return bucket.take()
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisBuckets:
+    """
+    Корзины пользователей в Redis channel layer: одна Lua-операция на кадр.
+    """
+    take_lua = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    async def take(self, user_id, rate, burst):
+        key = f'{self.layer.prefix}:ratelimit:user:{user_id}'
+        connection = self.layer.connection(self.layer.consistent_hash(key))
+        wait = await connection.eval(self.take_lua, 1, key, rate, burst,
+                                     time.time())
+        return float(wait)
+
+
+user_buckets = UserBuckets()
+
+
+def rate_limit_config():
+    return chat_setting('CHAT_RATE_LIMIT')
+
+
+async def check_frame(connection_bucket, layer, user_id):
+    """
+    Проверяет кадр по корзине соединения и корзине пользователя.
+    Возвращает 0, если кадр можно обработать, иначе – через сколько секунд
+    повторить.
+    """
+    config = rate_limit_config()
+    wait = connection_bucket.take()
+    if wait or user_id is None:
+        return wait
+    rate, burst = config['USER_RATE'], config['USER_BURST']
+    if config['SHARED'] and RedisChannelLayer is not None \
+            and isinstance(layer, RedisChannelLayer):
+        try:
+            return await RedisBuckets(layer).take(user_id, rate, burst)
+        except Exception:
+            logger.exception('Лимит пользователя %s проверен локально',
+                             user_id)
+    return user_buckets.take(user_id, rate, burst)
@@ -0,0 +1,206 @@
+"""
+Отметки доставки и прочтения.
+
+Клиент подтверждает кадром ack, что получил или прочитал сообщения диалога
+до номера `seq` (или до сообщения `message_id`). Подтверждения не пишутся
+по одному: буфер процесса сводит их в наибольшие отметки на пару (диалог,
+пользователь) и раз в FLUSH_INTERVAL_MS или по BATCH_SIZE отметок
+записывает все сразу через services.apply_receipts – число запросов не
+зависит от числа подтверждений. Если запись не удалась, отметки
+возвращаются в буфер (с новыми подтверждениями остаётся наибольшая) и
+пишутся при следующем сбросе. Отметки хранятся в Conversation, поэтому
+список сообщений узнаёт их одним запросом на страницу.
+
+После записи собеседник получает в группу уведомлений один кадр на сброс
+со всеми изменившимися отметками:
+
+    {"receipts": [{"conversation": "2_3", "user_id": 3,
+                   "delivered": 42, "read": 40}]}
+"""
+import asyncio
+import atexit
+import collections
+import logging
+
+from django.db import DatabaseError, close_old_connections
+
+from . import codec
+from .conf import chat_setting
+from .db import db_sync_to_async
+from .fanout import fan_out
+from .metrics import counter, histogram
+from .services import apply_receipts
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('delivered', 'read')
+
+acks = counter('chat_receipt_acks_total',
+               'Подтверждения доставки и прочтения от клиентов.')
+flushes = counter('chat_receipt_flushes_total',
+                  'Сбросы буфера отметок в базу.')
+flush_seconds = histogram('chat_receipt_flush_seconds',
+                          'Запись пачки отметок доставки и прочтения.')
+
+
+def receipt_frames(states):
+    """
+    Кадры для собеседников: {user_id: text} с изменившимися отметками.
+    """
+    by_user = collections.defaultdict(list)
+    for state in states:
+        if not state['changed']:
+            continue
+        manager_id, client_id = state['manager_id'], state['client_id']
+        counterpart = client_id if state['user_id'] == manager_id \
+            else manager_id
+        by_user[counterpart].append({
+            'conversation': f'{manager_id}_{client_id}',
+            'user_id': state['user_id'],
+            'delivered': state['delivered'],
+            'read': state['read'],
+        })
+    return {user_id: codec.dumps({'receipts': items})
+            for user_id, items in by_user.items()}
+
+
+async def announce(layer, states):
+    """
+    Рассылает изменившиеся отметки одной пачкой через fan_out.
+    """
+    # Имена групп задаёт модуль консьюмеров, который сам импортирует этот.
+    from .consumers import notifications_group_name
+
+    sends = [(notifications_group_name(user_id),
+              {'type': 'chat_receipts', 'text': text})
+             for user_id, text in receipt_frames(states).items()]
+    if sends:
+        await fan_out(layer, sends)
+
+
+def merge(target, marks):
+    """
+    Сливает отметки {key: {kind: value}} в `target`, оставляя наибольшие.
+    """
+    for key, kinds in marks.items():
+        current = target.setdefault(key, {})
+        for kind, value in kinds.items():
+            if value > current.get(kind, 0):
+                current[kind] = value
+
+
+class ReceiptBuffer:
+    def __init__(self, batch_size=500, flush_interval_ms=200):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.marks = {}
+        self.message_ids = {}
+        self.layer = None
+        self.loop = None
+        self.task = None
+
+    def __len__(self):
+        return len(self.marks) + len(self.message_ids)
+
+    def ensure_started(self):
+        """
+        Запускает фоновую задачу в текущем event loop (см.
+        MessageWriter.ensure_started).
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and self.task is not None \
+                and not self.task.done():
+            return
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self.run())
+
+    def add(self, layer, manager_id, client_id, user_id, kind, seq=None,
+            message_id=None):
+        """
+        Учитывает подтверждение `kind` ('delivered' или 'read') до номера
+        `seq` или до сообщения `message_id`. Запись – при следующем сбросе.
+        """
+        acks.inc()
+        self.ensure_started()
+        self.layer = layer
+        key = (int(manager_id), int(client_id), user_id)
+        if seq is not None:
+            target, value = self.marks, seq
+        else:
+            target, value = self.message_ids, message_id
+        merge(target, {key: {kind: value}})
+        if len(self) >= self.batch_size:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def take(self):
+        marks, message_ids = self.marks, self.message_ids
+        self.marks, self.message_ids = {}, {}
+        return marks, message_ids
+
+    def apply(self, marks, message_ids):
+        return apply_receipts(marks, message_ids)
+
+    def restore(self, marks, message_ids):
+        """
+        Возвращает в буфер отметки неудавшегося сброса.
+        """
+        merge(self.marks, marks)
+        merge(self.message_ids, message_ids)
+
+    async def flush(self):
+        marks, message_ids = self.take()
+        if not marks and not message_ids:
+            return
+        flushes.inc()
+        try:
+            with flush_seconds.time():
+                states = await db_sync_to_async(self.apply, write=True)(
+                    marks, message_ids
+                )
+        except DatabaseError:
+            logger.exception('Не удалось записать %s отметок, повтор при '
+                             'следующем сбросе', len(marks) + len(message_ids))
+            self.restore(marks, message_ids)
+            return
+        try:
+            await announce(self.layer, states)
+        except Exception:
+            logger.exception('Не удалось разослать отметки')
+
+    def drain_sync(self):
+        """
+        Синхронный сброс при завершении процесса; рассылки уже не будет.
+        """
+        if not len(self):
+            return
+        close_old_connections()
+        self.apply(*self.take())
+
+
+_buffer = None
+
+
+def get_receipt_buffer():
+    """
+    Возвращает буфер отметок процесса, создавая его по настройкам
+    CHAT_RECEIPTS.
+    """
+    global _buffer
+    if _buffer is None:
+        config = chat_setting('CHAT_RECEIPTS')
+        _buffer = ReceiptBuffer(
+            batch_size=config['BATCH_SIZE'],
+            flush_interval_ms=config['FLUSH_INTERVAL_MS'],
+        )
+        atexit.register(_buffer.drain_sync)
+    return _buffer
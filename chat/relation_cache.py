@@ -0,0 +1,201 @@
+"""
+Кэш проверки доступа к чату: существует ли ChatRelation для пары
+(manager_id, client_id).
+
+Кэш живёт в памяти процесса, ограничен по размеру (LRU) и по времени
+жизни записи. Изменения ChatRelation сбрасывают затронутые записи через
+сигналы (см. chat.signals).
+
+Чтобы отзыв доступа сразу действовал и в других процессах, инвалидация
+записывает новую версию пары или всех пар менеджера в общий кэш Django
+(CHAT_RELATION_CACHE['CACHE']). Запись хранит версии, прочитанные до
+запроса к БД, и отдаётся, только пока они совпадают с текущими. Общий
+кэш должен быть общим для процессов (Redis, Memcached): с locmem
+инвалидация видна только своему процессу, а остальные ждут TTL.
+"""
+import collections
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from .conf import chat_setting
+from .db import db_sync_to_async
+from .metrics import counter
+
+hits = counter('chat_relation_cache_hits_total',
+               'Проверки доступа, обслуженные из кэша.')
+misses = counter('chat_relation_cache_misses_total',
+                 'Проверки доступа, потребовавшие запрос к БД.')
+
+
+def manager_version_key(manager_id):
+    return f'chat:relation:v:{int(manager_id)}'
+
+
+def pair_version_key(manager_id, client_id):
+    return f'chat:relation:v:{int(manager_id)}_{int(client_id)}'
+
+
+class RelationCache:
+    def __init__(self, max_size=10_000, ttl=60.0, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Псевдоним кэша Django с версиями или None – без общих версий.
+        self.store = store
+        self.entries = collections.OrderedDict()
+        # Увеличивается при каждой инвалидации: значение, прочитанное из БД
+        # до инвалидации, не должно попасть в кэш после неё.
+        self.generation = 0
+        # Инвалидация приходит из потоков синхронных view, чтение – из
+        # event loop консьюмеров.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def shared(self):
+        return caches[self.store] if self.store else None
+
+    def versions(self, manager_id, client_id):
+        """
+        Текущие версии пары в общем кэше: (менеджера, пары).
+        """
+        shared = self.shared()
+        if shared is None:
+            return ()
+        keys = (manager_version_key(manager_id),
+                pair_version_key(manager_id, client_id))
+        values = shared.get_many(keys)
+        return tuple(values.get(key) for key in keys)
+
+    async def aversions(self, manager_id, client_id):
+        """
+        versions() для event loop: сетевой кэш читается в пуле chat.db,
+        чтобы не блокировать цикл.
+        """
+        if isinstance(self.shared(), (type(None), LocMemCache, DummyCache)):
+            return self.versions(manager_id, client_id)
+        return await db_sync_to_async(self.versions)(manager_id, client_id)
+
+    def bump(self, keys):
+        shared = self.shared()
+        if shared is None or not keys:
+            return
+        # Версия живёт дольше записи: запись, сохранённая до инвалидации,
+        # истекает раньше, чем исчезнет её новая версия.
+        version = uuid.uuid4().hex
+        shared.set_many(dict.fromkeys(keys, version), self.ttl * 2 + 1)
+
+    def get(self, manager_id, client_id, versions=None):
+        """
+        Возвращает закэшированный ответ или None, если его нет или версии
+        в общем кэше сменились. `versions` – результат versions(), без
+        него версии читаются сейчас.
+        """
+        if versions is None:
+            versions = self.versions(manager_id, client_id)
+        key = (int(manager_id), int(client_id))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic() or \
+                    entry[2] != versions:
+                if entry is not None:
+                    del self.entries[key]
+                misses.inc()
+                return None
+            self.entries.move_to_end(key)
+        hits.inc()
+        return entry[0]
+
+    def set(self, manager_id, client_id, exists, generation=None,
+            versions=None):
+        """
+        `generation` и `versions` прочитаны до запроса к БД: если с тех
+        пор была инвалидация, значение не кэшируется или не совпадёт с
+        новыми версиями.
+        """
+        if versions is None:
+            versions = self.versions(manager_id, client_id)
+        key = (int(manager_id), int(client_id))
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (exists, time.monotonic() + self.ttl,
+                                 versions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, manager_id, client_id=None):
+        """
+        Сбрасывает пару, а без client_id – все пары менеджера.
+        """
+        manager_id = int(manager_id)
+        with self.lock:
+            self.generation += 1
+            if client_id is not None:
+                self.entries.pop((manager_id, int(client_id)), None)
+            else:
+                for key in [key for key in self.entries
+                            if key[0] == manager_id]:
+                    del self.entries[key]
+        self.bump([manager_version_key(manager_id) if client_id is None
+                   else pair_version_key(manager_id, client_id)])
+
+    def invalidate_pairs(self, pairs):
+        """
+        Сбрасывает пары (manager_id, client_id) под одной блокировкой.
+        """
+        pairs = [(int(manager_id), int(client_id))
+                 for manager_id, client_id in pairs]
+        with self.lock:
+            self.generation += 1
+            for pair in pairs:
+                self.entries.pop(pair, None)
+        self.bump([pair_version_key(*pair) for pair in pairs])
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def hit_rate(self):
+        total = hits.value + misses.value
+        return hits.value / total if total else 0.0
+
+
+def _build():
+    config = chat_setting('CHAT_RELATION_CACHE')
+    return RelationCache(max_size=config['MAX_SIZE'], ttl=config['TTL'],
+                         store=config['CACHE'])
+
+
+relation_cache = _build()
+
+
+def invalidate_on_commit(pairs, managers=()):
+    """
+    Сбрасывает пары и все пары менеджеров `managers` сейчас и ещё раз
+    после коммита, чтобы в кэш не вернулось значение, прочитанное до
+    фиксации транзакции. Для массовых изменений связей, которые не шлют
+    сигналов. Новые версии уходят в общий кэш, так что сброс видят и
+    другие процессы.
+    """
+    pairs, managers = list(pairs), list(managers)
+
+    def invalidate():
+        relation_cache.invalidate_pairs(pairs)
+        for manager_id in managers:
+            relation_cache.invalidate(manager_id)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def relation_cache_enabled():
+    return chat_setting('CHAT_RELATION_CACHE')['ENABLED']
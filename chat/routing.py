@@ -4,4 +4,5 @@ from . import consumers
 websocket_urlpatterns = [
     path('ws/chat/<int:manager_id>/<int:client_id>/',
          consumers.ChatConsumer.as_asgi()),
+    path('ws/chat/', consumers.UserChatConsumer.as_asgi()),
 ]
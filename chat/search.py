@@ -0,0 +1,223 @@
+"""
+Полнотекстовый поиск по сообщениям.
+
+На SQLite с FTS5 сообщения индексирует виртуальная таблица
+`chat_message_fts` (миграция 0006): триггеры на chat_chatmessage обновляют
+её при любой вставке, изменении и удалении, включая bulk_create. Таблица
+contentless – текст хранится только в chat_chatmessage, в индексе лежат
+термы и участники (`u<sender_id> u<receiver_id>`), поэтому ограничение
+«только диалоги пользователя» – пересечение списков внутри FTS5.
+
+Без FTS5 (или при `CHAT_SEARCH['BACKEND'] = 'index'`) используется
+инвертированный индекс MessageTerm: строка на (участник, терм, сообщение),
+которую пишет `index_messages` при сохранении сообщения.
+
+Результаты упорядочены по убыванию `score` (для FTS5 – bm25 со знаком
+минус, для MessageTerm – сколько раз термы встретились), при равенстве –
+от новых сообщений к старым. FTS5 ранжирует только MAX_CANDIDATES самых
+новых совпадений: их индекс отдаёт по убыванию rowid без сортировки, и
+запрос из частых слов не считает bm25 по всей истории. Когда окно
+кандидатов исчерпано, более старые совпадения идут за ним от новых к
+старым (keyset по rowid). Курсор (score, id) остаётся прежним: id старше
+границы окна означает, что листание уже за окном.
+"""
+import re
+import unicodedata
+
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+
+from .conf import chat_setting
+from .models import ChatMessage, MessageTerm
+
+FTS_TABLE = 'chat_message_fts'
+TERM_MAX_LENGTH = 64
+
+_fts_available = None
+
+
+def tokenize(text):
+    """
+    Термы текста: слова в нижнем регистре без диакритики, как их режет
+    токенизатор unicode61 (remove_diacritics 2).
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return [term[:TERM_MAX_LENGTH] for term in re.findall(r'[^\W_]+', text)]
+
+
+def fts_available():
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = connection.vendor == 'sqlite' and \
+            FTS_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def search_backend():
+    """
+    'fts5' или 'index' в зависимости от CHAT_SEARCH['BACKEND'] и базы.
+    """
+    backend = chat_setting('CHAT_SEARCH')['BACKEND']
+    if backend == 'auto':
+        return 'fts5' if fts_available() else 'index'
+    return backend
+
+
+def index_messages(messages):
+    """
+    Добавляет сообщения в MessageTerm. Для FTS5 ничего не делает: индекс
+    обновляют триггеры.
+    """
+    if search_backend() != 'index':
+        return
+    terms = []
+    for message in messages:
+        counts = {}
+        for term in tokenize(message.content):
+            counts[term] = counts.get(term, 0) + 1
+        for user_id in {message.sender_id, message.receiver_id}:
+            terms.extend(
+                MessageTerm(user_id=user_id, term=term, message_id=message.pk,
+                            count=count)
+                for term, count in counts.items()
+            )
+    MessageTerm.objects.bulk_create(terms, batch_size=1000,
+                                    ignore_conflicts=True)
+
+
+def reindex_message(message):
+    if search_backend() != 'index':
+        return
+    with transaction.atomic():
+        MessageTerm.objects.filter(message_id=message.pk).delete()
+        index_messages([message])
+
+
+def rebuild_index(batch_size=5000):
+    """
+    Заново строит индекс активного бэкенда по всей таблице сообщений.
+    Возвращает число проиндексированных сообщений.
+    """
+    if search_backend() == 'fts5':
+        table = ChatMessage._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')"
+            )
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, content, participants) "
+                f"SELECT id, content, 'u' || sender_id || ' u' || receiver_id "
+                f"FROM {table}"
+            )
+            return cursor.rowcount
+    MessageTerm.objects.all().delete()
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = list(ChatMessage.objects.filter(pk__gt=last_id).order_by('pk')
+                     .only('pk', 'sender_id', 'receiver_id', 'content')
+                     [:batch_size])
+        if not batch:
+            return indexed
+        with transaction.atomic():
+            index_messages(batch)
+        indexed += len(batch)
+        last_id = batch[-1].pk
+
+
+class MessageSearch:
+    """
+    Поиск сообщений пользователя `user` (при `counterpart` – только
+    переписки с ним) по всем термам строки `query`.
+    """
+    def __init__(self, query, user, counterpart=None, fields=('id',)):
+        self.terms = list(dict.fromkeys(tokenize(query)))
+        self.user_id = user.pk
+        self.counterpart_id = counterpart
+        self.fields = fields
+
+    def fetch(self, cursor, limit):
+        """
+        До `limit` строк после курсора (score, id), лучшие первыми. Строки –
+        словари полей сообщения `fields` плюс `score`.
+        """
+        if not self.terms:
+            return []
+        if search_backend() == 'fts5':
+            ranked = self.fts_ranked(cursor, limit)
+        else:
+            ranked = self.index_ranked(cursor, limit)
+        rows = ChatMessage.objects.filter(
+            pk__in=[pk for pk, _ in ranked]
+        ).values('id', *self.fields)
+        rows = {row['id']: row for row in rows}
+        return [{**rows[pk], 'score': score} for pk, score in ranked
+                if pk in rows]
+
+    def fts_ranked(self, cursor, limit):
+        content = ' '.join(f'"{term}"' for term in self.terms)
+        match = f'content : ({content}) AND participants : "u{self.user_id}"'
+        if self.counterpart_id is not None:
+            match += f' AND participants : "u{self.counterpart_id}"'
+        with connection.cursor() as db_cursor:
+            # Граница окна – rowid самого старого из MAX_CANDIDATES новых
+            # совпадений; None – все совпадения в окне.
+            db_cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'ORDER BY rowid DESC LIMIT 1 OFFSET %s',
+                [match, chat_setting('CHAT_SEARCH')['MAX_CANDIDATES'] - 1]
+            )
+            row = db_cursor.fetchone()
+            boundary = row[0] if row else None
+            in_window = cursor is None or boundary is None or \
+                cursor[1] >= boundary
+
+            ranked = []
+            if in_window:
+                sql = (
+                    f'SELECT id, score FROM ('
+                    f'SELECT rowid AS id, -bm25({FTS_TABLE}, 1.0, 0.0) '
+                    f'AS score FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                    f'AND rowid >= %s)'
+                )
+                params = [match, boundary or 0]
+                if cursor is not None:
+                    sql += ' WHERE score < %s OR (score = %s AND id < %s)'
+                    params += [cursor[0], cursor[0], cursor[1]]
+                sql += ' ORDER BY score DESC, id DESC LIMIT %s'
+                params.append(limit)
+                db_cursor.execute(sql, params)
+                ranked = db_cursor.fetchall()
+            if boundary is None or len(ranked) >= limit:
+                return ranked
+
+            db_cursor.execute(
+                f'SELECT rowid, -bm25({FTS_TABLE}, 1.0, 0.0) '
+                f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid < %s '
+                f'ORDER BY rowid DESC LIMIT %s',
+                [match, boundary if in_window else cursor[1],
+                 limit - len(ranked)]
+            )
+            return ranked + db_cursor.fetchall()
+
+    def index_ranked(self, cursor, limit):
+        rows = MessageTerm.objects.filter(
+            user_id=self.user_id, term__in=self.terms
+        )
+        if self.counterpart_id is not None:
+            rows = rows.filter(
+                Q(message__sender_id=self.counterpart_id) |
+                Q(message__receiver_id=self.counterpart_id)
+            )
+        rows = rows.values('message_id').annotate(
+            matched=Count('term'), score=Sum('count')
+        ).filter(matched=len(self.terms))
+        if cursor is not None:
+            rows = rows.filter(
+                Q(score__lt=cursor[0]) |
+                Q(score=cursor[0], message_id__lt=cursor[1])
+            )
+        return list(rows.order_by('-score', '-message_id').values_list(
+            'message_id', 'score'
+        )[:limit])
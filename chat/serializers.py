@@ -1,6 +1,23 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import ChatMessage, ChatRelation
+from .models import ChatMessage, ChatRelation, Conversation
+
+
+def receipt_state(seq, receiver_id, marks):
+    """
+    (delivered, read) сообщения по отметкам стороны получателя. `marks` –
+    строка Conversation или None для сообщений без диалога.
+    """
+    if marks is None or seq is None:
+        return False, False
+    side = 'manager' if receiver_id == marks['manager_id'] else 'client'
+    return (seq <= marks[f'{side}_delivered_seq'],
+            seq <= marks[f'{side}_read_seq'])
+
+
+RECEIPT_VALUES = ('id', 'manager_id', 'manager_delivered_seq',
+                  'manager_read_seq', 'client_delivered_seq',
+                  'client_read_seq')
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -12,10 +29,26 @@ class UserSerializer(serializers.ModelSerializer):
 class ChatMessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     receiver = UserSerializer(read_only=True)
+    delivered = serializers.SerializerMethodField()
+    read = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatMessage
-        fields = ['id', 'sender', 'receiver', 'content', 'timestamp']
+        fields = ['id', 'sender', 'receiver', 'content', 'timestamp', 'seq',
+                  'delivered', 'read']
+
+    def get_receipt(self, obj):
+        conversation = obj.conversation
+        marks = None if conversation is None else {
+            field: getattr(conversation, field) for field in RECEIPT_VALUES
+        }
+        return receipt_state(obj.seq, obj.receiver_id, marks)
+
+    def get_delivered(self, obj):
+        return self.get_receipt(obj)[0]
+
+    def get_read(self, obj):
+        return self.get_receipt(obj)[1]
 
 
 class ChatRelationSerializer(serializers.ModelSerializer):
@@ -30,3 +63,155 @@ class ChatRelationSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatRelation
         fields = ['id', 'manager', 'client', 'client_id']
+
+    def validate_client_id(self, client):
+        if self.instance is not None and ChatRelation.objects.filter(
+            manager_id=self.instance.manager_id, client=client
+        ).exclude(pk=self.instance.pk).exists():
+            raise serializers.ValidationError('Связь уже существует.')
+        return client
+
+
+class ValuesSerializer:
+    """
+    Быстрая сериализация строк `queryset.values()` для списков.
+
+    Вместо вложенного `UserSerializer` на каждое поле каждой строки
+    пользователи страницы выбираются одним запросом (`user_fields`
+    перечисляет поля с id пользователя) и подставляются готовыми словарями.
+    Формат ответа совпадает с соответствующим ModelSerializer.
+    """
+    values_fields = ()
+    user_fields = ()
+    datetime_fields = ()
+    # Выбираются, но в ответ не попадают.
+    hidden_fields = ()
+
+    user_values = ('id', 'username', 'is_staff', 'email')
+    datetime_field = serializers.DateTimeField()
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def get_users(self):
+        ids = {row[f'{field}_id'] for row in self.rows
+               for field in self.user_fields}
+        if not ids:
+            return {}
+        return {
+            user['id']: user for user in
+            User.objects.filter(id__in=ids).values(*self.user_values)
+        }
+
+    @property
+    def data(self):
+        users = self.get_users()
+        plan = []
+        for field in self.values_fields:
+            if field in self.hidden_fields:
+                continue
+            if field.endswith('_id') and field[:-3] in self.user_fields:
+                plan.append((field[:-3], field, users.get))
+            elif field in self.datetime_fields:
+                plan.append((field, field,
+                             self.datetime_field.to_representation))
+            else:
+                plan.append((field, field, None))
+        return [
+            {key: convert(row[source]) if convert else row[source]
+             for key, source, convert in plan}
+            for row in self.rows
+        ]
+
+
+class FastChatMessageSerializer(ValuesSerializer):
+    """
+    Сообщения страницы с отметками доставки и прочтения: отметки диалогов
+    страницы выбираются одним запросом, без join на каждую строку.
+    """
+    values_fields = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp',
+                     'seq', 'conversation_id')
+    user_fields = ('sender', 'receiver')
+    datetime_fields = ('timestamp',)
+    hidden_fields = ('conversation_id',)
+
+    def __init__(self, rows, users=None, receipts=None):
+        """
+        `users` и `receipts` – уже выбранные пользователи и отметки
+        диалогов (например, из chat.history_cache), без них они читаются
+        из базы.
+        """
+        super().__init__(rows)
+        self.users = users
+        self.receipts = receipts
+
+    def get_users(self):
+        if self.users is not None:
+            return self.users
+        return super().get_users()
+
+    def get_receipts(self):
+        if self.receipts is not None:
+            return self.receipts
+        ids = {row['conversation_id'] for row in self.rows
+               if row['conversation_id'] is not None}
+        if not ids:
+            return {}
+        return {
+            marks['id']: marks for marks in
+            Conversation.objects.filter(id__in=ids).values(*RECEIPT_VALUES)
+        }
+
+    @property
+    def data(self):
+        items = super().data
+        receipts = self.get_receipts()
+        for item, row in zip(items, self.rows):
+            item['delivered'], item['read'] = receipt_state(
+                row['seq'], row['receiver_id'],
+                receipts.get(row['conversation_id'])
+            )
+        return items
+
+
+class FastChatRelationSerializer(ValuesSerializer):
+    values_fields = ('id', 'manager_id', 'client_id')
+    user_fields = ('manager', 'client')
+
+
+class ConversationSerializer(ValuesSerializer):
+    """
+    Элемент списка диалогов: собеседники, последнее сообщение и
+    непрочитанные у запрашивающего пользователя.
+    """
+    values_fields = ('id', 'manager_id', 'client_id', 'last_seq',
+                     'last_timestamp', 'manager_unread', 'client_unread',
+                     'last_message_id', 'last_message__sender_id',
+                     'last_message__content', 'last_message__seq')
+    user_fields = ('manager', 'client')
+    datetime_fields = ('last_timestamp',)
+
+    def __init__(self, rows, user):
+        super().__init__(rows)
+        self.user = user
+
+    @property
+    def data(self):
+        items = super().data
+        for item, row in zip(items, self.rows):
+            side = 'manager' if row['manager_id'] == self.user.id \
+                else 'client'
+            unread = item[f'{side}_unread']
+            del item['manager_unread'], item['client_unread']
+            item['conversation'] = f"{row['manager_id']}_{row['client_id']}"
+            item['unread'] = unread
+            last_message = {
+                'id': item.pop('last_message_id'),
+                'sender_id': item.pop('last_message__sender_id'),
+                'content': item.pop('last_message__content'),
+                'seq': item.pop('last_message__seq'),
+                'timestamp': item['last_timestamp'],
+            }
+            item['last_message'] = last_message \
+                if last_message['id'] is not None else None
+        return items
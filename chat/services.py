@@ -0,0 +1,407 @@
+import collections
+
+from django.db import transaction
+from django.db.models import (
+    BigIntegerField, Case, Count, DateTimeField, F, OuterRef,
+    PositiveBigIntegerField, PositiveIntegerField, Q, Subquery, Value, When
+)
+from django.utils import timezone
+
+from . import history_cache, search
+from .models import ChatMessage, ChatRelation, Conversation
+from .relation_cache import invalidate_on_commit
+
+
+def conversation_ids(pairs):
+    """
+    Возвращает {(manager_id, client_id): conversation_id}, создавая
+    недостающие диалоги.
+    """
+    query = Q()
+    for manager_id, client_id in pairs:
+        query |= Q(manager_id=manager_id, client_id=client_id)
+    rows = Conversation.objects.filter(query).values_list(
+        'pk', 'manager_id', 'client_id'
+    )
+    found = {(manager_id, client_id): pk for pk, manager_id, client_id in rows}
+    missing = [pair for pair in pairs if pair not in found]
+    if not missing:
+        return found
+    Conversation.objects.bulk_create(
+        [Conversation(manager_id=manager_id, client_id=client_id)
+         for manager_id, client_id in missing],
+        ignore_conflicts=True
+    )
+    return conversation_ids(pairs)
+
+
+def allocate_seqs(counts):
+    """
+    Выделяет порядковые номера сразу для нескольких диалогов одной
+    транзакцией из трёх запросов. `counts` – {(manager_id, client_id):
+    сколько номеров}. Возвращает {(manager_id, client_id):
+    (conversation_id, первый номер)}. Счётчики увеличиваются одним UPDATE
+    с F(), так что параллельные отправители получают разные номера.
+    """
+    with transaction.atomic():
+        ids = conversation_ids(list(counts))
+        conversations = Conversation.objects.filter(pk__in=ids.values())
+        conversations.update(last_seq=F('last_seq') + Case(
+            *[When(pk=ids[pair], then=Value(count))
+              for pair, count in counts.items()],
+            output_field=PositiveBigIntegerField()
+        ))
+        last_seqs = dict(conversations.values_list('pk', 'last_seq'))
+    return {
+        pair: (ids[pair], last_seqs[ids[pair]] - count + 1)
+        for pair, count in counts.items()
+    }
+
+
+def create_chat_message(sender, receiver_id, content, manager_id, client_id):
+    """
+    Создаёт одно сообщение диалога (manager_id, client_id) в БД вместе с
+    его порядковым номером и обновляет сводку диалога.
+    """
+    pair = (int(manager_id), int(client_id))
+    with transaction.atomic():
+        conversation_id, seq = allocate_seqs({pair: 1})[pair]
+        chat_message = ChatMessage.objects.create(
+            sender=sender,
+            receiver_id=receiver_id,
+            content=content,
+            conversation_id=conversation_id,
+            seq=seq
+        )
+        update_conversations([chat_message])
+    return chat_message
+
+
+def persist_messages(messages):
+    """
+    Сохраняет пачку заранее собранных сообщений одним bulk_create и
+    обновляет сводки их диалогов и поисковый индекс в той же транзакции.
+    После коммита сообщения дописываются в кэш истории.
+    """
+    with transaction.atomic():
+        messages = ChatMessage.objects.bulk_create(messages)
+        update_conversations(messages)
+        search.index_messages(messages)
+        history_cache.append_on_commit(messages)
+    return messages
+
+
+def broadcast_messages(manager, content, client_ids=None):
+    """
+    Рассылка менеджера своим клиентам: `client_ids` – список id или None
+    для всех связей менеджера. Связи проверяются одним запросом, все
+    сообщения пишутся одним bulk_create, номера и сводки диалогов
+    обновляются одним UPDATE на шаг, а не на получателя.
+    Возвращает (сообщения, id без связи с менеджером).
+    """
+    relations = ChatRelation.objects.filter(manager=manager)
+    if client_ids is not None:
+        relations = relations.filter(client_id__in=client_ids)
+    clients = set(relations.values_list('client_id', flat=True))
+    rejected = sorted(set(client_ids or ()) - clients)
+    if not clients:
+        return [], rejected
+
+    now = timezone.now()
+    with transaction.atomic():
+        conversations = Conversation.objects.filter(manager=manager,
+                                                    client_id__in=clients)
+        missing = clients - set(conversations.values_list('client_id',
+                                                          flat=True))
+        if missing:
+            Conversation.objects.bulk_create(
+                [Conversation(manager=manager, client_id=client_id)
+                 for client_id in missing],
+                ignore_conflicts=True
+            )
+        conversations.update(last_seq=F('last_seq') + 1)
+        messages = ChatMessage.objects.bulk_create([
+            ChatMessage(sender=manager, receiver_id=client_id,
+                        content=content, timestamp=now,
+                        conversation_id=pk, seq=seq)
+            for pk, client_id, seq in
+            conversations.values_list('pk', 'client_id', 'last_seq')
+        ])
+        # Все сообщения рассылки – последние в своих диалогах.
+        conversations.update(
+            last_message_id=Subquery(ChatMessage.objects.filter(
+                conversation=OuterRef('pk'), seq=OuterRef('last_seq')
+            ).values('pk')),
+            last_timestamp=Value(now),
+            client_unread=F('client_unread') + 1,
+        )
+        search.index_messages(messages)
+        history_cache.append_on_commit(messages)
+    return messages, rejected
+
+
+def import_relations(pairs):
+    """
+    Создаёт связи из пар (manager_id, client_id), которых ещё нет: одно
+    чтение существующих и bulk_create в одной транзакции. Возвращает
+    число созданных связей.
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return 0
+    with transaction.atomic():
+        existing = set(ChatRelation.objects.filter(
+            manager_id__in={manager_id for manager_id, _ in pairs},
+            client_id__in={client_id for _, client_id in pairs},
+        ).values_list('manager_id', 'client_id'))
+        missing = sorted(pairs - existing)
+        # ignore_conflicts – на случай параллельного импорта тех же пар.
+        ChatRelation.objects.bulk_create(
+            [ChatRelation(manager_id=manager_id, client_id=client_id)
+             for manager_id, client_id in missing],
+            batch_size=1000, ignore_conflicts=True
+        )
+        invalidate_on_commit(missing)
+    return len(missing)
+
+
+def reassign_relations(from_manager_id, to_manager_id, client_ids=None):
+    """
+    Передаёт клиентов `client_ids` (None – всех) от одного менеджера
+    другому в одной транзакции. Связи, которых у нового менеджера ещё нет,
+    переносятся одним UPDATE, уже существующие у него – удаляются у
+    прежнего. Диалоги и сообщения остаются у прежней пары.
+    Возвращает {"moved": N, "merged": M}.
+    """
+    if from_manager_id == to_manager_id:
+        return {'moved': 0, 'merged': 0}
+    with transaction.atomic():
+        relations = ChatRelation.objects.filter(manager_id=from_manager_id)
+        if client_ids is not None:
+            relations = relations.filter(client_id__in=client_ids)
+        clients = set(relations.select_for_update().values_list(
+            'client_id', flat=True
+        ))
+        if not clients:
+            return {'moved': 0, 'merged': 0}
+        merged = set(ChatRelation.objects.filter(
+            manager_id=to_manager_id, client_id__in=clients
+        ).values_list('client_id', flat=True))
+        if merged:
+            relations.filter(client_id__in=merged).delete()
+        # Новый менеджер у всех один – UPDATE без CASE по строкам, как
+        # сделал бы bulk_update.
+        moved = relations.exclude(client_id__in=merged).update(
+            manager_id=to_manager_id
+        )
+        pairs = [(to_manager_id, client_id) for client_id in clients - merged]
+        if client_ids is None:
+            # Уходят все клиенты – одна версия менеджера вместо версии на
+            # каждую пару.
+            invalidate_on_commit(pairs, managers=[from_manager_id])
+        else:
+            invalidate_on_commit(
+                pairs + [(from_manager_id, client_id) for client_id in clients]
+            )
+    return {'moved': moved, 'merged': len(merged)}
+
+
+def unread_increment(side, received):
+    """
+    Прибавка к счётчику непрочитанных стороны `side` ('manager' или
+    'client'): сколько сообщений из `received` ({receiver_id: count})
+    адресовано ей.
+    """
+    return Case(
+        *[When(**{f'{side}_id': receiver_id}, then=Value(count))
+          for receiver_id, count in received.items()],
+        default=Value(0),
+        output_field=PositiveIntegerField()
+    )
+
+
+def update_conversations(messages):
+    """
+    Обновляет сводку диалогов по сохранённым сообщениям: последнее
+    сообщение и непрочитанные у получателей. Один UPDATE с F() на диалог,
+    поэтому параллельные записи не теряют приращений.
+    """
+    by_conversation = collections.defaultdict(list)
+    for message in messages:
+        if message.conversation_id is not None:
+            by_conversation[message.conversation_id].append(message)
+    for conversation_id, items in by_conversation.items():
+        last = max(items, key=lambda message: (message.timestamp, message.pk))
+        received = collections.Counter(message.receiver_id
+                                       for message in items)
+        # Сообщение из отложенной пачки может оказаться старше уже
+        # записанного последним.
+        newer = Q(last_timestamp__isnull=True) | \
+            Q(last_timestamp__lte=last.timestamp)
+        Conversation.objects.filter(pk=conversation_id).update(
+            last_message_id=Case(When(newer, then=Value(last.pk)),
+                                 default=F('last_message_id'),
+                                 output_field=BigIntegerField()),
+            last_timestamp=Case(When(newer, then=Value(last.timestamp)),
+                                default=F('last_timestamp'),
+                                output_field=DateTimeField()),
+            manager_unread=F('manager_unread') + unread_increment(
+                'manager', received
+            ),
+            client_unread=F('client_unread') + unread_increment(
+                'client', received
+            ),
+        )
+
+
+def mark_read(conversation, user_id, seq=None):
+    """
+    Отмечает сообщения диалога до номера `seq` (по умолчанию все)
+    прочитанными стороной пользователя `user_id` и пересчитывает её
+    счётчик непрочитанных. Отметка не сдвигается назад.
+    Возвращает состояние отметок, как apply_receipts.
+    """
+    key = (conversation.manager_id, conversation.client_id, user_id)
+    if seq is None:
+        seq = Conversation.objects.values_list(
+            'last_seq', flat=True
+        ).get(pk=conversation.pk)
+    return apply_receipts({key: {'read': seq}})[0]
+
+
+RECEIPT_FIELDS = ('delivered_seq', 'read_seq', 'unread')
+
+
+def resolve_message_ids(marks, message_ids):
+    """
+    Переводит отметки по id сообщений в отметки по номерам одним запросом.
+    Сообщения другого диалога и без номера пропускаются.
+    """
+    ids = {pk for value in message_ids.values() for pk in value.values()}
+    rows = ChatMessage.objects.filter(pk__in=ids, seq__isnull=False).values(
+        'pk', 'seq', 'conversation__manager_id', 'conversation__client_id'
+    )
+    seqs = {row['pk']: ((row['conversation__manager_id'],
+                         row['conversation__client_id']), row['seq'])
+            for row in rows}
+    for key, value in message_ids.items():
+        for kind, pk in value.items():
+            pair, seq = seqs.get(pk, (None, None))
+            if pair != key[:2]:
+                continue
+            current = marks.setdefault(key, {})
+            current[kind] = max(current.get(kind, 0), seq)
+
+
+def apply_receipts(marks, message_ids=None):
+    """
+    Записывает отметки доставки и прочтения пачкой. `marks` –
+    {(manager_id, client_id, user_id): {'delivered': seq, 'read': seq}}
+    (любой ключ можно опустить), `message_ids` – то же с id сообщений
+    вместо номеров.
+
+    Отметки только растут, не превышают last_seq диалога, доставленное не
+    меньше прочитанного. Число запросов не зависит от числа отметок: id
+    сообщений, диалоги, непрочитанные и один UPDATE с Case. Возвращает
+    список состояний {'manager_id', 'client_id', 'user_id', 'delivered',
+    'read', 'unread', 'changed'} для отметок участников диалогов.
+    """
+    marks = {key: dict(value) for key, value in marks.items()}
+    states = []
+    with transaction.atomic():
+        if message_ids:
+            resolve_message_ids(marks, message_ids)
+        if not marks:
+            return states
+        query = Q()
+        for manager_id, client_id in {key[:2] for key in marks}:
+            query |= Q(manager_id=manager_id, client_id=client_id)
+        fields = [f'{side}_{field}' for side in ('manager', 'client')
+                  for field in RECEIPT_FIELDS]
+        conversations = {
+            (row['manager_id'], row['client_id']): row
+            for row in Conversation.objects.select_for_update().filter(
+                query
+            ).values('pk', 'manager_id', 'client_id', 'last_seq', *fields)
+        }
+
+        for (manager_id, client_id, user_id), value in marks.items():
+            conversation = conversations.get((manager_id, client_id))
+            if conversation is None or user_id not in (manager_id,
+                                                       client_id):
+                continue
+            side = 'manager' if user_id == manager_id else 'client'
+            last_seq = conversation['last_seq']
+            read = max(conversation[f'{side}_read_seq'],
+                       min(value.get('read', 0), last_seq))
+            delivered = max(conversation[f'{side}_delivered_seq'], read,
+                            min(value.get('delivered', 0), last_seq))
+            changed = (delivered, read) != (
+                conversation[f'{side}_delivered_seq'],
+                conversation[f'{side}_read_seq']
+            )
+            conversation[f'{side}_delivered_seq'] = delivered
+            states.append({
+                'manager_id': manager_id, 'client_id': client_id,
+                'user_id': user_id, 'delivered': delivered, 'read': read,
+                'unread': conversation[f'{side}_unread'],
+                'changed': changed,
+                'moved_read': read != conversation[f'{side}_read_seq'],
+            })
+            conversation[f'{side}_read_seq'] = read
+
+        moved = [state for state in states if state.pop('moved_read')]
+        if moved:
+            unread_query = Q()
+            for state in moved:
+                conversation = conversations[(state['manager_id'],
+                                              state['client_id'])]
+                unread_query |= Q(conversation_id=conversation['pk'],
+                                  receiver_id=state['user_id'],
+                                  seq__gt=state['read'])
+            counts = {
+                (row['conversation_id'], row['receiver_id']): row['count']
+                for row in ChatMessage.objects.filter(unread_query).values(
+                    'conversation_id', 'receiver_id'
+                ).annotate(count=Count('pk')).order_by()
+            }
+            for state in moved:
+                conversation = conversations[(state['manager_id'],
+                                              state['client_id'])]
+                side = 'manager' if state['user_id'] == state['manager_id'] \
+                    else 'client'
+                state['unread'] = conversation[f'{side}_unread'] = \
+                    counts.get((conversation['pk'], state['user_id']), 0)
+
+        changed = list({
+            conversation['pk']: conversation for conversation in (
+                conversations[(state['manager_id'], state['client_id'])]
+                for state in states if state['changed']
+            )
+        }.values())
+        if changed:
+            Conversation.objects.filter(
+                pk__in=[conversation['pk'] for conversation in changed]
+            ).update(**{
+                field: Case(*[When(pk=conversation['pk'],
+                                   then=Value(conversation[field]))
+                              for conversation in changed],
+                            default=F(field),
+                            output_field=PositiveBigIntegerField())
+                for field in fields
+            })
+    return states
+
+
+def messages_after(manager_id, client_id, seq, limit):
+    """
+    Сообщения диалога с номером больше `seq` по возрастанию номера:
+    диапазонное чтение по индексу (conversation, seq).
+    """
+    return list(ChatMessage.objects.filter(
+        conversation__manager_id=manager_id,
+        conversation__client_id=client_id,
+        seq__gt=seq
+    ).order_by('seq').values(
+        'sender_id', 'content', 'uid', 'timestamp', 'seq'
+    )[:limit])
@@ -0,0 +1,84 @@
+"""
+Шардирование Redis channel layer.
+
+RedisChannelLayer из channels_redis выбирает узел группы или канала по
+crc32 имени, поделённому на равные диапазоны по числу узлов: при
+добавлении узла границы всех диапазонов сдвигаются и переезжает большая
+часть групп. ShardedRedisChannelLayer выбирает узел по кольцу
+согласованного хеширования (HashRing). У каждого узла REPLICAS
+виртуальных точек, положение которых зависит только от имени узла, поэтому
+при добавлении (N+1)-го узла на него переезжает около 1/(N+1) групп, а
+остальные остаются на своих узлах.
+
+Все каналы процесса (`specific.<client>!<id>`) хешируются по общей
+нелокальной части имени, как при чтении в receive: процесс читает свои
+сообщения с одного узла, а отправка в канал попадает туда же.
+"""
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+REPLICAS = 160
+
+
+def ring_hash(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(),
+                          'big')
+
+
+def node_name(host):
+    """
+    Имя узла на кольце по настройкам хоста из CHANNEL_LAYERS.
+    """
+    if 'address' in host:
+        return str(host['address'])
+    if 'host' in host:
+        return f"{host['host']}:{host.get('port', 6379)}"
+    return repr(sorted(host.items()))
+
+
+class HashRing:
+    """
+    Кольцо согласованного хеширования: ключ принадлежит узлу первой
+    виртуальной точки по часовой стрелке от хеша ключа.
+    """
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = sorted(
+            (ring_hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self.size = len(nodes)
+        self.hashes = [point for point, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def index(self, key):
+        if self.size == 1:
+            return 0
+        position = bisect.bisect(self.hashes, ring_hash(key))
+        return self.indexes[position % len(self.hashes)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer с выбором узла по HashRing. `shard_names` задаёт имена
+    узлов на кольце, если адреса узлов могут меняться (по умолчанию –
+    адреса из `hosts`).
+    """
+    def __init__(self, hosts=None, shard_names=None, replicas=REPLICAS,
+                 **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        names = shard_names or [node_name(host) for host in self.hosts]
+        if len(names) != self.ring_size:
+            raise ValueError('shard_names должен называть каждый узел hosts.')
+        self.ring = HashRing(names, replicas)
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        if '!' in value:
+            value = self.non_local_name(value)
+        return self.ring.index(value)
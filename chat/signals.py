@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import history_cache, search
+from .models import ChatMessage, ChatRelation
+from .relation_cache import relation_cache
+
+
+def invalidate_relation(manager_id, client_id=None):
+    """
+    Сбрасывает кэш доступа сейчас и ещё раз после коммита, чтобы в кэш
+    не вернулось значение, прочитанное до фиксации транзакции.
+    """
+    relation_cache.invalidate(manager_id, client_id)
+    transaction.on_commit(
+        lambda: relation_cache.invalidate(manager_id, client_id)
+    )
+
+
+@receiver(post_save, sender=ChatRelation)
+def relation_saved(sender, instance, created, **kwargs):
+    # При обновлении мог смениться клиент, старая пара неизвестна –
+    # сбрасываем все пары менеджера.
+    invalidate_relation(instance.manager_id,
+                        instance.client_id if created else None)
+
+
+@receiver(post_delete, sender=ChatRelation)
+def relation_deleted(sender, instance, **kwargs):
+    invalidate_relation(instance.manager_id, instance.client_id)
+
+
+@receiver(post_save, sender=ChatMessage)
+def message_saved(sender, instance, created, **kwargs):
+    # bulk_create сигналов не шлёт, пачки индексирует persist_messages.
+    if created:
+        search.index_messages([instance])
+        history_cache.append_on_commit([instance])
+    else:
+        search.reindex_message(instance)
+        history_cache.invalidate([(instance.sender_id, instance.receiver_id)])
+
+
+@receiver(post_delete, sender=ChatMessage)
+def message_deleted(sender, instance, **kwargs):
+    # Буфер не знает об удалении: last_seq не меняется, и сверка с
+    # Conversation.last_seq его не отбросит.
+    history_cache.invalidate([(instance.sender_id, instance.receiver_id)])
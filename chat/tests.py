@@ -1,12 +1,55 @@
 import asyncio
+import collections
+import csv
+import io
+import json
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
 
-from asgiref.sync import sync_to_async
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
 from channels.testing import WebsocketCommunicator, ChannelsLiveServerTestCase
-from django.test import TestCase, override_settings
+from channels_redis.core import RedisChannelLayer
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
+from django.db.models import Sum
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
-from chat.models import ChatRelation, ChatMessage
+from chat.models import (
+    ArchiveSegment, ArchiveSegmentMember, ChatRelation, ChatMessage,
+    Conversation
+)
+from chat.pagination import KeysetPagination
+from chat import (
+    codec, db, export, history_cache, metrics, middleware, search, services
+)
+from chat.archive import archive_messages
+from chat.bench import seed_messages
+from chat.db import db_sync_to_async
+from chat.fanout import RedisAdapter, fan_out, get_adapter, plan
+from chat.framing import Framing, negotiate
+from chat.lifecycle import tracker
+from chat.local_layer import LocalChannelLayer
+from chat.persistence import (
+    MessageWriter, SeqAllocator, WriteBehindOverflow, get_writer
+)
+from chat.presence import LocalPresenceStore, TypingThrottle, local_presence
+from chat.ratelimit import TokenBucket, user_buckets
+from chat.receipts import ReceiptBuffer, get_receipt_buffer
+from chat.relation_cache import RelationCache, relation_cache
+from chat.serializers import ChatMessageSerializer, ChatRelationSerializer
+from chat.sharding import HashRing, ShardedRedisChannelLayer
 from chat_channels.asgi import application
 
 
@@ -78,9 +121,10 @@ class ChatAPITests(TestCase):
         url = reverse('relations-list')
         response = self.api_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['manager']['username'], 'manager')
-        self.assertEqual(response.data[0]['client']['username'], 'client')
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['manager']['username'], 'manager')
+        self.assertEqual(results[0]['client']['username'], 'client')
 
     def test_client_can_see_own_relation(self):
         """
@@ -90,9 +134,10 @@ class ChatAPITests(TestCase):
         url = reverse('relations-list')
         response = self.api_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['manager']['username'], 'manager')
-        self.assertEqual(response.data[0]['client']['username'], 'client')
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['manager']['username'], 'manager')
+        self.assertEqual(results[0]['client']['username'], 'client')
 
     def test_anonymous_cannot_see_relations(self):
         """
@@ -141,9 +186,10 @@ class ChatAPITests(TestCase):
         response = self.api_client.get(url)
         self.assertEqual(response.status_code, 200)
         # Менеджер должен видеть только 1 связь
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['manager']['username'], 'manager')
-        self.assertEqual(response.data[0]['client']['username'], 'client')
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['manager']['username'], 'manager')
+        self.assertEqual(results[0]['client']['username'], 'client')
 
     def test_client_sees_only_his_relation(self):
         """
@@ -153,9 +199,10 @@ class ChatAPITests(TestCase):
         url = reverse('relations-list')
         response = self.api_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['manager']['username'], 'manager')
-        self.assertEqual(response.data[0]['client']['username'], 'client')
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['manager']['username'], 'manager')
+        self.assertEqual(results[0]['client']['username'], 'client')
 
     def test_manager_sees_only_his_messages(self):
         """
@@ -225,8 +272,7 @@ class ChatAPITests(TestCase):
         Проверяем, что менеджер может обновить (изменить) существующий чат, например,
         сменить клиента.
         """
-        relation = ChatRelation.objects.create(manager=self.manager,
-                                               client=self.client_user)
+        relation = self.relation
         self.api_client.login(username='manager', password='test12345')
         url = reverse('relations-detail', args=[relation.id])
         data = {
@@ -252,8 +298,7 @@ class ChatAPITests(TestCase):
         """
         Проверяем, что менеджер может удалить чат через API.
         """
-        relation = ChatRelation.objects.create(manager=self.manager,
-                                               client=self.client_user)
+        relation = self.relation
         self.api_client.login(username='manager', password='test12345')
         url = reverse('relations-detail', args=[relation.id])
         response = self.api_client.delete(url)
@@ -270,6 +315,1581 @@ class ChatAPITests(TestCase):
         self.assertEqual(response.status_code, 403)
 
 
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create_user(
+            username='client', password='test12345'
+        )
+        self.client2 = User.objects.create_user(
+            username='client2', password='test12345'
+        )
+        self.messages = []
+        for i in range(7):
+            self.messages.append(ChatMessage.objects.create(
+                sender=self.manager, receiver=self.client_user,
+                content=f'm{i}'
+            ))
+            self.messages.append(ChatMessage.objects.create(
+                sender=self.client2, receiver=self.manager,
+                content=f'c{i}'
+            ))
+        self.api_client = APIClient()
+        self.api_client.login(username='manager', password='test12345')
+        self.url = reverse('messages-history')
+
+    def test_decodable_cursor_with_bad_values_is_rejected(self):
+        timestamp = timezone.now().isoformat()
+        for values in (["abc", 1], [timestamp, "zz"], [None, 1],
+                       ["2026-01-01T00:00:00", 1], [timestamp, True]):
+            cursor = KeysetPagination().encode_cursor(
+                {"timestamp": values[0], "id": values[1]}
+            )
+            for url in (self.url, reverse('conversations-list')):
+                for param in ('before', 'after'):
+                    response = self.api_client.get(url, {param: cursor})
+                    self.assertEqual(response.status_code, 400,
+                                     (url, param, values))
+
+    def test_pages_walk_whole_history_newest_first(self):
+        """
+        Последовательный проход по курсору before отдаёт всю историю
+        без пропусков и повторов, от новых сообщений к старым.
+        """
+        seen = []
+        params = {'limit': 4}
+        while True:
+            response = self.api_client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(msg['id'] for msg in response.data['results'])
+            if response.data['before'] is None:
+                break
+            params = {'limit': 4, 'before': response.data['before']}
+        expected = [m.id for m in sorted(
+            self.messages, key=lambda m: (m.timestamp, m.id), reverse=True
+        )]
+        self.assertEqual(seen, expected)
+
+    def test_after_cursor_returns_newer_messages(self):
+        response = self.api_client.get(self.url, {'limit': 3})
+        newest_page = [msg['id'] for msg in response.data['results']]
+        older = self.api_client.get(
+            self.url, {'limit': 3, 'before': response.data['before']}
+        )
+        newer = self.api_client.get(
+            self.url, {'limit': 3, 'after': older.data['after']}
+        )
+        self.assertEqual([msg['id'] for msg in newer.data['results']],
+                         newest_page)
+
+    def test_history_scoped_to_counterpart(self):
+        response = self.api_client.get(
+            self.url, {'with_user': self.client2.id, 'limit': 50}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 7)
+        self.assertTrue(all(msg['sender']['id'] == self.client2.id
+                            for msg in response.data['results']))
+
+    def test_history_is_private(self):
+        self.api_client.login(username='client', password='test12345')
+        response = self.api_client.get(
+            self.url, {'with_user': self.client2.id}
+        )
+        self.assertEqual(response.data['results'], [])
+
+    def test_invalid_cursor(self):
+        response = self.api_client.get(self.url, {'before': '%%%'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create_user(
+            username='client', password='test12345'
+        )
+        self.other_client = User.objects.create_user(
+            username='other_client', password='test12345'
+        )
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.client_user)
+
+    def create_messages(self):
+        texts = ['Где мой заказ?', 'Заказ уже в пути, заказ придёт завтра',
+                 'Спасибо!', 'Ещё один ЗАКАЗ оформлен']
+        messages = [
+            ChatMessage.objects.create(sender=self.client_user,
+                                       receiver=self.manager, content=text)
+            for text in texts
+        ]
+        ChatMessage.objects.create(sender=self.other_client,
+                                   receiver=self.manager,
+                                   content='Чужой заказ')
+        return messages
+
+    def search(self, **params):
+        response = self.api_client.get(reverse('messages-search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def assert_ranked_and_paged(self):
+        messages = self.create_messages()
+        data = self.search(q='заказ')
+        ids = [item['id'] for item in data['results']]
+        # Двойное упоминание выше, чужой диалог не виден.
+        self.assertEqual(ids[0], messages[1].id)
+        self.assertEqual(sorted(ids), sorted(
+            [messages[0].id, messages[1].id, messages[3].id]
+        ))
+        self.assertIsNone(data['cursor'])
+
+        paged, cursor = [], None
+        while True:
+            params = {'q': 'заказ', 'limit': 1}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.search(**params)
+            paged += [item['id'] for item in data['results']]
+            cursor = data['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(paged, ids)
+
+        # Все слова запроса должны встретиться.
+        data = self.search(q='заказ завтра')
+        self.assertEqual([item['id'] for item in data['results']],
+                         [messages[1].id])
+
+    def test_fts5_search(self):
+        self.assertEqual(search.search_backend(), 'fts5')
+        self.assert_ranked_and_paged()
+
+    @override_settings(CHAT_SEARCH={'BACKEND': 'index'})
+    def test_inverted_index_search(self):
+        self.assert_ranked_and_paged()
+
+    @override_settings(CHAT_SEARCH={'MAX_CANDIDATES': 2})
+    def test_fts5_pages_past_candidate_window(self):
+        messages = [
+            ChatMessage.objects.create(sender=self.client_user,
+                                       receiver=self.manager,
+                                       content='заказ ' * (i % 2 + 1))
+            for i in range(5)
+        ]
+        paged, cursor = [], None
+        while True:
+            params = {'q': 'заказ', 'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.search(**params)
+            paged += [item['id'] for item in data['results']]
+            cursor = data['cursor']
+            if cursor is None:
+                break
+        # Окно из двух новых ранжируется, старые – от новых к старым.
+        self.assertEqual(paged, [messages[3].id, messages[4].id,
+                                 messages[2].id, messages[1].id,
+                                 messages[0].id])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = ChatMessage.objects.create(
+            sender=self.client_user, receiver=self.manager,
+            content='Вопрос про доставку'
+        )
+        message.content = 'Вопрос про оплату'
+        message.save()
+        self.assertEqual(self.search(q='доставку')['results'], [])
+        self.assertEqual(len(self.search(q='оплату')['results']), 1)
+        message.delete()
+        self.assertEqual(self.search(q='оплату')['results'], [])
+
+    def test_rebuild_command_fills_inverted_index(self):
+        messages = self.create_messages()
+        with override_settings(CHAT_SEARCH={'BACKEND': 'index'}):
+            self.assertEqual(self.search(q='спасибо')['results'], [])
+            out = io.StringIO()
+            call_command('rebuild_search_index', stdout=out)
+            self.assertIn('Проиндексировано сообщений: 5.', out.getvalue())
+            self.assertEqual(
+                [item['id'] for item in self.search(q='спасибо')['results']],
+                [messages[2].id]
+            )
+
+    def test_query_is_required(self):
+        response = self.api_client.get(reverse('messages-search'))
+        self.assertEqual(response.status_code, 400)
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create_user(
+            username='client', password='test12345'
+        )
+        self.other_client = User.objects.create_user(
+            username='other_client', password='test12345'
+        )
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_settings = override_settings(CHAT_ARCHIVE={
+            'DIR': directory.name
+        })
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.manager)
+
+        now = timezone.now()
+        self.messages = []
+        # Шесть сообщений: четыре старых в двух разных месяцах и два свежих.
+        for days in (100, 95, 60, 55, 1, 0):
+            message = ChatMessage.objects.create(
+                sender=self.client_user, receiver=self.manager,
+                content=f'{days} дней назад'
+            )
+            ChatMessage.objects.filter(pk=message.pk).update(
+                timestamp=now - timedelta(days=days)
+            )
+            self.messages.append(message)
+        self.other = ChatMessage.objects.create(
+            sender=self.other_client, receiver=self.manager, content='чужое'
+        )
+        ChatMessage.objects.filter(pk=self.other.pk).update(
+            timestamp=now - timedelta(days=90)
+        )
+
+    def archive(self):
+        out = io.StringIO()
+        call_command('archive_messages', '--older-than-days', '30',
+                     stdout=out)
+        return out.getvalue()
+
+    def history(self, **params):
+        response = self.api_client.get(reverse('messages-history'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_archive_moves_old_messages_to_segments(self):
+        self.assertIn('Перенесено в архив сообщений: 5', self.archive())
+        self.assertEqual(
+            set(ChatMessage.objects.values_list('id', flat=True)),
+            {self.messages[4].id, self.messages[5].id}
+        )
+        segments = ArchiveSegment.objects.all()
+        self.assertEqual(sum(segment.rows for segment in segments), 5)
+        self.assertTrue(all(segment.month.day == 1 for segment in segments))
+        self.assertEqual(
+            ArchiveSegmentMember.objects.filter(user=self.manager)
+            .aggregate(rows=Sum('rows'))['rows'], 5
+        )
+        # Повторный прогон ничего не переносит.
+        self.assertIn('Перенесено в архив сообщений: 0', self.archive())
+
+    def test_last_message_of_conversation_stays_hot(self):
+        Conversation.objects.create(
+            manager=self.manager, client=self.other_client,
+            last_message=self.other, last_timestamp=timezone.now()
+        )
+        self.archive()
+        self.assertTrue(ChatMessage.objects.filter(pk=self.other.pk).exists())
+
+    def test_history_reads_through_archive(self):
+        self.archive()
+        expected = [message.id for message in reversed(self.messages)]
+        pages, cursor = [], None
+        while True:
+            params = {'with_user': self.client_user.id, 'limit': 2}
+            if cursor:
+                params['before'] = cursor
+            data = self.history(**params)
+            pages.append([item['id'] for item in data['results']])
+            cursor = data['before']
+            if cursor is None:
+                break
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(pages[-1], expected[-2:])
+
+        # Все сообщения менеджера, включая чужую архивную переписку.
+        data = self.history(limit=50)
+        self.assertEqual(len(data['results']), 7)
+
+        # Курсор after внутри архива: сначала архивные, затем горячие.
+        after = self.history(with_user=self.client_user.id, limit=50)
+        data = self.history(with_user=self.client_user.id, limit=3,
+                            after=KeysetPagination().encode_cursor(
+                                after['results'][-1]))
+        self.assertEqual([item['id'] for item in data['results']],
+                         expected[-4:-1])
+
+        # Клиент не видит чужие сегменты.
+        self.api_client.force_authenticate(user=self.other_client)
+        data = self.history(limit=50)
+        self.assertEqual([item['id'] for item in data['results']],
+                         [self.other.id])
+
+
+class HistoryCacheTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create_user(
+            username='client', password='test12345'
+        )
+        history_cache.cache().clear()
+        self.addCleanup(history_cache.cache().clear)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.manager)
+        for i in range(5):
+            self.send(self.manager if i % 2 else self.client_user, f'm{i}')
+
+    def send(self, sender, content):
+        receiver = self.client_user if sender == self.manager \
+            else self.manager
+        return services.create_chat_message(
+            sender, receiver.id, content, self.manager.id, self.client_user.id
+        )
+
+    def history(self, **params):
+        params['with_user'] = self.client_user.id
+        response = self.api_client.get(reverse('messages-history'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def walk(self):
+        pages, cursor = [], None
+        while True:
+            data = self.history(limit=2, **({'before': cursor} if cursor
+                                            else {}))
+            pages.append(data['results'])
+            cursor = data['before']
+            if cursor is None:
+                return pages
+
+    def test_recent_pages_served_from_cache(self):
+        with override_settings(CHAT_HISTORY_CACHE={'ENABLED': False}):
+            expected = self.walk()
+        self.walk()
+        hits = history_cache.hits.value
+        # Страница из кэша – один запрос: отметки диалога и его last_seq.
+        with self.assertNumQueries(len(expected)):
+            self.assertEqual(self.walk(), expected)
+        self.assertEqual(history_cache.hits.value, hits + len(expected))
+
+    def test_new_messages_are_appended_after_commit(self):
+        self.history()
+        with self.captureOnCommitCallbacks(execute=True):
+            message = self.send(self.manager, 'новое')
+        with self.assertNumQueries(1):
+            data = self.history(limit=2)
+        self.assertEqual(data['results'][0]['id'], message.id)
+        self.assertEqual(data['results'][0]['seq'], 6)
+
+    def test_buffer_missing_a_message_is_not_served(self):
+        self.history()
+        # Сообщение записано в обход кэша: после коммита буфер его не
+        # получил.
+        message = self.send(self.manager, 'мимо кэша')
+        stale = history_cache.stale.value
+        data = self.history(limit=2)
+        self.assertEqual(data['results'][0]['id'], message.id)
+        self.assertEqual(history_cache.stale.value, stale + 1)
+
+    def test_deleted_message_leaves_cache(self):
+        first = self.history()['results']
+        ChatMessage.objects.get(pk=first[0]['id']).delete()
+        self.assertIsNone(history_cache.get(self.manager.id,
+                                            self.client_user.id))
+        self.assertEqual(self.history()['results'], first[1:])
+
+    def test_windows_beyond_buffer_read_database(self):
+        with override_settings(CHAT_HISTORY_CACHE={'SIZE': 3}):
+            self.history()
+            entry = history_cache.get(self.manager.id, self.client_user.id)
+            self.assertEqual(len(entry['rows']), 3)
+            self.assertFalse(entry['complete'])
+            misses = history_cache.misses.value
+            self.assertEqual(len(self.history(limit=4)['results']), 4)
+            self.assertEqual(history_cache.misses.value, misses + 1)
+
+
+@override_settings(CHANNEL_LAYERS={
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+})
+class BroadcastTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.clients = [
+            User.objects.create_user(username=f'client{i}',
+                                     password='test12345')
+            for i in range(20)
+        ]
+        for client in self.clients:
+            ChatRelation.objects.create(manager=self.manager, client=client)
+        self.stranger = User.objects.create_user(username='stranger',
+                                                 password='test12345')
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.manager)
+        self.url = reverse('messages-broadcast')
+
+    def test_broadcast_writes_and_delivers_every_conversation(self):
+        layer = get_channel_layer()
+        first = self.clients[0]
+        inbox = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'user_{first.id}_notifications',
+                                       inbox)
+        services.create_chat_message(first, self.manager.id, 'вопрос',
+                                     self.manager.id, first.id)
+
+        response = self.api_client.post(self.url, {
+            'message': 'Объявление',
+            'clients': [first.id, self.clients[1].id, self.stranger.id],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'sent': 2,
+                                         'rejected': [self.stranger.id]})
+        frame = json.loads(async_to_sync(layer.receive)(inbox)['text'])
+        self.assertEqual((frame['message'], frame['seq']), ('Объявление', 2))
+
+        conversation = Conversation.objects.get(manager=self.manager,
+                                                client=first)
+        self.assertEqual(conversation.last_seq, 2)
+        self.assertEqual(conversation.last_message.content, 'Объявление')
+        self.assertEqual(conversation.client_unread, 1)
+        self.assertEqual(conversation.manager_unread, 1)
+
+    def test_query_count_does_not_grow_with_recipients(self):
+        counts = []
+        for clients in (self.clients[:2], self.clients[2:]):
+            with CaptureQueriesContext(connection) as queries:
+                messages, _ = services.broadcast_messages(
+                    self.manager, 'всем', [client.id for client in clients]
+                )
+            self.assertEqual(len(messages), len(clients))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        messages, _ = services.broadcast_messages(self.manager, 'ещё')
+        self.assertEqual(sorted(message.seq for message in messages),
+                         [2] * len(self.clients))
+
+    def test_only_managers_broadcast(self):
+        self.api_client.force_authenticate(user=self.clients[0])
+        response = self.api_client.post(self.url, {
+            'message': 'Спам', 'clients': 'all'
+        }, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.api_client.force_authenticate(user=self.manager)
+        response = self.api_client.post(self.url, {
+            'message': 'Текст', 'clients': ['x']
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ConversationExportTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create_user(
+            username='client', password='test12345'
+        )
+        self.other_client = User.objects.create_user(
+            username='other_client', password='test12345'
+        )
+        self.relation = ChatRelation.objects.create(manager=self.manager,
+                                                    client=self.client_user)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.client_user)
+        self.url = reverse('relations-export', args=[self.relation.id])
+
+    def export(self, **params):
+        response = self.api_client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_and_csv_include_archive_in_order(self):
+        now = timezone.now()
+        expected = []
+        for days, (sender, receiver) in zip(
+                (50, 40, 2, 1), [(self.client_user, self.manager),
+                                 (self.manager, self.client_user)] * 2):
+            message = ChatMessage.objects.create(
+                sender=sender, receiver=receiver,
+                content=f'строка, "{days}"\nвторая'
+            )
+            ChatMessage.objects.filter(pk=message.pk).update(
+                timestamp=now - timedelta(days=days)
+            )
+            expected.append(message.id)
+        ChatMessage.objects.create(sender=self.other_client,
+                                   receiver=self.manager, content='чужое')
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(CHAT_ARCHIVE={'DIR': directory}):
+            archive_messages(now - timedelta(days=30))
+            lines = self.export().splitlines()
+            rows = list(csv.reader(io.StringIO(self.export(output='csv'))))
+
+        self.assertEqual([json.loads(line)['id'] for line in lines], expected)
+        self.assertEqual(json.loads(lines[0])['content'],
+                         'строка, "50"\nвторая')
+        self.assertEqual(rows[0], list(export.FIELDS))
+        self.assertEqual([int(row[0]) for row in rows[1:]], expected)
+        self.assertEqual(rows[1][-1], 'строка, "50"\nвторая')
+
+    def test_overlapping_archive_segments_are_merged(self):
+        base = (timezone.now() - timedelta(days=60)).replace(day=15)
+
+        def message(hours):
+            created = ChatMessage.objects.create(
+                sender=self.client_user, receiver=self.manager,
+                content=str(hours)
+            )
+            ChatMessage.objects.filter(pk=created.pk).update(
+                timestamp=base + timedelta(hours=hours)
+            )
+            return created.id
+
+        first, third = message(0), message(2)
+        latest = message(24 * 50)
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(CHAT_ARCHIVE={'DIR': directory}):
+            archive_messages(base + timedelta(days=1))
+            # Сообщение между уже заархивированными – второй сегмент того
+            # же месяца внутри интервала первого.
+            second = message(1)
+            archive_messages(base + timedelta(days=1))
+            lines = self.export().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [first, second, third, latest])
+
+    def test_unknown_output_is_rejected(self):
+        response = self.api_client.get(self.url, {'output': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_async_export_matches_sync(self):
+        await sync_to_async(seed_messages)(
+            [(self.manager.id, self.client_user.id),
+             (self.client_user.id, self.manager.id)], 500
+        )
+        args = (self.manager.id, self.client_user.id, 'ndjson')
+        chunks = [chunk async for chunk in
+                  export.aexport_chunks(*args, chunk_size=100)]
+        self.assertGreater(len(chunks), 1)
+        synchronous = await sync_to_async(
+            lambda: ''.join(export.export_chunks(*args, chunk_size=100))
+        )()
+        self.assertEqual(''.join(chunks), synchronous)
+
+    def test_memory_does_not_grow_with_history(self):
+        """
+        Пик памяти выгрузки одинаков для 5 тысяч и 40 тысяч сообщений.
+        Выгрузку 1M сообщений проверяет `chat_bench export`.
+        """
+        pairs = [(self.manager.id, self.client_user.id),
+                 (self.client_user.id, self.manager.id)]
+
+        def peak():
+            tracemalloc.start()
+            try:
+                response = self.api_client.get(self.url)
+                size = sum(len(chunk) for chunk in response.streaming_content)
+                return size, tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        seed_messages(pairs, 5000)
+        small_size, small_peak = peak()
+        seed_messages(pairs, 35000)
+        large_size, large_peak = peak()
+        self.assertGreater(large_size, small_size * 7)
+        self.assertLess(large_peak, small_peak * 1.5)
+
+
+class ListQueryCountTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.clients = [
+            User.objects.create(username=f'client{i}') for i in range(20)
+        ]
+        for client in self.clients:
+            ChatRelation.objects.create(manager=self.manager, client=client)
+        self.api_client = APIClient()
+        self.api_client.login(username='manager', password='test12345')
+
+    def add_messages(self, count):
+        for i in range(count):
+            client = self.clients[i % len(self.clients)]
+            ChatMessage.objects.create(sender=self.manager, receiver=client,
+                                       content=f'm{i}')
+            ChatMessage.objects.create(sender=client, receiver=self.manager,
+                                       content=f'c{i}')
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.api_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_message_list_queries_do_not_grow_with_rows(self):
+        """
+        Количество запросов к /messages/ не зависит от числа сообщений.
+        """
+        urls = [reverse('messages-list'), reverse('messages-history')]
+        self.add_messages(1)
+        small = [self.count_queries(url) for url in urls]
+        self.add_messages(40)
+        large = [self.count_queries(url) for url in urls]
+        self.assertEqual(large[0], small[0])
+        # Неполная страница истории дочитывается из архива: один запрос к
+        # манифесту, которого нет, когда горячая таблица заполняет страницу.
+        self.assertEqual(large[1], small[1] - 1)
+
+    def test_relation_list_queries_do_not_grow_with_rows(self):
+        url = reverse('relations-list')
+        with CaptureQueriesContext(connection) as queries:
+            self.api_client.get(url)
+        many = len(queries)
+        ChatRelation.objects.filter(client__in=self.clients[1:]).delete()
+        self.assertEqual(self.count_queries(url), many)
+
+    def test_fast_serializers_match_model_serializers(self):
+        self.add_messages(3)
+        messages = self.api_client.get(reverse('messages-list')).data
+        expected = ChatMessageSerializer(
+            ChatMessage.objects.order_by('-timestamp', '-id'), many=True
+        ).data
+        self.assertEqual(messages, expected)
+        relations = self.api_client.get(
+            reverse('relations-list')
+        ).data['results']
+        expected = ChatRelationSerializer(
+            ChatRelation.objects.filter(manager=self.manager), many=True
+        ).data
+        self.assertEqual(sorted(relations, key=lambda r: r['id']),
+                         sorted(expected, key=lambda r: r['id']))
+
+
+@override_settings(
+    CHANNEL_LAYERS={
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+)
+class ConversationInboxTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.clients = [
+            User.objects.create_user(username=f'client{i}',
+                                     password='test12345')
+            for i in range(3)
+        ]
+        for client in self.clients:
+            ChatRelation.objects.create(manager=self.manager, client=client)
+        self.api_client = APIClient()
+        self.api_client.login(username='manager', password='test12345')
+        self.url = reverse('conversations-list')
+
+    def send(self, sender, client, content):
+        receiver = client if sender == self.manager else self.manager
+        return services.create_chat_message(
+            sender, receiver.id, content, self.manager.id, client.id
+        )
+
+    def test_inbox_sorted_by_recency_with_unread(self):
+        first, second, third = self.clients
+        self.send(first, first, 'привет')
+        self.send(first, first, 'есть вопрос')
+        self.send(self.manager, second, 'добрый день')
+        self.send(third, third, 'жду ответа')
+
+        response = self.api_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(
+            [item['client']['id'] for item in results],
+            [third.id, second.id, first.id]
+        )
+        self.assertEqual([item['unread'] for item in results], [1, 0, 2])
+        self.assertEqual(results[0]['last_message']['content'],
+                         'жду ответа')
+        self.assertEqual(results[2]['last_seq'], 2)
+
+        self.api_client.login(username='client1', password='test12345')
+        response = self.api_client.get(self.url)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['unread'], 1)
+
+    def test_inbox_pages_walk_all_conversations(self):
+        for client in self.clients:
+            self.send(client, client, 'сообщение')
+        seen = []
+        params = {'limit': 2}
+        while True:
+            response = self.api_client.get(self.url, params)
+            seen.extend(item['id'] for item in response.data['results'])
+            if response.data['before'] is None:
+                break
+            params = {'limit': 2, 'before': response.data['before']}
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+
+    def test_inbox_queries_do_not_grow_with_conversations(self):
+        self.send(self.clients[0], self.clients[0], 'раз')
+        with CaptureQueriesContext(connection) as queries:
+            self.api_client.get(self.url)
+        few = len(queries)
+        for client in self.clients:
+            for i in range(3):
+                self.send(client, client, f'сообщение {i}')
+        with CaptureQueriesContext(connection) as queries:
+            self.api_client.get(self.url)
+        self.assertEqual(len(queries), few)
+
+    def test_mark_read(self):
+        client = self.clients[0]
+        for i in range(3):
+            self.send(client, client, f'сообщение {i}')
+        conversation = Conversation.objects.get(client=client)
+        url = reverse('conversations-read', args=[conversation.id])
+
+        response = self.api_client.post(url, {'seq': 2})
+        self.assertEqual(response.data, {'read_seq': 2, 'unread': 1})
+        response = self.api_client.post(url)
+        self.assertEqual(response.data, {'read_seq': 3, 'unread': 0})
+        # Отметка не сдвигается назад.
+        response = self.api_client.post(url, {'seq': 1})
+        self.assertEqual(response.data, {'read_seq': 3, 'unread': 0})
+
+        self.api_client.login(username='client1', password='test12345')
+        response = self.api_client.post(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_receipts_apply_in_one_batch(self):
+        for client in self.clients:
+            for i in range(3):
+                self.send(client, client, f'сообщение {i}')
+        first, second, third = self.clients
+        last = ChatMessage.objects.filter(receiver=self.manager,
+                                          sender=second).latest('seq')
+        marks = {(self.manager.id, first.id, self.manager.id):
+                 {'delivered': 99, 'read': 2},
+                 (self.manager.id, first.id, first.id): {'delivered': 1},
+                 (self.manager.id, third.id, self.manager.id):
+                 {'read': 1},
+                 # Не участник диалога.
+                 (self.manager.id, third.id, first.id): {'read': 3}}
+        message_ids = {(self.manager.id, second.id, self.manager.id):
+                       {'read': last.id},
+                       (self.manager.id, first.id, self.manager.id):
+                       {'read': last.id}}
+        # Четыре запроса и точка сохранения транзакции.
+        with self.assertNumQueries(6):
+            states = services.apply_receipts(marks, message_ids)
+        self.assertEqual(
+            [(s['client_id'], s['user_id'], s['delivered'], s['read'],
+              s['unread']) for s in states],
+            [(first.id, self.manager.id, 3, 2, 1),
+             (first.id, first.id, 1, 0, 0),
+             (third.id, self.manager.id, 1, 1, 2),
+             (second.id, self.manager.id, 3, 3, 0)]
+        )
+        # Повтор ничего не сдвигает и не пишет.
+        with self.assertNumQueries(3):
+            states = services.apply_receipts(marks)
+        self.assertFalse(any(state['changed'] for state in states))
+
+        self.api_client.login(username='client0', password='test12345')
+        response = self.api_client.get(reverse('messages-list'))
+        self.assertEqual(
+            [(item['seq'], item['delivered'], item['read'])
+             for item in response.data],
+            [(3, True, False), (2, True, True), (1, True, True)]
+        )
+
+    def test_batch_persist_updates_summary(self):
+        client = self.clients[0]
+        pair = (self.manager.id, client.id)
+        conversation_id, seq = services.allocate_seqs({pair: 2})[pair]
+        messages = [
+            ChatMessage(sender=client, receiver=self.manager,
+                        content=f'пачка {i}', conversation_id=conversation_id,
+                        seq=seq + i)
+            for i in range(2)
+        ]
+        services.persist_messages(messages)
+        conversation = Conversation.objects.get(pk=conversation_id)
+        self.assertEqual(conversation.manager_unread, 2)
+        self.assertEqual(conversation.client_unread, 0)
+        self.assertEqual(conversation.last_message_id, messages[1].pk)
+
+    def test_rebuild_conversations_fixes_drift(self):
+        client = self.clients[0]
+        self.send(client, client, 'раз')
+        last = self.send(self.manager, client, 'два')
+        Conversation.objects.update(manager_unread=7, client_unread=0,
+                                    last_message=None)
+
+        out = io.StringIO()
+        call_command('rebuild_conversations', '--dry-run', stdout=out)
+        self.assertIn('Найдено расхождений: 1', out.getvalue())
+        self.assertEqual(Conversation.objects.get().manager_unread, 7)
+
+        call_command('rebuild_conversations', stdout=io.StringIO())
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.manager_unread, 1)
+        self.assertEqual(conversation.client_unread, 1)
+        self.assertEqual(conversation.last_message_id, last.pk)
+        self.assertEqual(conversation.last_seq, 2)
+
+        out = io.StringIO()
+        call_command('rebuild_conversations', stdout=out)
+        self.assertIn('Исправлено: 0', out.getvalue())
+
+
+class RecordingWriter(MessageWriter):
+    """
+    MessageWriter без БД: запоминает размеры записанных пачек.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def write(self, batch):
+        self.batches.append(len(batch))
+
+
+class StalledWriter(RecordingWriter):
+    async def run(self):
+        await asyncio.Event().wait()
+
+
+class SlowWriter(RecordingWriter):
+    def write(self, batch):
+        time.sleep(0.05)
+        super().write(batch)
+
+
+class MessageWriterTests(SimpleTestCase):
+    async def test_flushes_in_batches(self):
+        writer = RecordingWriter(batch_size=2, flush_interval_ms=10_000)
+        for i in range(5):
+            await writer.put(i)
+        await writer.close()
+        self.assertEqual(sum(writer.batches), 5)
+        self.assertTrue(all(size <= 2 for size in writer.batches))
+
+    async def test_flushes_by_interval(self):
+        writer = RecordingWriter(batch_size=100, flush_interval_ms=10)
+        await writer.put(1)
+        await asyncio.sleep(0.1)
+        self.assertEqual(writer.batches, [1])
+        await writer.close()
+
+    async def test_flush_waits_for_batch_in_flight(self):
+        writer = SlowWriter(batch_size=2, flush_interval_ms=10_000)
+        for i in range(3):
+            await writer.put(i)
+        # Фоновая задача уже забрала первую пачку и пишет её.
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(writer), 1)
+        await writer.flush()
+        self.assertEqual(writer.batches, [2, 1])
+        await writer.flush()
+        await writer.close()
+
+    async def test_overflow_when_queue_is_full(self):
+        writer = StalledWriter(max_queue=2, put_timeout=0.05)
+        await writer.put(1)
+        await writer.put(2)
+        with self.assertRaises(WriteBehindOverflow):
+            await writer.put(3)
+        await writer.close()
+        self.assertEqual(writer.batches, [2])
+
+
+class FailingReceiptBuffer(ReceiptBuffer):
+    """
+    ReceiptBuffer без БД: пока `fail`, запись падает.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.fail = True
+        self.applied = []
+
+    def apply(self, marks, message_ids):
+        if self.fail:
+            raise DatabaseError('база недоступна')
+        self.applied.append((marks, message_ids))
+        return []
+
+
+class ReceiptBufferTests(SimpleTestCase):
+    async def test_failed_flush_is_retried_with_high_water_marks(self):
+        buffer = FailingReceiptBuffer(flush_interval_ms=10_000)
+        buffer.add(None, 1, 2, 1, 'read', seq=5)
+        buffer.add(None, 1, 2, 1, 'read', message_id=40)
+        with self.assertLogs('chat.receipts', 'ERROR'):
+            await buffer.flush()
+        self.assertEqual(len(buffer), 2)
+
+        buffer.add(None, 1, 2, 1, 'read', seq=3)
+        buffer.add(None, 1, 2, 1, 'delivered', seq=7)
+        buffer.fail = False
+        await buffer.flush()
+        buffer.task.cancel()
+        self.assertEqual(buffer.applied, [(
+            {(1, 2, 1): {'read': 5, 'delivered': 7}},
+            {(1, 2, 1): {'read': 40}},
+        )])
+        self.assertEqual(len(buffer), 0)
+
+
+class RelationCacheTests(SimpleTestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = RelationCache(ttl=0)
+        cache.set(1, 2, True)
+        self.assertIsNone(cache.get(1, 2))
+
+    def test_size_is_bounded_lru(self):
+        cache = RelationCache(max_size=2)
+        cache.set(1, 1, True)
+        cache.set(1, 2, True)
+        cache.get(1, 1)
+        cache.set(1, 3, False)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(1, 2))
+        self.assertTrue(cache.get(1, 1))
+        self.assertFalse(cache.get(1, 3))
+
+    def test_invalidate_manager_drops_all_pairs(self):
+        cache = RelationCache()
+        cache.set(1, 2, True)
+        cache.set(1, 3, True)
+        cache.set(4, 2, True)
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1, 2))
+        self.assertIsNone(cache.get(1, 3))
+        self.assertTrue(cache.get(4, 2))
+
+    def test_stale_read_is_not_cached_after_invalidation(self):
+        cache = RelationCache()
+        generation = cache.generation
+        cache.invalidate(1, 2)
+        cache.set(1, 2, True, generation)
+        self.assertIsNone(cache.get(1, 2))
+
+    def test_invalidation_reaches_other_process_through_shared_cache(self):
+        # Два процесса с общим кэшем Django.
+        caches['default'].clear()
+        first = RelationCache(store='default')
+        second = RelationCache(store='default')
+        first.set(1, 2, True)
+        second.set(1, 2, True)
+        second.set(1, 3, True)
+        versions = second.versions(1, 2)
+
+        first.invalidate(1, 2)
+        self.assertIsNone(second.get(1, 2))
+        self.assertTrue(second.get(1, 3))
+        # Значение, прочитанное из БД до инвалидации, не отдаётся.
+        second.set(1, 2, True, versions=versions)
+        self.assertIsNone(second.get(1, 2))
+
+        first.invalidate(1)
+        self.assertIsNone(second.get(1, 3))
+        first.invalidate_pairs([(4, 5)])
+        second.set(4, 6, False)
+        self.assertFalse(second.get(4, 6))
+
+
+class RelationCacheInvalidationTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create(username='client')
+        self.other_client = User.objects.create(username='other_client')
+        relation_cache.clear()
+
+    def test_create_update_delete_invalidate_cache(self):
+        relation_cache.set(self.manager.id, self.client_user.id, False)
+        relation = ChatRelation.objects.create(
+            manager=self.manager, client=self.client_user
+        )
+        self.assertIsNone(
+            relation_cache.get(self.manager.id, self.client_user.id)
+        )
+
+        relation_cache.set(self.manager.id, self.client_user.id, True)
+        self.api_client = APIClient()
+        self.api_client.login(username='manager', password='test12345')
+        self.api_client.patch(
+            reverse('relations-detail', args=[relation.id]),
+            {'client_id': self.other_client.id}, format='json'
+        )
+        self.assertIsNone(
+            relation_cache.get(self.manager.id, self.client_user.id)
+        )
+
+        relation_cache.set(self.manager.id, self.other_client.id, True)
+        self.api_client.delete(reverse('relations-detail', args=[relation.id]))
+        self.assertIsNone(
+            relation_cache.get(self.manager.id, self.other_client.id)
+        )
+
+
+class RelationBulkTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.other_manager = User.objects.create(username='other_manager',
+                                                 is_staff=True)
+        self.clients = [User.objects.create(username=f'client{i}')
+                        for i in range(5)]
+        for client in self.clients[:3]:
+            ChatRelation.objects.create(manager=self.manager, client=client)
+        relation_cache.clear()
+        self.api_client = APIClient()
+        self.api_client.login(username='manager', password='test12345')
+
+    def test_relations_are_listed_in_pages_by_ordering(self):
+        url = reverse('relations-list')
+        names, cursor = [], None
+        while True:
+            params = {'ordering': '-client_name', 'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.api_client.get(url, params)
+            names += [relation['client']['username']
+                      for relation in response.data['results']]
+            cursor = response.data['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(names, ['client2', 'client1', 'client0'])
+        response = self.api_client.get(url, {'ordering': 'email'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_pair_is_unique(self):
+        response = self.api_client.post(reverse('relations-list'), {
+            'manager_id': self.manager.id, 'client_id': self.clients[0].id,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ChatRelation.objects.create(manager=self.manager,
+                                        client=self.clients[0])
+
+    def test_import_creates_missing_relations_in_one_batch(self):
+        relation_cache.set(self.manager.id, self.clients[4].id, False)
+        relations = [{'manager_id': self.manager.id, 'client_id': client.id}
+                     for client in self.clients]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.api_client.post(reverse('relations-import'),
+                                            {'relations': relations},
+                                            format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'created': 2, 'existing': 3})
+        inserts = [q for q in queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(
+            ChatRelation.objects.filter(manager=self.manager).count(), 5
+        )
+        self.assertIsNone(relation_cache.get(self.manager.id,
+                                             self.clients[4].id))
+        response = self.api_client.post(reverse('relations-import'), {
+            'relations': [{'manager_id': self.manager.id, 'client_id': 999}]
+        }, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['missing'], [999])
+
+    def test_reassign_moves_clients_and_merges_duplicates(self):
+        ChatRelation.objects.create(manager=self.other_manager,
+                                    client=self.clients[0])
+        relation_cache.set(self.manager.id, self.clients[1].id, True)
+        relation_cache.set(self.other_manager.id, self.clients[1].id, False)
+        response = self.api_client.post(reverse('relations-reassign'), {
+            'from_manager_id': self.manager.id,
+            'to_manager_id': self.other_manager.id,
+            'clients': 'all',
+        }, format='json')
+        self.assertEqual(response.data, {'moved': 2, 'merged': 1})
+        self.assertFalse(ChatRelation.objects.filter(
+            manager=self.manager).exists())
+        self.assertEqual(sorted(ChatRelation.objects.filter(
+            manager=self.other_manager
+        ).values_list('client_id', flat=True)),
+            [client.id for client in self.clients[:3]])
+        self.assertIsNone(relation_cache.get(self.manager.id,
+                                             self.clients[1].id))
+        self.assertIsNone(relation_cache.get(self.other_manager.id,
+                                             self.clients[1].id))
+
+        client_api = APIClient()
+        client_api.force_authenticate(self.clients[0])
+        response = client_api.post(reverse('relations-reassign'), {
+            'from_manager_id': self.other_manager.id,
+            'to_manager_id': self.manager.id, 'clients': 'all',
+        }, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_reassign_takes_only_callers_clients(self):
+        ChatRelation.objects.create(manager=self.other_manager,
+                                    client=self.clients[3])
+        response = self.api_client.post(reverse('relations-reassign'), {
+            'from_manager_id': self.other_manager.id,
+            'to_manager_id': self.manager.id,
+            'clients': 'all',
+        }, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(ChatRelation.objects.filter(
+            manager=self.other_manager, client=self.clients[3]).exists())
+
+    def test_reassign_target_must_be_staff(self):
+        response = self.api_client.post(reverse('relations-reassign'), {
+            'from_manager_id': self.manager.id,
+            'to_manager_id': self.clients[4].id,
+            'clients': 'all',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            ChatRelation.objects.filter(manager=self.manager).count(), 3
+        )
+        self.assertFalse(ChatRelation.objects.filter(
+            manager=self.clients[4]).exists())
+
+    def test_bulk_changes_invalidate_other_processes(self):
+        # Кэш другого процесса с тем же общим кэшем версий.
+        other = RelationCache(store='default')
+        for client in self.clients:
+            other.set(self.manager.id, client.id, True)
+        other.set(self.other_manager.id, self.clients[3].id, False)
+        self.api_client.post(reverse('relations-import'), {
+            'relations': [{'manager_id': self.other_manager.id,
+                           'client_id': self.clients[3].id}]
+        }, format='json')
+        self.assertIsNone(other.get(self.other_manager.id,
+                                    self.clients[3].id))
+        self.assertTrue(other.get(self.manager.id, self.clients[0].id))
+
+        self.api_client.post(reverse('relations-reassign'), {
+            'from_manager_id': self.manager.id,
+            'to_manager_id': self.other_manager.id,
+            'clients': [self.clients[0].id],
+        }, format='json')
+        self.assertIsNone(other.get(self.manager.id, self.clients[0].id))
+        self.assertTrue(other.get(self.manager.id, self.clients[1].id))
+
+        self.api_client.post(reverse('relations-reassign'), {
+            'from_manager_id': self.manager.id,
+            'to_manager_id': self.other_manager.id,
+            'clients': 'all',
+        }, format='json')
+        for client in self.clients:
+            self.assertIsNone(other.get(self.manager.id, client.id))
+
+
+class StubUser:
+    is_authenticated = True
+
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+@override_settings(
+    CHANNEL_LAYERS={
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+)
+class ConnectionLifecycleTests(SimpleTestCase):
+    async def churn(self, count):
+        for i in range(count):
+            user = StubUser(1000 + i % 50)
+            if i % 2:
+                path = "/ws/chat/"
+            else:
+                # Доступ берётся из кэша, БД не нужна.
+                path = f"/ws/chat/{user.id}/{user.id + 1}/"
+                relation_cache.set(user.id, user.id + 1, True)
+            communicator = WebsocketCommunicator(application, path)
+            communicator.scope["user"] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+
+    async def test_disconnect_leaves_notification_group(self):
+        live = tracker.live_connections
+        memberships = tracker.live_memberships
+        relation_cache.set(1, 2, True)
+        communicator = WebsocketCommunicator(application, "/ws/chat/1/2/")
+        communicator.scope["user"] = StubUser(1)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        layer = get_channel_layer()
+        self.assertIn("user_1_notifications", layer.groups)
+        self.assertEqual(tracker.live_connections, live + 1)
+        self.assertEqual(tracker.live_memberships, memberships + 2)
+        await communicator.disconnect()
+        self.assertNotIn("user_1_notifications", layer.groups)
+        self.assertNotIn("chat_1_2", layer.groups)
+        self.assertEqual(tracker.live_connections, live)
+
+    async def test_soak_membership_stays_bounded(self):
+        """
+        10 000 подключений и отключений не оставляют членств в группах,
+        а чистка удаляет подброшенные «осиротевшие» членства.
+        """
+        layer = get_channel_layer()
+        # Периодическая чистка не должна сработать посреди теста.
+        tracker.sweep_interval = 3600
+        tracker.last_sweep = time.monotonic()
+        self.addCleanup(setattr, tracker, 'sweep_interval', 60.0)
+        await tracker.sweep(layer)
+        live = tracker.live_connections
+        # Соединения, закрытые без group_discard (например, отменённые
+        # посреди подключения), и чужой канал, которого чистка не трогает.
+        for i in range(25):
+            orphan = await layer.new_channel()
+            tracker.opened(orphan)
+            for group in (f"user_{i}_notifications", "chat_1_2"):
+                tracker.joined(orphan, group)
+                await layer.group_add(group, orphan)
+            tracker.closed(orphan)
+        foreign = await layer.new_channel()
+        await layer.group_add("foreign", foreign)
+        opened = tracker.stats()['opened_total']
+
+        await self.churn(10_000)
+
+        self.assertEqual(tracker.stats()['opened_total'] - opened, 10_000)
+        self.assertEqual(tracker.live_connections, live)
+        self.assertEqual(await tracker.sweep(layer), 50)
+        self.assertEqual(list(layer.groups), ["foreign"])
+        self.assertEqual(await tracker.sweep(layer), 0)
+
+
+class CodecTests(SimpleTestCase):
+    def test_dumps_is_compact_utf8(self):
+        text = codec.dumps({"message": "Привет", "id": 1})
+        self.assertEqual(text, '{"message":"Привет","id":1}')
+        self.assertEqual(codec.loads(text), {"message": "Привет", "id": 1})
+
+    def test_loads_raises_json_decode_error(self):
+        with self.assertRaises(json.JSONDecodeError):
+            codec.loads("{not json")
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+        self.assertEqual([bucket.take(now=0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(now=0), 0.5)
+        self.assertEqual(bucket.take(now=0.5), 0)
+        # Запас не растёт выше burst.
+        bucket.take(now=100)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class PresenceTests(SimpleTestCase):
+    def test_typing_throttle_coalesces_frames(self):
+        throttle = TypingThrottle(interval=2)
+        frames = [throttle.allow('1_2', True, now=t / 10) for t in range(30)]
+        # Три секунды нажатий – два события «печатает».
+        self.assertEqual(frames.count(True), 2)
+        self.assertTrue(throttle.allow('1_2', False, now=3))
+        self.assertFalse(throttle.allow('1_2', False, now=3))
+        throttle.allow('1_2', True, now=4)
+        throttle.reset('1_2')
+        self.assertFalse(throttle.allow('1_2', False, now=4))
+
+    def test_local_store_expires_connections(self):
+        store = LocalPresenceStore()
+
+        async def scenario():
+            await store.touch('1_2', 1, 'a', ttl=30)
+            await store.touch('1_2', 2, 'b', ttl=-1)
+            await store.touch('1_2', 1, 'c', ttl=30)
+            online = await store.online('1_2')
+            await store.remove('1_2', 1, 'a')
+            return online, await store.online('1_2')
+
+        self.assertEqual(asyncio.run(scenario()), ([1], [1]))
+
+
+class ShardingTests(SimpleTestCase):
+    def test_adding_node_moves_only_its_share(self):
+        groups = [f'chat_{i}_{i + 1}' for i in range(20_000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [group for group in groups
+                 if before.index(group) != after.index(group)]
+        # Переезжают только группы нового узла, около четверти.
+        self.assertEqual({after.index(group) for group in moved}, {3})
+        self.assertAlmostEqual(len(moved) / len(groups), 0.25, delta=0.05)
+        load = collections.Counter(after.index(group) for group in groups)
+        self.assertLess(max(load.values()) / (len(groups) / 4), 1.2)
+
+    def test_process_channels_share_a_node(self):
+        layer = ShardedRedisChannelLayer(
+            hosts=['redis://a:6379', 'redis://b:6379', 'redis://c:6379']
+        )
+        prefix = f'specific.{layer.client_prefix}!'
+        self.assertEqual(
+            {layer.consistent_hash(prefix + str(i)) for i in range(50)},
+            {layer.consistent_hash(prefix)}
+        )
+        # Узел зависит от имени, а не от позиции в hosts.
+        reordered = ShardedRedisChannelLayer(
+            hosts=['redis://c:6379', 'redis://a:6379', 'redis://b:6379']
+        )
+        self.assertEqual(
+            reordered.hosts[reordered.consistent_hash('chat_1_2')],
+            layer.hosts[layer.consistent_hash('chat_1_2')]
+        )
+
+
+class FanOutTests(SimpleTestCase):
+    def test_plan_sends_each_channel_once(self):
+        batches = plan(
+            [("room", "message"), ("notify", "notification")],
+            {"room": ["a", "b"], "notify": ["b", "c"]},
+        )
+        self.assertEqual(batches, [("message", ["a", "b"]),
+                                   ("notification", ["c"])])
+
+    async def test_fan_out_deduplicates_in_memory(self):
+        layer = InMemoryChannelLayer()
+        room_member = await layer.new_channel()
+        other_device = await layer.new_channel()
+        await layer.group_add("room", room_member)
+        await layer.group_add("notify", room_member)
+        await layer.group_add("notify", other_device)
+        await fan_out(layer, [
+            ("room", {"type": "chat.message"}),
+            ("notify", {"type": "new.message.notify"}),
+        ])
+        self.assertEqual((await layer.receive(room_member))["type"],
+                         "chat.message")
+        self.assertEqual((await layer.receive(other_device))["type"],
+                         "new.message.notify")
+        self.assertNotIn(room_member, layer.channels)
+
+    async def test_redis_layer_internals(self):
+        """
+        Закрытые методы channels_redis, на которые опирается RedisAdapter,
+        есть в закреплённой версии; без них рассылка идёт через group_send.
+        """
+        self.assertIsInstance(get_adapter(RedisChannelLayer()), RedisAdapter)
+
+        class ChangedLayer(RedisChannelLayer):
+            def _group_key(self, group, prefix=None):
+                return group
+
+            async def group_send(self, group, message):
+                sent.append(group)
+
+        sent = []
+        with self.assertLogs('chat.fanout', 'WARNING'):
+            self.assertIsNone(get_adapter(ChangedLayer()))
+        await fan_out(ChangedLayer(), [('room', {'type': 'chat.message'})])
+        self.assertEqual(sent, ['room'])
+
+
+@override_settings(CHAT_FRAMING={'ALLOW_BATCH': True, 'BATCH_MAX_EVENTS': 3,
+                                 'BATCH_MAX_DELAY_MS': 20})
+class FramingTests(SimpleTestCase):
+    def setUp(self):
+        self.frames = []
+
+    async def send_frame(self, text_data=None, bytes_data=None):
+        self.frames.append(text_data if text_data is not None
+                           else bytes_data)
+
+    async def test_events_are_batched_by_count_and_delay(self):
+        framing = Framing(self.send_frame, batch=True)
+        for i in range(4):
+            await framing.event(codec.dumps({"seq": i}))
+        self.assertEqual(self.frames, ['[{"seq":0},{"seq":1},{"seq":2}]'])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.frames[1:], ['[{"seq":3}]'])
+        framing.close()
+
+    async def test_reply_flushes_pending_events_first(self):
+        framing = Framing(self.send_frame, batch=True, encoding='msgpack')
+        await framing.event(codec.dumps({"seq": 1}))
+        await framing.send(codec.dumps({"error": "x"}))
+        self.assertEqual([msgpack.unpackb(frame) for frame in self.frames],
+                         [[{"seq": 1}], {"error": "x"}])
+        framing.close()
+
+    def test_negotiate_rejects_unknown_encoding(self):
+        self.assertEqual(negotiate({"batch": ["1"]}), (True, 'json'))
+        self.assertEqual(negotiate({"encoding": ["msgpack"]}),
+                         (False, 'msgpack'))
+        with self.assertRaises(ValueError):
+            negotiate({"encoding": ["cbor"]})
+
+
+class DatabaseExecutorTests(SimpleTestCase):
+    def setUp(self):
+        # Потоки общего пула держат соединения прошлых тестов.
+        db.reset_executor()
+        self.addCleanup(db.reset_executor)
+
+    async def test_calls_run_in_parallel_on_the_pool(self):
+        @db_sync_to_async
+        def blocking():
+            time.sleep(0.1)
+            return threading.current_thread().name
+
+        started = time.perf_counter()
+        names = await asyncio.gather(*(blocking() for _ in range(8)))
+        # Восемь вызовов по 100 мс – не 800 мс в одном потоке.
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertTrue(all(name.startswith('chat-db') for name in names))
+
+    async def test_sqlite_writes_stay_on_the_shared_thread(self):
+        @db_sync_to_async(write=True)
+        def write():
+            return threading.current_thread().name
+
+        self.assertFalse((await write()).startswith('chat-db'))
+
+
+class LocalChannelLayerTests(SimpleTestCase):
+    async def test_group_send_hands_off_without_copy(self):
+        layer = LocalChannelLayer()
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add('room', first)
+        await layer.group_add('room', second)
+        waiting = asyncio.ensure_future(layer.receive(first))
+        await asyncio.sleep(0)
+        message = {'type': 'chat.message', 'text': 'привет'}
+        await layer.group_send('room', message)
+        # Ожидающий receive получает сообщение напрямую, мимо очереди.
+        self.assertIs(await waiting, message)
+        self.assertNotIn(first, layer.queues)
+        self.assertIs(await layer.receive(second), message)
+        await layer.group_discard('room', second)
+        self.assertEqual(layer.groups, {'room': {first}})
+
+    async def test_capacity_and_expiry_match_channels_redis(self):
+        layer = LocalChannelLayer(expiry=0.05, group_expiry=0.05,
+                                  capacity=1, cleanup_interval=0)
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        await layer.send(channel, {'type': 'first'})
+        with self.assertRaises(ChannelFull):
+            await layer.send(channel, {'type': 'second'})
+        # group_send полный канал пропускает.
+        await layer.group_send('room', {'type': 'third'})
+        self.assertEqual((await layer.receive(channel))['type'], 'first')
+
+        await layer.send(channel, {'type': 'stale'})
+        await asyncio.sleep(0.06)
+        await layer.send(channel, {'type': 'fresh'})
+        self.assertEqual((await layer.receive(channel))['type'], 'fresh')
+        # Членство истекло, а канал из-за истёкшего сообщения не удалялся.
+        self.assertEqual(await layer.group_channels(['room']), {'room': []})
+
+    async def test_fan_out_uses_layer_batch(self):
+        layer = LocalChannelLayer()
+        room_member, other_device = [await layer.new_channel()
+                                     for _ in range(2)]
+        await layer.group_add('room', room_member)
+        await layer.group_add('notify', room_member)
+        await layer.group_add('notify', other_device)
+        await fan_out(layer, [
+            ('room', {'type': 'chat.message'}),
+            ('notify', {'type': 'new.message.notify'}),
+        ])
+        self.assertEqual([entry[1]['type']
+                          for entry in layer.queues[room_member]],
+                         ['chat.message'])
+        self.assertEqual((await layer.receive(other_device))['type'],
+                         'new.message.notify')
+
+    async def test_cancelled_receive_keeps_message(self):
+        layer = LocalChannelLayer()
+        channel = await layer.new_channel()
+        waiting = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+        await layer.send(channel, {'type': 'kept'})
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual((await layer.receive(channel))['type'], 'kept')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(
+            username='manager', password='test12345', is_staff=True
+        )
+        self.client_user = User.objects.create_user(
+            username='client', password='test12345'
+        )
+        self.api_client = APIClient()
+
+    def test_render_prometheus_text(self):
+        observed = metrics.histogram('chat_test_seconds', 'Тест.',
+                                     buckets=(0.1, 1))
+        self.addCleanup(metrics.REGISTRY.pop, 'chat_test_seconds')
+        observed.observe(0.05)
+        observed.observe(0.5)
+        observed.observe(5)
+        text = metrics.render()
+        self.assertIn('# TYPE chat_test_seconds histogram\n'
+                      'chat_test_seconds_bucket{le="0.1"} 1\n'
+                      'chat_test_seconds_bucket{le="1"} 2\n'
+                      'chat_test_seconds_bucket{le="+Inf"} 3\n'
+                      'chat_test_seconds_sum 5.55\n'
+                      'chat_test_seconds_count 3\n', text)
+
+    @override_settings(CHAT_METRICS={'ALLOWED_IPS': ('127.0.0.1',)})
+    def test_endpoint_counts_request_queries(self):
+        self.api_client.force_authenticate(user=self.client_user)
+        before = middleware.request_queries.count
+        self.api_client.get(reverse('messages-list'))
+        self.assertEqual(middleware.request_queries.count, before + 1)
+
+        response = self.api_client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('chat_http_request_queries_count',
+                      response.content.decode())
+
+    def test_endpoint_closed_to_non_staff(self):
+        # По умолчанию адресов нет: локальный REMOTE_ADDR за прокси не
+        # открывает метрики.
+        self.assertEqual(self.api_client.get(reverse('metrics')).status_code,
+                         403)
+        # /metrics – обычное представление Django, нужна сессия.
+        self.api_client.force_login(self.client_user)
+        response = self.api_client.get(reverse('metrics'),
+                                       REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+        self.api_client.force_login(self.manager)
+        response = self.api_client.get(reverse('metrics'),
+                                       REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+
+
 @override_settings(
     CHANNEL_LAYERS={
         'default': {
@@ -304,6 +1924,9 @@ class ChatConsumerTests(ChannelsLiveServerTestCase):
             password='test123',
             is_staff=False
         )
+        relation_cache.clear()
+        user_buckets.clear()
+        local_presence.clear()
 
     async def test_manager_client_communication(self):
         """
@@ -341,15 +1964,20 @@ class ChatConsumerTests(ChannelsLiveServerTestCase):
         response = await client_communicator.receive_json_from()
         self.assertEqual(response["sender_id"], self.manager.id)
         self.assertEqual(response["message"], "Привет от менеджера")
+        self.assertEqual(response["conversation"],
+                         f"{self.manager.id}_{self.client_user.id}")
 
         # Клиент отправляет сообщение
         await client_communicator.send_json_to(
             {"message": "Привет от клиента"})
 
+        # Менеджер в комнате получает сообщение один раз, без повторного
+        # уведомления.
         first_response = await manager_communicator.receive_json_from()
         second_response = await manager_communicator.receive_json_from()
         self.assertEqual(second_response["sender_id"], self.client_user.id)
         self.assertEqual(second_response["message"], "Привет от клиента")
+        self.assertTrue(await manager_communicator.receive_nothing())
 
         # Закрываем соединения
         await manager_communicator.disconnect()
@@ -408,8 +2036,9 @@ class ChatConsumerTests(ChannelsLiveServerTestCase):
 
     async def test_notification_delivery(self):
         """
-        Тестируем, что при отправке сообщения получатель (client) получает два события:
-        обычное сообщение и отдельное уведомление с ключом "notification": True.
+        Тестируем, что получатель, находящийся в комнате, получает сообщение
+        ровно один раз: уведомление с ключом "notification": True ему
+        не дублируется.
         """
         manager_communicator = WebsocketCommunicator(
             application=application,
@@ -430,26 +2059,46 @@ class ChatConsumerTests(ChannelsLiveServerTestCase):
         await manager_communicator.send_json_to(
             {"message": "Сообщение с уведомлением"})
 
-        responses = []
-        for _ in range(2):
-            responses.append(await client_communicator.receive_json_from())
+        response = await client_communicator.receive_json_from()
+        self.assertNotIn("notification", response)
+        self.assertEqual(response["sender_id"], self.manager.id)
+        self.assertEqual(response["message"], "Сообщение с уведомлением")
+        self.assertTrue(await client_communicator.receive_nothing(),
+                        "Уведомление не должно дублировать сообщение")
 
-        notifications = [resp for resp in responses if
-                         resp.get("notification") is True]
-        normal_messages = [resp for resp in responses if
-                           "notification" not in resp]
+        await manager_communicator.disconnect()
+        await client_communicator.disconnect()
 
-        self.assertEqual(len(notifications), 1,
-                         "Должно прийти ровно одно уведомление")
-        self.assertEqual(len(normal_messages), 1,
-                         "Должно прийти ровно одно обычное сообщение")
+    async def test_notification_delivered_outside_the_room(self):
+        """
+        Получатель, подключённый к другой комнате, получает уведомление
+        с ключом "notification": True.
+        """
+        client2 = await sync_to_async(User.objects.create_user)(
+            username='client2', password='test123'
+        )
+        await sync_to_async(ChatRelation.objects.create)(
+            manager=self.manager, client=client2
+        )
+        manager_communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{self.manager.id}/{client2.id}/"
+        )
+        manager_communicator.scope["user"] = self.manager
+        client_communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        )
+        client_communicator.scope["user"] = self.client_user
+        connected, _ = await manager_communicator.connect()
+        self.assertTrue(connected)
+        connected, _ = await client_communicator.connect()
+        self.assertTrue(connected)
 
-        self.assertEqual(notifications[0]["sender_id"], self.manager.id)
-        self.assertEqual(notifications[0]["message"],
-                         "Сообщение с уведомлением")
-        self.assertEqual(normal_messages[0]["sender_id"], self.manager.id)
-        self.assertEqual(normal_messages[0]["message"],
-                         "Сообщение с уведомлением")
+        await client_communicator.send_json_to({"message": "Вы тут?"})
+        response = await manager_communicator.receive_json_from()
+        self.assertTrue(response["notification"])
+        self.assertEqual(response["sender_id"], self.client_user.id)
+        self.assertEqual(response["message"], "Вы тут?")
+        self.assertTrue(await manager_communicator.receive_nothing())
 
         await manager_communicator.disconnect()
         await client_communicator.disconnect()
@@ -521,3 +2170,544 @@ class ChatConsumerTests(ChannelsLiveServerTestCase):
         await manager_communicator.disconnect()
         await client_comm1.disconnect()
         await client_comm2.disconnect()
+
+    async def test_write_behind_broadcasts_before_persisting(self):
+        """
+        В режиме write-behind сообщение рассылается с uid и timestamp,
+        а в БД появляется после сброса очереди.
+        """
+        with self.settings(CHAT_WRITE_BEHIND={'ENABLED': True}):
+            manager_communicator = WebsocketCommunicator(
+                application=application,
+                path=f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+            )
+            manager_communicator.scope["user"] = self.manager
+            client_communicator = WebsocketCommunicator(
+                application=application,
+                path=f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+            )
+            client_communicator.scope["user"] = self.client_user
+            connected, _ = await manager_communicator.connect()
+            self.assertTrue(connected)
+            connected, _ = await client_communicator.connect()
+            self.assertTrue(connected)
+
+            await manager_communicator.send_json_to(
+                {"message": "Отложенная запись"})
+            response = await client_communicator.receive_json_from()
+            self.assertEqual(response["message"], "Отложенная запись")
+            self.assertIn("timestamp", response)
+
+            await get_writer().drain()
+            stored = await sync_to_async(ChatMessage.objects.get)(
+                uid=response["uid"]
+            )
+            self.assertEqual(stored.content, "Отложенная запись")
+            self.assertEqual(stored.sender_id, self.manager.id)
+
+            await manager_communicator.disconnect()
+            await client_communicator.disconnect()
+
+    async def test_revoked_relation_takes_effect_immediately(self):
+        """
+        Удаление связи сбрасывает кэш: повторное подключение отклоняется.
+        """
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        communicator = WebsocketCommunicator(application, path)
+        communicator.scope["user"] = self.client_user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+        await sync_to_async(self.relation.delete)()
+
+        communicator = WebsocketCommunicator(application, path)
+        communicator.scope["user"] = self.client_user
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        await communicator.disconnect()
+
+    async def test_reconnect_is_served_from_cache(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        for _ in range(3):
+            communicator = WebsocketCommunicator(application, path)
+            communicator.scope["user"] = self.manager
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+        self.assertTrue(
+            relation_cache.get(self.manager.id, self.client_user.id)
+        )
+
+    async def test_multiplexed_consumer_routes_by_conversation(self):
+        """
+        Одно соединение менеджера обслуживает несколько диалогов: события
+        помечены conversation, а уведомление по подписанному диалогу
+        не дублируется.
+        """
+        client2 = await sync_to_async(User.objects.create_user)(
+            username='client2', password='test123'
+        )
+        await sync_to_async(ChatRelation.objects.create)(
+            manager=self.manager, client=client2
+        )
+        manager_communicator = WebsocketCommunicator(application, "/ws/chat/")
+        manager_communicator.scope["user"] = self.manager
+        connected, _ = await manager_communicator.connect()
+        self.assertTrue(connected)
+
+        first = f"{self.manager.id}_{self.client_user.id}"
+        second = f"{self.manager.id}_{client2.id}"
+        for conversation in (first, second):
+            await manager_communicator.send_json_to(
+                {"action": "subscribe", "conversation": conversation})
+            response = await manager_communicator.receive_json_from()
+            self.assertEqual(response["subscribed"], conversation)
+
+        # Клиент 2 пользуется старым консьюмером комнаты.
+        client_communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{self.manager.id}/{client2.id}/"
+        )
+        client_communicator.scope["user"] = client2
+        connected, _ = await client_communicator.connect()
+        self.assertTrue(connected)
+
+        await client_communicator.send_json_to({"message": "Привет"})
+        response = await manager_communicator.receive_json_from()
+        self.assertEqual(response["conversation"], second)
+        self.assertEqual(response["message"], "Привет")
+        self.assertNotIn("notification", response)
+        self.assertTrue(await manager_communicator.receive_nothing())
+
+        await manager_communicator.send_json_to(
+            {"action": "message", "conversation": second,
+             "message": "Ответ"})
+        response = await client_communicator.receive_json_from()
+        self.assertEqual(response["message"], "Привет")
+        response = await client_communicator.receive_json_from()
+        self.assertEqual(response["message"], "Ответ")
+        self.assertEqual(response["sender_id"], self.manager.id)
+
+        await manager_communicator.send_json_to(
+            {"action": "unsubscribe", "conversation": second})
+        while "unsubscribed" not in (
+                await manager_communicator.receive_json_from()):
+            pass
+        await client_communicator.send_json_to({"message": "Ещё"})
+        response = await manager_communicator.receive_json_from()
+        self.assertTrue(response["notification"])
+        self.assertEqual(response["conversation"], second)
+
+        await manager_communicator.disconnect()
+        await client_communicator.disconnect()
+
+    async def test_manager_broadcasts_from_one_connection(self):
+        client2 = await sync_to_async(User.objects.create_user)(
+            username='client2', password='test123'
+        )
+        await sync_to_async(ChatRelation.objects.create)(
+            manager=self.manager, client=client2
+        )
+        manager_communicator = WebsocketCommunicator(application, "/ws/chat/")
+        manager_communicator.scope["user"] = self.manager
+        room_communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        )
+        room_communicator.scope["user"] = self.client_user
+        inbox_communicator = WebsocketCommunicator(application, "/ws/chat/")
+        inbox_communicator.scope["user"] = client2
+        for communicator in (manager_communicator, room_communicator,
+                             inbox_communicator):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+        await manager_communicator.send_json_to({
+            "action": "broadcast", "message": "Объявление",
+            "clients": [self.client_user.id, client2.id,
+                        self.other_client.id],
+        })
+        response = await manager_communicator.receive_json_from()
+        self.assertEqual(response["broadcast"],
+                         {"sent": 2, "rejected": [self.other_client.id]})
+        response = await room_communicator.receive_json_from()
+        self.assertEqual(response["message"], "Объявление")
+        self.assertEqual(response["seq"], 1)
+        self.assertNotIn("notification", response)
+        response = await inbox_communicator.receive_json_from()
+        self.assertTrue(response["notification"])
+        self.assertEqual(response["conversation"],
+                         f"{self.manager.id}_{client2.id}")
+
+        # Не строка – та же ошибка, что в REST, а не падение при записи.
+        await manager_communicator.send_json_to({
+            "action": "broadcast", "message": {"text": "Объявление"},
+            "clients": "all",
+        })
+        response = await manager_communicator.receive_json_from()
+        self.assertEqual(response, {"error": "Сообщение не может быть пустым."})
+
+        # Клиент рассылать не может.
+        await inbox_communicator.send_json_to(
+            {"action": "broadcast", "message": "Спам", "clients": "all"})
+        response = await inbox_communicator.receive_json_from()
+        self.assertIn("error", response)
+
+        for communicator in (manager_communicator, room_communicator,
+                             inbox_communicator):
+            await communicator.disconnect()
+
+    async def test_presence_and_typing_do_not_touch_database(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        conversation = f"{self.manager.id}_{self.client_user.id}"
+        manager_communicator = WebsocketCommunicator(
+            application, path + "?presence=1"
+        )
+        manager_communicator.scope["user"] = self.manager
+        await manager_communicator.connect()
+        snapshot = await manager_communicator.receive_json_from()
+        self.assertEqual(snapshot, {"presence": conversation,
+                                    "online_users": [self.manager.id]})
+
+        client_communicator = WebsocketCommunicator(application, path)
+        client_communicator.scope["user"] = self.client_user
+        await client_communicator.connect()
+        self.assertEqual(await manager_communicator.receive_json_from(),
+                         {"presence": conversation,
+                          "user_id": self.client_user.id, "online": True})
+        # Поток нажатий сводится к одному событию «печатает» и одному
+        # «перестал»; лимит сообщений не расходуется.
+        with self.settings(CHAT_RATE_LIMIT={'CONNECTION_BURST': 2}):
+            for _ in range(30):
+                await client_communicator.send_json_to({"typing": True})
+            await client_communicator.send_json_to({"typing": False})
+            await client_communicator.send_json_to({"heartbeat": True})
+            frames = [await manager_communicator.receive_json_from()
+                      for _ in range(2)]
+            self.assertTrue(await manager_communicator.receive_nothing())
+            self.assertTrue(await client_communicator.receive_nothing())
+        self.assertEqual([f["active"] for f in frames], [True, False])
+        self.assertEqual({f["user_id"] for f in frames},
+                         {self.client_user.id})
+        self.assertFalse(await sync_to_async(
+            Conversation.objects.exists
+        )())
+
+        await client_communicator.disconnect()
+        self.assertEqual(await manager_communicator.receive_json_from(),
+                         {"presence": conversation,
+                          "user_id": self.client_user.id, "online": False})
+        await manager_communicator.disconnect()
+
+    async def test_acks_are_coalesced_into_one_receipt(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        manager_communicator = WebsocketCommunicator(application, path)
+        manager_communicator.scope["user"] = self.manager
+        await manager_communicator.connect()
+        client_communicator = WebsocketCommunicator(application, path)
+        client_communicator.scope["user"] = self.client_user
+        await client_communicator.connect()
+        for i in range(3):
+            await manager_communicator.send_json_to({"message": f"m{i}"})
+            await manager_communicator.receive_json_from()
+            frame = await client_communicator.receive_json_from()
+            await client_communicator.send_json_to(
+                {"ack": "delivered", "seq": frame["seq"]})
+        await client_communicator.send_json_to({"ack": "read", "seq": 2})
+        await client_communicator.send_json_to({"ack": "seen", "seq": 2})
+        error = await client_communicator.receive_json_from()
+        self.assertEqual(error["error"], "Некорректное подтверждение.")
+
+        receipt = await manager_communicator.receive_json_from()
+        self.assertEqual(receipt, {"receipts": [{
+            "conversation": f"{self.manager.id}_{self.client_user.id}",
+            "user_id": self.client_user.id, "delivered": 3, "read": 2,
+        }]})
+        self.assertTrue(await manager_communicator.receive_nothing())
+        conversation = await sync_to_async(Conversation.objects.get)(
+            manager=self.manager, client=self.client_user
+        )
+        self.assertEqual((conversation.client_delivered_seq,
+                          conversation.client_read_seq,
+                          conversation.client_unread), (3, 2, 1))
+        await manager_communicator.disconnect()
+        await client_communicator.disconnect()
+
+    async def test_multiplexed_consumer_rejects_foreign_conversation(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        communicator.scope["user"] = self.other_manager
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({
+            "action": "subscribe",
+            "conversation": f"{self.manager.id}_{self.client_user.id}",
+        })
+        response = await communicator.receive_json_from()
+        self.assertIn("error", response)
+        await communicator.disconnect()
+
+    async def test_ack_without_relation_is_rejected(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        communicator.scope["user"] = self.other_client
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({
+            "action": "ack",
+            "conversation": f"{self.other_manager.id}_{self.other_client.id}",
+            "ack": "read", "seq": 1,
+        })
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["error"], "Нет доступа к диалогу.")
+        key = (self.other_manager.id, self.other_client.id,
+               self.other_client.id)
+        self.assertNotIn(key, get_receipt_buffer().marks)
+        await communicator.disconnect()
+
+    async def test_negotiated_batches_arrive_as_msgpack_arrays(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        manager_communicator = WebsocketCommunicator(application, path)
+        manager_communicator.scope["user"] = self.manager
+        client_communicator = WebsocketCommunicator(
+            application, path + "?batch=1&encoding=msgpack"
+        )
+        client_communicator.scope["user"] = self.client_user
+        await manager_communicator.connect()
+        await client_communicator.connect()
+
+        for i in range(2):
+            await manager_communicator.send_json_to({"message": f"m{i}"})
+            await manager_communicator.receive_json_from()
+        frames = []
+        while sum(len(frame) for frame in frames) < 2:
+            frames.append(msgpack.unpackb(
+                (await client_communicator.receive_output())["bytes"]
+            ))
+        self.assertEqual([event["message"] for frame in frames
+                          for event in frame], ["m0", "m1"])
+        await client_communicator.send_json_to({"message": ""})
+        error = await client_communicator.receive_output()
+        self.assertEqual(msgpack.unpackb(error["bytes"]),
+                         {"error": "Сообщение не может быть пустым."})
+
+        await manager_communicator.disconnect()
+        await client_communicator.disconnect()
+
+    async def test_messages_carry_conversation_seq(self):
+        """
+        Номер сообщения растёт в диалоге в обе стороны и есть в кадре.
+        """
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        manager_communicator = WebsocketCommunicator(application, path)
+        manager_communicator.scope["user"] = self.manager
+        client_communicator = WebsocketCommunicator(application, path)
+        client_communicator.scope["user"] = self.client_user
+        await manager_communicator.connect()
+        await client_communicator.connect()
+
+        await manager_communicator.send_json_to({"message": "Первое"})
+        response = await client_communicator.receive_json_from()
+        self.assertEqual(response["seq"], 1)
+        await client_communicator.send_json_to({"message": "Второе"})
+        await manager_communicator.receive_json_from()
+        response = await manager_communicator.receive_json_from()
+        self.assertEqual(response["seq"], 2)
+        stored = await sync_to_async(ChatMessage.objects.get)(
+            uid=response["uid"]
+        )
+        self.assertEqual(stored.seq, 2)
+
+        await manager_communicator.disconnect()
+        await client_communicator.disconnect()
+
+    async def test_resume_streams_missed_messages_in_batches(self):
+        """
+        Переподключение с resume_from досылает только пропущенные
+        сообщения пачками, последняя помечена last.
+        """
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        manager_communicator = WebsocketCommunicator(application, path)
+        manager_communicator.scope["user"] = self.manager
+        await manager_communicator.connect()
+        for i in range(5):
+            await manager_communicator.send_json_to({"message": f"m{i}"})
+            await manager_communicator.receive_json_from()
+        await manager_communicator.disconnect()
+
+        with self.settings(CHAT_RESUME={'BATCH_SIZE': 2}):
+            client_communicator = WebsocketCommunicator(
+                application, f"{path}?resume_from=2"
+            )
+            client_communicator.scope["user"] = self.client_user
+            connected, _ = await client_communicator.connect()
+            self.assertTrue(connected)
+            batches = [await client_communicator.receive_json_from()]
+            while not batches[-1]["last"]:
+                batches.append(await client_communicator.receive_json_from())
+
+        self.assertEqual([len(batch["messages"]) for batch in batches],
+                         [2, 1])
+        messages = [m for batch in batches for m in batch["messages"]]
+        self.assertEqual([m["seq"] for m in messages], [3, 4, 5])
+        self.assertEqual([m["message"] for m in messages],
+                         ["m2", "m3", "m4"])
+        self.assertTrue(await client_communicator.receive_nothing())
+
+        # Повторная догрузка кадром с последнего номера пуста.
+        await client_communicator.send_json_to({"resume_from": 5})
+        response = await client_communicator.receive_json_from()
+        self.assertEqual(response["messages"], [])
+        self.assertTrue(response["last"])
+        await client_communicator.disconnect()
+
+    async def test_resume_includes_write_behind_queue(self):
+        """
+        Догрузка видит сообщения, которые ещё ждут в очереди write-behind.
+        """
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        writer = get_writer()
+        interval, writer.flush_interval = writer.flush_interval, 60
+        try:
+            with self.settings(CHAT_WRITE_BEHIND={'ENABLED': True}):
+                manager_communicator = WebsocketCommunicator(application,
+                                                             path)
+                manager_communicator.scope["user"] = self.manager
+                await manager_communicator.connect()
+                for i in range(3):
+                    await manager_communicator.send_json_to(
+                        {"message": f"m{i}"}
+                    )
+                    await manager_communicator.receive_json_from()
+                await manager_communicator.disconnect()
+
+                client_communicator = WebsocketCommunicator(
+                    application, f"{path}?resume_from=0"
+                )
+                client_communicator.scope["user"] = self.client_user
+                await client_communicator.connect()
+                response = await client_communicator.receive_json_from()
+                await client_communicator.disconnect()
+        finally:
+            writer.flush_interval = interval
+        self.assertEqual([m["message"] for m in response["messages"]],
+                         ["m0", "m1", "m2"])
+
+    async def test_lifespan_shutdown_flushes_write_behind_queue(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        writer = get_writer()
+        interval, writer.flush_interval = writer.flush_interval, 60
+        try:
+            with self.settings(CHAT_WRITE_BEHIND={'ENABLED': True}):
+                communicator = WebsocketCommunicator(application, path)
+                communicator.scope["user"] = self.manager
+                await communicator.connect()
+                for i in range(3):
+                    await communicator.send_json_to({"message": f"m{i}"})
+                    await communicator.receive_json_from()
+                await communicator.disconnect()
+
+            server = ApplicationCommunicator(application,
+                                             {"type": "lifespan"})
+            await server.send_input({"type": "lifespan.startup"})
+            self.assertEqual(await server.receive_output(),
+                             {"type": "lifespan.startup.complete"})
+            await server.send_input({"type": "lifespan.shutdown"})
+            self.assertEqual(await server.receive_output(),
+                             {"type": "lifespan.shutdown.complete"})
+        finally:
+            writer.flush_interval = interval
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(await sync_to_async(ChatMessage.objects.filter(
+            content__in=["m0", "m1", "m2"]).count)(), 3)
+
+    async def test_resume_is_capped(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        manager_communicator = WebsocketCommunicator(application, path)
+        manager_communicator.scope["user"] = self.manager
+        await manager_communicator.connect()
+        for i in range(3):
+            await manager_communicator.send_json_to({"message": f"m{i}"})
+            await manager_communicator.receive_json_from()
+        await manager_communicator.disconnect()
+
+        with self.settings(CHAT_RESUME={'MAX_MESSAGES': 2}):
+            communicator = WebsocketCommunicator(application, "/ws/chat/")
+            communicator.scope["user"] = self.client_user
+            await communicator.connect()
+            await communicator.send_json_to({
+                "action": "subscribe",
+                "conversation": f"{self.manager.id}_{self.client_user.id}",
+                "resume_from": 0,
+            })
+            await communicator.receive_json_from()
+            response = await communicator.receive_json_from()
+        self.assertEqual([m["seq"] for m in response["messages"]], [1, 2])
+        self.assertTrue(response["last"])
+        self.assertTrue(response["truncated"])
+        await communicator.disconnect()
+
+    async def test_allocator_numbers_concurrent_senders(self):
+        """
+        Одновременные отправители получают разные номера подряд.
+        """
+        allocator = SeqAllocator()
+        results = await asyncio.gather(*(
+            allocator.allocate(self.manager.id, self.client_user.id)
+            for _ in range(20)
+        ))
+        self.assertEqual(sorted(seq for _, seq in results),
+                         list(range(1, 21)))
+        conversation = await sync_to_async(Conversation.objects.get)(
+            manager=self.manager, client=self.client_user
+        )
+        self.assertEqual(conversation.last_seq, 20)
+        self.assertEqual({pk for pk, _ in results}, {conversation.pk})
+
+    async def test_rate_limit_rejects_flood_without_writing(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        limits = {'CONNECTION_RATE': 0.001, 'CONNECTION_BURST': 2}
+        with self.settings(CHAT_RATE_LIMIT=limits):
+            communicator = WebsocketCommunicator(application, path)
+            communicator.scope["user"] = self.client_user
+            await communicator.connect()
+            for i in range(3):
+                await communicator.send_json_to({"message": f"m{i}"})
+            frames = [await communicator.receive_json_from()
+                      for _ in range(3)]
+            errors = [f for f in frames if "error" in f]
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(errors[0]["code"], "rate_limited")
+            self.assertGreater(errors[0]["retry_after"], 0)
+            self.assertEqual({f.get("message") for f in frames
+                              if "error" not in f}, {"m0", "m1"})
+
+            # Лимит соединения не задевает собеседника.
+            manager_communicator = WebsocketCommunicator(application, path)
+            manager_communicator.scope["user"] = self.manager
+            await manager_communicator.connect()
+            await manager_communicator.send_json_to({"message": "ответ"})
+            response = await manager_communicator.receive_json_from()
+            self.assertEqual(response["message"], "ответ")
+        self.assertEqual(
+            await sync_to_async(ChatMessage.objects.count)(), 3
+        )
+        await communicator.disconnect()
+        await manager_communicator.disconnect()
+
+    async def test_rate_limit_per_user_spans_connections(self):
+        path = f"/ws/chat/{self.manager.id}/{self.client_user.id}/"
+        limits = {'USER_RATE': 0.001, 'USER_BURST': 2}
+        with self.settings(CHAT_RATE_LIMIT=limits):
+            sockets = []
+            for i in range(3):
+                communicator = WebsocketCommunicator(application, path)
+                communicator.scope["user"] = self.client_user
+                await communicator.connect()
+                sockets.append(communicator)
+            for i, communicator in enumerate(sockets):
+                await communicator.send_json_to({"message": f"m{i}"})
+                while True:
+                    frame = await communicator.receive_json_from()
+                    if frame.get("message") == f"m{i}" or "error" in frame:
+                        break
+            self.assertEqual(frame["code"], "rate_limited")
+        for communicator in sockets:
+            await communicator.disconnect()
@@ -1,11 +1,16 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ChatMessageViewSet, ChatRelationViewSet
+from .views import (
+    ChatMessageViewSet, ChatRelationViewSet, ConversationViewSet, metrics
+)
 
 router = DefaultRouter()
 router.register(r'messages', ChatMessageViewSet, basename='messages')
 router.register(r'relations', ChatRelationViewSet, basename='relations')
+router.register(r'conversations', ConversationViewSet,
+                basename='conversations')
 
 urlpatterns = [
+    path('metrics', metrics, name='metrics'),
     path('', include(router.urls)),
 ]
@@ -1,10 +1,46 @@
+import functools
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib.auth.models import User
 from django.db.models import Q
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+)
 from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
-from .models import ChatMessage, ChatRelation
-from .serializers import ChatMessageSerializer, ChatRelationSerializer
+from . import (
+    broadcast as chat_broadcast, export, history_cache,
+    metrics as chat_metrics, receipts, services
+)
+from .archive import ArchivedHistory
+from .search import MessageSearch
+from .conf import chat_setting
+from .models import ChatMessage, ChatRelation, Conversation
+from .pagination import (
+    KeysetPagination, RecentConversationPagination, RelationPagination,
+    SearchPagination
+)
+from .serializers import (
+    ChatMessageSerializer,
+    ChatRelationSerializer,
+    ConversationSerializer,
+    FastChatMessageSerializer,
+    FastChatRelationSerializer,
+    RECEIPT_VALUES,
+)
+
+logger = logging.getLogger(__name__)
+
+serialize_seconds = chat_metrics.histogram(
+    'chat_api_serialize_seconds',
+    'Сериализация списка сообщений REST API, включая выборку пользователей.'
+)
 
 
 class ChatMessageViewSet(viewsets.ReadOnlyModelViewSet):
@@ -18,8 +54,220 @@ class ChatMessageViewSet(viewsets.ReadOnlyModelViewSet):
         user = self.request.user
         return ChatMessage.objects.filter(
             Q(sender=user) | Q(receiver=user)
+        ).select_related(
+            'sender', 'receiver', 'conversation'
+        ).order_by('-timestamp', '-id')
+
+    def list(self, request, *args, **kwargs):
+        rows = list(self.get_queryset().values(
+            *FastChatMessageSerializer.values_fields
+        ))
+        with serialize_seconds.time():
+            data = FastChatMessageSerializer(rows).data
+        return Response(data)
+
+    def get_counterpart(self):
+        counterpart = self.request.query_params.get('with_user')
+        if counterpart is None:
+            return None
+        try:
+            return int(counterpart)
+        except ValueError:
+            raise ValidationError({"detail": "with_user должен быть числом."})
+
+    def get_history_branches(self):
+        """
+        Возвращает ветви запроса истории: исходящие и входящие сообщения
+        пользователя, при `with_user` – только переписку с этим собеседником.
+        Каждая ветвь обслуживается своим составным индексом.
+        """
+        user = self.request.user
+        counterpart = self.get_counterpart()
+        messages = ChatMessage.objects.values(
+            *FastChatMessageSerializer.values_fields
+        )
+        if counterpart is None:
+            return [messages.filter(sender=user),
+                    messages.filter(receiver=user)]
+        return [messages.filter(sender=user, receiver_id=counterpart),
+                messages.filter(sender_id=counterpart, receiver=user)]
+
+    @action(detail=False, methods=['get'])
+    def history(self, request):
+        """
+        История сообщений с keyset-пагинацией по (timestamp, id).
+        Когда горячая таблица заканчивается, страница дочитывается из
+        архива (chat.archive). Последние страницы переписки с `with_user`
+        отдаются из кэша (chat.history_cache).
+        """
+        paginator = KeysetPagination()
+        counterpart = self.get_counterpart()
+        archive = ArchivedHistory(request.user.id, counterpart,
+                                  FastChatMessageSerializer.values_fields)
+        if counterpart is not None and history_cache.history_cache_enabled():
+            data = self.cached_history(paginator, archive)
+            if data is not None:
+                return paginator.get_paginated_response(data)
+        page = paginator.paginate_queryset(
+            self.get_history_branches(), request, view=self, archive=archive
+        )
+        with serialize_seconds.time():
+            data = FastChatMessageSerializer(page).data
+        return paginator.get_paginated_response(data)
+
+    def cached_history(self, paginator, archive):
+        """
+        Страница переписки из кэша последних сообщений или None, если её
+        нужно читать из базы. Буфер сверяется с Conversation.last_seq тем
+        же запросом, что выбирает отметки доставки и прочтения.
+        """
+        request = self.request
+        if 'after' in request.query_params:
+            history_cache.misses.inc()
+            return None
+        entry = history_cache.get(archive.user_id, archive.counterpart_id)
+        if entry is None:
+            entry = history_cache.load(self.get_history_branches(), archive)
+            if entry is None:
+                history_cache.misses.inc()
+                return None
+        marks = Conversation.objects.filter(
+            pk=entry['conversation_id']
+        ).values(*RECEIPT_VALUES, 'last_seq').first()
+        if marks is None or marks['last_seq'] != entry['last_seq']:
+            history_cache.stale.inc()
+            history_cache.misses.inc()
+            history_cache.invalidate([(archive.user_id,
+                                       archive.counterpart_id)])
+            return None
+        page = paginator.paginate_window(
+            request, functools.partial(history_cache.window, entry)
+        )
+        if page is None:
+            history_cache.misses.inc()
+            return None
+        history_cache.hits.inc()
+        with serialize_seconds.time():
+            return FastChatMessageSerializer(
+                page, users=entry['users'], receipts={marks['id']: marks}
+            ).data
+
+    @action(detail=False, methods=['post'])
+    def broadcast(self, request):
+        """
+        Рассылка менеджера своим клиентам: `{"message": ..., "clients":
+        [id, ...] | "all"}`. Каждый клиент получает обычное сообщение
+        своего диалога. В ответе – число получателей и id без связи.
+        """
+        if not request.user.is_staff:
+            return Response(
+                {"detail": "Только менеджер может делать рассылки."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            message = chat_broadcast.parse_message(
+                request.data.get('message')
+            )
+            client_ids = chat_broadcast.parse_clients(
+                request.data.get('clients')
+            )
+        except ValueError as error:
+            raise ValidationError({"detail": str(error)})
+        with chat_broadcast.broadcast_seconds.time():
+            messages, rejected = services.broadcast_messages(
+                request.user, message, client_ids
+            )
+            try:
+                async_to_sync(chat_broadcast.announce)(
+                    get_channel_layer(), request.user.id, messages
+                )
+            except Exception:
+                logger.exception('Не удалось разослать рассылку')
+        chat_broadcast.recipients.inc(len(messages))
+        return Response({'sent': len(messages), 'rejected': rejected},
+                        status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Поиск по тексту сообщений пользователя: `q` – слова, которые все
+        должны встретиться в сообщении, `with_user` – только переписка с
+        этим собеседником. Лучшие совпадения первыми.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({"detail": "Укажите q."})
+        counterpart = self.get_counterpart()
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(
+            MessageSearch(query, request.user, counterpart,
+                          FastChatMessageSerializer.values_fields),
+            request, view=self
+        )
+        data = FastChatMessageSerializer(page).data
+        for item, row in zip(data, page):
+            item['score'] = row['score']
+        return paginator.get_paginated_response(data)
+
+
+class ConversationViewSet(viewsets.GenericViewSet):
+    """
+    Список диалогов пользователя (inbox) по сводке Conversation: последнее
+    сообщение и непрочитанные без обращения к таблице сообщений.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        user = self.request.user
+        return Conversation.objects.filter(
+            Q(manager=user) | Q(client=user)
         )
 
+    def get_inbox_branches(self):
+        """
+        Диалоги, где пользователь менеджер, и диалоги, где он клиент;
+        каждая ветвь читается своим индексом по last_timestamp.
+        """
+        user = self.request.user
+        conversations = Conversation.objects.filter(
+            last_timestamp__isnull=False
+        ).values(*ConversationSerializer.values_fields)
+        return [conversations.filter(manager=user),
+                conversations.filter(client=user)]
+
+    def list(self, request):
+        paginator = RecentConversationPagination()
+        page = paginator.paginate_queryset(
+            self.get_inbox_branches(), request, view=self
+        )
+        return paginator.get_paginated_response(
+            ConversationSerializer(page, request.user).data
+        )
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        """
+        Отмечает сообщения прочитанными: все или до `seq` из тела запроса.
+        Собеседник получает отметку так же, как после подтверждения по
+        WebSocket.
+        """
+        conversation = self.get_object()
+        seq = request.data.get('seq')
+        if seq is not None:
+            try:
+                seq = int(seq)
+            except (TypeError, ValueError):
+                raise ValidationError({"detail": "seq должен быть числом."})
+        state = services.mark_read(conversation, request.user.id, seq)
+        if state['changed']:
+            try:
+                async_to_sync(receipts.announce)(get_channel_layer(),
+                                                 [state])
+            except Exception:
+                logger.exception('Не удалось разослать отметку прочтения')
+        return Response({'read_seq': state['read'],
+                         'unread': state['unread']})
+
 
 # class ChatRelationViewSet(viewsets.ReadOnlyModelViewSet):
 #     """
@@ -55,10 +303,27 @@ class ChatRelationViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        relations = ChatRelation.objects.select_related('manager', 'client')
         if user.is_staff:
-            return ChatRelation.objects.filter(manager=user)
+            return relations.filter(manager=user)
         else:
-            return ChatRelation.objects.filter(client=user)
+            return relations.filter(client=user)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Связи страницами: `limit`, `ordering` и `cursor` (см.
+        RelationPagination).
+        """
+        paginator = RelationPagination()
+        page = paginator.paginate_queryset(
+            self.get_queryset().values(
+                *FastChatRelationSerializer.values_fields
+            ),
+            request, view=self
+        )
+        return paginator.get_paginated_response(
+            FastChatRelationSerializer(page).data
+        )
 
     def create(self, request, *args, **kwargs):
         if not request.user.is_staff:
@@ -82,6 +347,12 @@ class ChatRelationViewSet(viewsets.ModelViewSet):
                 {"detail": "Менеджер или клиент с указанными ID не найдены"},
                 status=status.HTTP_404_NOT_FOUND
             )
+        if ChatRelation.objects.filter(manager=manager,
+                                       client=client).exists():
+            return Response(
+                {"detail": "Связь уже существует."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         relation = ChatRelation.objects.create(manager=manager, client=client)
         serializer = self.get_serializer(relation)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -116,3 +387,147 @@ class ChatRelationViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['post'], url_path='import',
+            url_name='import')
+    def bulk_import(self, request):
+        """
+        Массовое создание связей: `{"relations": [{"manager_id": ...,
+        "client_id": ...}, ...]}`. Существующие пары пропускаются.
+        """
+        if not request.user.is_staff:
+            return Response(
+                {"detail": "Только менеджер может создавать новые связи."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        relations = request.data.get('relations')
+        if not isinstance(relations, list) or not relations:
+            raise ValidationError(
+                {"detail": "relations должен быть непустым списком."}
+            )
+        if len(relations) > chat_setting('CHAT_RELATIONS')['MAX_BULK']:
+            raise ValidationError({"detail": "Слишком много связей."})
+        try:
+            pairs = {(int(item['manager_id']), int(item['client_id']))
+                     for item in relations}
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError(
+                {"detail": "Каждая связь – manager_id и client_id числами."}
+            )
+        missing = self.missing_users({user_id for pair in pairs
+                                      for user_id in pair})
+        if missing:
+            return Response(
+                {"detail": "Пользователи не найдены.", "missing": missing},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        created = services.import_relations(pairs)
+        return Response({'created': created,
+                         'existing': len(pairs) - created},
+                        status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def reassign(self, request):
+        """
+        Передача клиентов другому менеджеру: `{"from_manager_id": ...,
+        "to_manager_id": ..., "clients": [id, ...] | "all"}`. Менеджер
+        передаёт только своих клиентов (from_manager_id – он сам), и только
+        сотруднику.
+        """
+        if not request.user.is_staff:
+            return Response(
+                {"detail": "Только менеджер может изменять чат."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            from_manager_id = int(request.data.get('from_manager_id'))
+            to_manager_id = int(request.data.get('to_manager_id'))
+        except (TypeError, ValueError):
+            raise ValidationError({
+                "detail": "Необходимо передать from_manager_id и to_manager_id"
+            })
+        if from_manager_id != request.user.id:
+            return Response(
+                {"detail": "Можно передавать только своих клиентов."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        clients = request.data.get('clients')
+        client_ids = None
+        if clients != 'all':
+            if not isinstance(clients, list) or not clients:
+                raise ValidationError({
+                    "detail": 'clients должен быть непустым списком id или "all".'
+                })
+            if len(clients) > chat_setting('CHAT_RELATIONS')['MAX_BULK']:
+                raise ValidationError({"detail": "Слишком много клиентов."})
+            try:
+                client_ids = sorted({int(client_id) for client_id in clients})
+            except (TypeError, ValueError):
+                raise ValidationError(
+                    {"detail": "clients должен содержать только числа."}
+                )
+        to_manager_is_staff = User.objects.filter(
+            pk=to_manager_id
+        ).values_list('is_staff', flat=True).first()
+        if to_manager_is_staff is None:
+            return Response(
+                {"detail": "Менеджер с указанным ID не найден"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if not to_manager_is_staff:
+            raise ValidationError(
+                {"detail": "Передать клиентов можно только менеджеру."}
+            )
+        return Response(services.reassign_relations(
+            from_manager_id, to_manager_id, client_ids
+        ))
+
+    def missing_users(self, ids):
+        """
+        id из `ids`, которых нет среди пользователей, – одним запросом.
+        """
+        found = set(User.objects.filter(id__in=ids).values_list('id',
+                                                               flat=True))
+        return sorted(set(ids) - found)
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Потоковая выгрузка всей переписки связи, включая архив:
+        `output=ndjson` (по умолчанию) или `output=csv`.
+        """
+        relation = self.get_object()
+        output = request.query_params.get('output', 'ndjson')
+        if output not in export.CONTENT_TYPES:
+            raise ValidationError(
+                {"detail": "output должен быть ndjson или csv."}
+            )
+        args = (relation.manager_id, relation.client_id, output)
+        # Синхронный итератор под ASGI Django собрал бы в память целиком.
+        if isinstance(request._request, ASGIRequest):
+            content = export.aexport_chunks(*args)
+        else:
+            content = export.export_chunks(*args)
+        response = StreamingHttpResponse(
+            content, content_type=export.CONTENT_TYPES[output]
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="chat-{relation.manager_id}-'
+            f'{relation.client_id}.{output}"'
+        )
+        return response
+
+
+def metrics(request):
+    """
+    Метрики процесса в текстовом формате Prometheus. Доступны с адресов
+    CHAT_METRICS['ALLOWED_IPS'] и сотрудникам (is_staff).
+    """
+    config = chat_setting('CHAT_METRICS')
+    if not config['ENABLED']:
+        raise Http404
+    if request.META.get('REMOTE_ADDR') not in config['ALLOWED_IPS'] and \
+            not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(chat_metrics.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
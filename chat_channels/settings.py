@@ -50,6 +50,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Число и время SQL-запросов на HTTP-запрос в /metrics.
+    'chat.middleware.QueryMetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'chat_channels.urls'
@@ -75,15 +77,150 @@ WSGI_APPLICATION = 'chat_channels.wsgi.application'
 
 ASGI_APPLICATION = 'chat_channels.asgi.application'
 
+# Группы и каналы распределяются по узлам hosts кольцом согласованного
+# хеширования (chat.sharding): при добавлении узла на него переезжает около
+# 1/N групп. Для шардирования перечислите несколько узлов, например
+# [('10.0.0.1', 6379), ('10.0.0.2', 6379)]; shard_names задаёт имена узлов
+# на кольце, если их адреса могут меняться.
+# Для одного процесса без Redis подходит 'chat.local_layer.LocalChannelLayer'
+# (CONFIG: capacity, channel_capacity, expiry, group_expiry).
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.sharding.ShardedRedisChannelLayer',
         'CONFIG': {
             'hosts': [('127.0.0.1', 6379)],
         },
     },
 }
 
+# Отложенная запись сообщений из WebSocket: сообщение рассылается сразу,
+# а в БД попадает пачкой через bulk_create (см. chat.persistence).
+CHAT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL_MS': 50,
+    'MAX_QUEUE': 10_000,
+    'PUT_TIMEOUT': 1.0,
+}
+
+# Кэш проверки доступа к чату (ChatRelation) в памяти процесса.
+# Изменения связей сбрасывают его сигналами и меняют версию связи в кэше
+# Django CACHE, чтобы сброс увидели остальные процессы. С locmem версии
+# видны только своему процессу, там устаревание ограничивает TTL.
+CHAT_RELATION_CACHE = {
+    'ENABLED': True,
+    'MAX_SIZE': 10_000,
+    'TTL': 60,
+    'CACHE': 'default',
+}
+
+# Догрузка пропущенных сообщений по resume_from: размер пачки и предел
+# сообщений за один запрос.
+CHAT_RESUME = {
+    'BATCH_SIZE': 100,
+    'MAX_MESSAGES': 5000,
+}
+
+# Ограничение частоты входящих кадров WebSocket (кадров в секунду и запас):
+# на соединение и на пользователя. SHARED хранит лимит пользователя в Redis
+# channel layer, общий для всех процессов.
+CHAT_RATE_LIMIT = {
+    'ENABLED': True,
+    'CONNECTION_RATE': 5,
+    'CONNECTION_BURST': 20,
+    'USER_RATE': 10,
+    'USER_BURST': 40,
+    'SHARED': False,
+}
+
+# Поиск по сообщениям: 'auto' выбирает FTS5 SQLite, если он доступен,
+# иначе инвертированный индекс chat.models.MessageTerm. FTS5 ранжирует
+# не больше MAX_CANDIDATES самых новых совпадений.
+CHAT_SEARCH = {
+    'BACKEND': 'auto',
+    'MAX_CANDIDATES': 10_000,
+}
+
+# Архив: сообщения старше AFTER_DAYS дней переносятся командой
+# archive_messages в gzip-сегменты JSONL по месяцам в DIR.
+CHAT_ARCHIVE = {
+    'DIR': BASE_DIR / 'archive',
+    'AFTER_DAYS': 365,
+    'BATCH_SIZE': 5000,
+}
+
+# Метрики Prometheus на /metrics: открыты для is_staff и для адресов
+# ALLOWED_IPS. Адрес – REMOTE_ADDR: за обратным прокси на том же хосте он
+# локальный у всех запросов, поэтому localhost сюда добавляют, только если
+# прокси не пропускает /metrics снаружи.
+CHAT_METRICS = {
+    'ENABLED': True,
+    'ALLOWED_IPS': (),
+}
+
+# Подтверждения доставки и прочтения сводятся в отметки на диалог и
+# записываются пачкой раз в FLUSH_INTERVAL_MS или по BATCH_SIZE отметок.
+CHAT_RECEIPTS = {
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL_MS': 200,
+}
+
+# Присутствие в диалогах: STORE 'auto' хранит его в Redis channel layer, если
+# он используется, иначе в памяти процесса ('redis' и 'local' – явно).
+# Запись соединения живёт TTL секунд и продлевается
+# его кадрами не чаще раза в HEARTBEAT_INTERVAL. Событие «печатает»
+# рассылается не чаще раза в TYPING_INTERVAL секунд на соединение и диалог.
+CHAT_PRESENCE = {
+    'ENABLED': True,
+    'STORE': 'auto',
+    'TTL': 30,
+    'HEARTBEAT_INTERVAL': 10,
+    'TYPING_INTERVAL': 2.0,
+}
+
+# Обращения консьюмеров к БД выполняются в пуле из MAX_WORKERS потоков, а не
+# в одном общем потоке database_sync_to_async; 0 – выключить пул. Каждый поток
+# держит своё соединение, их не больше MAX_WORKERS. Пишущие вызовы идут в пул
+# при PARALLEL_WRITES True, при 'auto' – кроме SQLite.
+CHAT_DB_EXECUTOR = {
+    'MAX_WORKERS': 16,
+    'PARALLEL_WRITES': 'auto',
+}
+
+# /relations/import/ и /relations/reassign/ принимают не больше MAX_BULK
+# связей или клиентов за запрос; всё выполняется в одной транзакции.
+CHAT_RELATIONS = {
+    'MAX_BULK': 50_000,
+}
+
+# Рассылка менеджера: не больше MAX_RECIPIENTS получателей в списке, кадры
+# уходят в channel layer пачками по FANOUT_BATCH диалогов.
+CHAT_BROADCAST = {
+    'MAX_RECIPIENTS': 50_000,
+    'FANOUT_BATCH': 500,
+}
+
+# Соединение с ?batch=1 получает события групп кадрами-массивами: не больше
+# BATCH_MAX_EVENTS событий, первое ждёт не дольше BATCH_MAX_DELAY_MS
+# миллисекунд. ALLOW_BATCH False отключает пачки. ?encoding=msgpack – бинарные
+# кадры в msgpack.
+CHAT_FRAMING = {
+    'ALLOW_BATCH': True,
+    'BATCH_MAX_EVENTS': 50,
+    'BATCH_MAX_DELAY_MS': 5,
+}
+
+# Последние SIZE сообщений каждой переписки хранятся в кэше CACHE (TTL
+# секунд) и отдают первые страницы истории без запросов к таблице
+# сообщений. Кэш по умолчанию – locmem, свой в каждом процессе; для
+# нескольких процессов стоит указать общий, например RedisCache.
+CHAT_HISTORY_CACHE = {
+    'ENABLED': True,
+    'SIZE': 200,
+    'TTL': 600,
+    'CACHE': 'default',
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 